@@ -5,14 +5,34 @@ import threading
 import time
 import requests
 import logging
+import re
+import mimetypes
 from datetime import datetime
 from werkzeug.middleware.proxy_fix import ProxyFix
 from utils.xiaoyuzhou import get_episode_info, get_download_url
 from utils.opml_parser import parse_opml
 from utils.rss_parser import parse_rss_feed, get_episodes_from_rss
 from utils.download_manager import DownloadManager
+from utils.download_index import entry_owners
 from utils.task_manager import TaskManager
-from utils.audio_converter import convert_m4a_to_mp3, get_audio_format, check_ffmpeg
+from utils.task_store import TaskStore
+from utils.user_store import UserStore
+from utils.coordination import create_coordinator, ROLE_ALL, ROLE_API
+from utils.lifecycle import RequestTracker
+from utils.single_flight import SingleFlightDownloader
+from utils.zip_stream import stream_zip, unique_arcname
+from utils.file_serving import file_etag, accel_redirect_uri, OFFLOAD_MODES, OFFLOAD_X_ACCEL, OFFLOAD_X_SENDFILE
+from utils.scheduler import TaskScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKFILL
+from utils.retry import RetryPolicy
+from utils.derivative_cache import DerivativeCache, needs_derivative
+from utils.storage_tiering import StorageTiering
+from utils.reconciler import LibraryReconciler
+from utils.storage_quota import StorageQuota, QuotaExceededError, parse_user_quotas
+from utils.storage_backend import LocalStorage, S3Storage, STORAGE_LOCAL, STORAGE_S3
+from utils.audio_converter import (
+    convert_m4a_to_mp3, get_audio_format, check_ffmpeg,
+    peek_streamable_m4a, stream_convert_to_mp3, AUDIO_FORMATS
+)
 
 # 配置日志
 log_dir = os.getenv('LOG_DIR', '.')
@@ -55,6 +75,10 @@ if os.getenv('PROXY_FIX', '').lower() in ('1', 'true', 'yes'):
     )
     logger.info("已启用ProxyFix中间件")
 
+# 统计进行中的请求（包括流式传输），生产模式（serve.py）停止时等待它们结束
+request_tracker = RequestTracker(app.wsgi_app)
+app.wsgi_app = request_tracker
+
 # 添加模板上下文处理器，确保url_for正确处理路径前缀
 @app.context_processor
 def inject_application_root():
@@ -83,19 +107,256 @@ def url_for(endpoint, **values):
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DOWNLOAD_FOLDER'] = 'downloads'
 app.config['USERS_FOLDER'] = 'users'
+# 下载库的目录布局：由 / 分隔的 user（按用户）、podcast（按播客）、shard（按file_id分散到256个子目录）组成，
+# 例如 user/shard；为空时所有文件直接放在下载目录中。修改后用 migrate_library.py 迁移已有文件
+app.config['LIBRARY_LAYOUT'] = os.getenv('LIBRARY_LAYOUT', '')
+# 新文件的存储后端：local（默认，保存在下载目录中）或 s3（S3兼容的对象存储，需要安装boto3）
+# S3_ENDPOINT_URL为MinIO等兼容服务的地址；未设置S3_ACCESS_KEY_ID/S3_SECRET_ACCESS_KEY时使用boto3的默认凭证；
+# S3_PART_SIZE_MB为分片上传的分片大小（不小于5），S3_PRESIGN_EXPIRES为/downloads重定向的预签名URL有效期（秒）
+app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', STORAGE_LOCAL).strip().lower()
+app.config['S3_BUCKET'] = os.getenv('S3_BUCKET', '')
+app.config['S3_PREFIX'] = os.getenv('S3_PREFIX', '')
+app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL', '')
+app.config['S3_REGION'] = os.getenv('S3_REGION', '')
+app.config['S3_PART_SIZE_MB'] = float(os.getenv('S3_PART_SIZE_MB', '8'))
+app.config['S3_PRESIGN_EXPIRES'] = int(os.getenv('S3_PRESIGN_EXPIRES', '3600'))
+if app.config['STORAGE_BACKEND'] not in (STORAGE_LOCAL, STORAGE_S3):
+    raise ValueError(f"不支持的STORAGE_BACKEND: {app.config['STORAGE_BACKEND']}")
+if app.config['STORAGE_BACKEND'] == STORAGE_S3 and not app.config['S3_BUCKET']:
+    raise ValueError("STORAGE_BACKEND=s3 时必须设置S3_BUCKET")
+# 任务持久化数据（SQLite），重启后恢复任务和未完成的工作
+app.config['DATA_FOLDER'] = os.getenv('DATA_FOLDER', 'data')
+# 边下载边转换（管道流式转换），设置 STREAM_CONVERT=0 可强制使用临时文件转换
+app.config['STREAM_CONVERT'] = os.getenv('STREAM_CONVERT', '1').lower() in ('1', 'true', 'yes')
+
+# 派生文件缓存（/downloads/<file_id>?format=mp3 等按需生成的其他格式），超出容量按LRU淘汰
+app.config['DERIVATIVE_FOLDER'] = os.getenv('DERIVATIVE_FOLDER', os.path.join('cache', 'derivatives'))
+app.config['DERIVATIVE_CACHE_MAX_MB'] = int(os.getenv('DERIVATIVE_CACHE_MAX_MB', '2048'))
+
+# 已下载文件的发送方式：FILE_OFFLOAD=x-accel 时由nginx通过X-Accel-Redirect直接发送（需配置internal location，见NGINX_CONFIG.md），
+# x-sendfile 时使用Apache/lighttpd的X-Sendfile，为空时由应用发送；X_ACCEL_PREFIX为internal location的URI前缀
+app.config['FILE_OFFLOAD'] = os.getenv('FILE_OFFLOAD', '').strip().lower()
+if app.config['FILE_OFFLOAD'] and app.config['FILE_OFFLOAD'] not in OFFLOAD_MODES:
+    raise ValueError(f"不支持的FILE_OFFLOAD: {app.config['FILE_OFFLOAD']}")
+app.config['USE_X_SENDFILE'] = app.config['FILE_OFFLOAD'] == OFFLOAD_X_SENDFILE
+app.config['X_ACCEL_PREFIX'] = os.getenv('X_ACCEL_PREFIX', '/_protected')
+
+# 存储分层：把长时间未访问的节目重新压缩为语音优化的小体积格式
+# TIERING_ENABLED=1 时后台每 TIERING_INTERVAL_HOURS 小时执行一次
+app.config['TIERING_ENABLED'] = os.getenv('TIERING_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['TIERING_MAX_AGE_DAYS'] = int(os.getenv('TIERING_MAX_AGE_DAYS', '90'))
+app.config['TIERING_FORMAT'] = os.getenv('TIERING_FORMAT', 'opus')
+app.config['TIERING_BITRATE'] = os.getenv('TIERING_BITRATE', '32k')
+app.config['TIERING_THROTTLE'] = float(os.getenv('TIERING_THROTTLE', '1.0'))
+app.config['TIERING_INTERVAL_HOURS'] = float(os.getenv('TIERING_INTERVAL_HOURS', '24'))
+
+# 下载目录与元数据的一致性检查：启动时执行一次，之后每 RECONCILE_INTERVAL_HOURS 小时执行一次（为0时只在启动时执行，RECONCILE_ENABLED=0 关闭）
+# 孤立文件移到 QUARANTINE_FOLDER；RECONCILE_WORKERS为并行扫描子目录的线程数
+app.config['RECONCILE_ENABLED'] = os.getenv('RECONCILE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+app.config['RECONCILE_INTERVAL_HOURS'] = float(os.getenv('RECONCILE_INTERVAL_HOURS', '6'))
+app.config['RECONCILE_WORKERS'] = int(os.getenv('RECONCILE_WORKERS', '4'))
+app.config['QUARANTINE_FOLDER'] = os.getenv('QUARANTINE_FOLDER', os.path.join(app.config['DOWNLOAD_FOLDER'], '.quarantine'))
+# 存储配额（MB，0表示不限制）：QUOTA_GLOBAL_MB为下载库总配额，QUOTA_USER_MB为每个用户的默认配额，
+# QUOTA_USER_OVERRIDES按用户覆盖，格式 alice=2048,bob=512；超出时淘汰最久未播放的文件，固定的文件除外
+app.config['QUOTA_GLOBAL_MB'] = float(os.getenv('QUOTA_GLOBAL_MB', '0'))
+app.config['QUOTA_USER_MB'] = float(os.getenv('QUOTA_USER_MB', '0'))
+app.config['QUOTA_USER_OVERRIDES'] = parse_user_quotas(os.getenv('QUOTA_USER_OVERRIDES', ''))
+
+# 任务进度推送（SSE）：TASK_STREAM_MIN_INTERVAL为两次推送的最小间隔秒数，
+# TASK_STREAM_MAX_SECONDS为单个连接的最长时间，到期后浏览器自动重连，避免长期占用工作线程
+app.config['TASK_STREAM_MIN_INTERVAL'] = float(os.getenv('TASK_STREAM_MIN_INTERVAL', '0.5'))
+app.config['TASK_STREAM_MAX_SECONDS'] = float(os.getenv('TASK_STREAM_MAX_SECONDS', '300'))
 
 # 确保必要的文件夹存在
-for folder in [app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_FOLDER'], app.config['USERS_FOLDER']]:
+for folder in [app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_FOLDER'], app.config['USERS_FOLDER'], app.config['DATA_FOLDER']]:
     os.makedirs(folder, exist_ok=True)
 
+def create_storage_backend():
+    """按配置创建新文件使用的存储后端"""
+    if app.config['STORAGE_BACKEND'] == STORAGE_S3:
+        return S3Storage(
+            app.config['S3_BUCKET'],
+            app.config['DOWNLOAD_FOLDER'],
+            prefix=app.config['S3_PREFIX'],
+            endpoint_url=app.config['S3_ENDPOINT_URL'],
+            region=app.config['S3_REGION'],
+            access_key=os.getenv('S3_ACCESS_KEY_ID'),
+            secret_key=os.getenv('S3_SECRET_ACCESS_KEY'),
+            part_size=int(app.config['S3_PART_SIZE_MB'] * 1024 * 1024),
+            presign_expires=app.config['S3_PRESIGN_EXPIRES']
+        )
+    return LocalStorage(app.config['DOWNLOAD_FOLDER'])
+
 # 初始化管理器
-download_manager = DownloadManager(app.config['DOWNLOAD_FOLDER'])
-task_manager = TaskManager(download_manager)
+download_manager = DownloadManager(
+    app.config['DOWNLOAD_FOLDER'],
+    layout=app.config['LIBRARY_LAYOUT'],
+    storage=create_storage_backend(),
+    quota=StorageQuota(
+        global_bytes=int(app.config['QUOTA_GLOBAL_MB'] * 1024 * 1024),
+        user_bytes=int(app.config['QUOTA_USER_MB'] * 1024 * 1024),
+        user_overrides=app.config['QUOTA_USER_OVERRIDES']
+    )
+)
+user_store = UserStore(app.config['USERS_FOLDER'])
+# TASK_ARCHIVE_LIMIT: 数据库中保留的归档任务数上限
+task_store = TaskStore(
+    os.path.join(app.config['DATA_FOLDER'], 'tasks.db'),
+    archive_limit=int(os.getenv('TASK_ARCHIVE_LIMIT', '5000'))
+)
+# TASK_WORKERS: 同时执行的后台任务数上限
+task_scheduler = TaskScheduler(max_workers=int(os.getenv('TASK_WORKERS', '2')))
+# 下载失败重试：RETRY_MAX_ATTEMPTS为最多尝试次数，RETRY_BASE_DELAY/RETRY_MAX_DELAY为指数退避的起始和上限秒数
+retry_policy = RetryPolicy(
+    max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', '4')),
+    base_delay=float(os.getenv('RETRY_BASE_DELAY', '5')),
+    max_delay=float(os.getenv('RETRY_MAX_DELAY', '300'))
+)
+# 多进程部署：COORDINATION_URL为共享的协调后端（sqlite:///data/coordination.db 或 redis://host:6379/0），
+# 为空时单进程运行；WORKER_ROLE为本进程的角色：all（默认）、api（只处理请求）、worker（只执行任务，见worker.py）
+coordinator = create_coordinator(os.getenv('COORDINATION_URL', ''))
+# PIPELINE_QUEUE_SIZE: 后台任务中下载/转换/提交阶段之间的队列容量
+# TASK_HISTORY_LIMIT/TASK_HISTORY_MAX_AGE_DAYS: 内存中保留的已结束任务数和天数，超出的任务归档到数据库
+task_manager = TaskManager(
+    download_manager,
+    pipeline_queue_size=int(os.getenv('PIPELINE_QUEUE_SIZE', '2')),
+    store=task_store,
+    scheduler=task_scheduler,
+    retry_policy=retry_policy,
+    history_limit=int(os.getenv('TASK_HISTORY_LIMIT', '100')),
+    history_max_age_days=float(os.getenv('TASK_HISTORY_MAX_AGE_DAYS', '7')),
+    coordinator=coordinator,
+    role=os.getenv('WORKER_ROLE', ROLE_ALL)
+)
+storage_tiering = StorageTiering(
+    download_manager,
+    max_age_days=app.config['TIERING_MAX_AGE_DAYS'],
+    target_format=app.config['TIERING_FORMAT'],
+    bitrate=app.config['TIERING_BITRATE'],
+    throttle=app.config['TIERING_THROTTLE']
+)
+reconciler = LibraryReconciler(
+    download_manager,
+    quarantine_folder=app.config['QUARANTINE_FOLDER'],
+    workers=app.config['RECONCILE_WORKERS']
+)
+derivative_cache = DerivativeCache(
+    app.config['DERIVATIVE_FOLDER'],
+    max_bytes=app.config['DERIVATIVE_CACHE_MAX_MB'] * 1024 * 1024
+)
+# 因配额被淘汰的文件同时清理派生缓存
+download_manager.on_evict = derivative_cache.invalidate
+
+def get_unique_server_path(filename, file_id, username=None):
+    """按下载库的目录布局为文件生成不冲突的保存路径"""
+    safe_server_filename = download_manager._sanitize_filename(filename)
+    return download_manager.get_unique_path(file_id, safe_server_filename, username or 'unknown')
+
+def save_proxy_download(spool_path, headers, save_as):
+    """代理下载结束后，把共享下载的暂存文件保存到下载目录并记录元数据"""
+    audio_url = save_as['audio_url']
+    file_id = download_manager._get_file_id(audio_url)
+    if not download_manager.make_room(save_as['username'], os.path.getsize(spool_path), (file_id,)):
+        logger.warning(f"超出存储配额，不保存到服务器: {audio_url}, 用户: {save_as['username']}")
+        return
+    server_file_path = get_unique_server_path(save_as['filename'], file_id, save_as['username'])
+    os.replace(spool_path, server_file_path)
+    if download_manager.add_file(file_id, {
+        'file_id': file_id,
+        'filename': os.path.basename(server_file_path),
+        'file_path': server_file_path,
+        'size': os.path.getsize(server_file_path),
+        'downloaded_at': datetime.now().isoformat(),
+        'username': save_as['username'],
+        'owners': [save_as['username'] or 'unknown'],
+        'episode_info': {
+            'title': save_as['title'],
+            'audio_url': audio_url
+        }
+    }):
+        logger.info(f"文件已保存到服务器: {server_file_path}, 文件ID: {file_id}")
+
+# 代理下载（/api/episode/download）：同一URL的并发请求合并为一次上游下载，暂存文件放在下载目录中，保存时只需重命名
+proxy_downloader = SingleFlightDownloader(app.config['DOWNLOAD_FOLDER'], on_complete=save_proxy_download)
+
+def serve_from_library(audio_url, safe_filename, convert_to_mp3=False, owner=None):
+    """
+    代理下载优先使用下载库：该URL已保存到服务器（例如监听任务已下载）时直接发送本地文件
+    需要mp3而本地是m4a时使用派生缓存中的mp3；mp3尚未生成时在后台生成，本次回源流式转换，
+    不等待完整转换后才发送第一个字节
+    owner: 可选，要求保存到服务器的用户，加入该文件的所有者
+    返回: Response，未命中时返回None（由调用方回源下载）
+    """
+    file_id = download_manager._get_file_id(audio_url)
+    file_info = download_manager.get_file_info(file_id)
+    if not file_info:
+        return None
+    remote = not download_manager.is_local(file_info)
+    if remote and convert_to_mp3 and file_info['file_path'].lower().endswith(('.m4a', '.m4b')):
+        # 对象存储中的文件没有派生缓存，需要转换时回源下载
+        return None
+    if not remote and not os.path.exists(file_info['file_path']):
+        return None
+    if file_info.get('tiered'):
+        # 已重新压缩为低码率的语音格式，音质不如源文件，回源下载
+        return None
+    
+    serve_path = file_info['file_path']
+    mimetype = None
+    target_format = None
+    if not remote and convert_to_mp3 and get_audio_format(serve_path) == 'm4a':
+        if not check_ffmpeg():
+            return None
+        target_format = 'mp3'
+        serve_path = derivative_cache.lookup(file_id, file_info['file_path'], target_format)
+        if not serve_path:
+            if derivative_cache.prefetch(file_id, file_info['file_path'], target_format):
+                logger.info(f"派生缓存中没有mp3，后台生成，本次回源 - 文件ID: {file_id}")
+            return None
+        mimetype = AUDIO_FORMATS[target_format]['mimetype']
+    
+    proxy_downloader.record_library_hit()
+    download_manager.touch(file_id)
+    if owner:
+        try:
+            download_manager.add_owner(file_id, owner)
+        except QuotaExceededError as e:
+            logger.warning(f"{str(e)}，不加入下载库 - 文件ID: {file_id}")
+    filename = f"{safe_filename}{os.path.splitext(serve_path)[1]}"
+    if remote:
+        logger.info(f"下载库中已有该音频，重定向到对象存储: {file_info['object_key']}, 文件ID: {file_id}")
+        return redirect_to_storage(file_info, filename)
+    logger.info(f"下载库中已有该音频，直接发送本地文件: {serve_path}, 文件ID: {file_id}")
+    # ETag与/downloads/<file_id>一致
+    return send_download_file(serve_path, filename, mimetype, f"{file_id}:{target_format or ''}:")
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活检查：进程能处理请求即返回200"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪检查：正在停止或依赖不可用时返回503，负载均衡据此摘除实例"""
+    checks = {}
+    try:
+        task_store.ping()
+        checks['task_store'] = 'ok'
+    except Exception as e:
+        checks['task_store'] = str(e)
+    checks['download_folder'] = 'ok' if os.access(app.config['DOWNLOAD_FOLDER'], os.W_OK) else '不可写'
+    status = request_tracker.get_status()
+    ready = not status['draining'] and all(value == 'ok' for value in checks.values())
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'checks': checks,
+        **status
+    }), 200 if ready else 503
+
 @app.route('/api/episode/info', methods=['POST'])
 def get_episode_info_api():
     """获取单集节目信息"""
@@ -147,6 +408,7 @@ def download_episode_file():
     audio_url = data.get('url', '').strip()
     filename = data.get('filename', 'episode').strip()
     convert_to_mp3 = data.get('convert_to_mp3', False)  # 是否转换为mp3
+    stream_convert = data.get('stream_convert', app.config['STREAM_CONVERT'])  # 是否边下载边转换
     save_to_server = data.get('save_to_server', False)  # 是否保存到服务器
     username = data.get('username', '').strip()  # 用户名（用于下载管理）
     
@@ -163,21 +425,29 @@ def download_episode_file():
         logger.warning("请求失败: 未提供音频链接")
         return jsonify({'error': '请提供音频链接'}), 400
     
+    # 响应关闭时执行的清理（见下方call_on_close），处理出错时也在下方执行
+    close_callbacks = []
     try:
         # 清理文件名，移除非法字符
         safe_filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
         safe_filename = safe_filename.strip()[:100]  # 限制长度
         
-        # 下载文件
+        # 下载库中已有该音频时不再回源
+        library_response = serve_from_library(
+            audio_url, safe_filename, convert_to_mp3, owner=(username or 'unknown') if save_to_server else None
+        )
+        if library_response is not None:
+            logger.info(f"=== 下载请求处理完成，使用下载库中的文件 ===")
+            return library_response
+        
+        # 下载文件：同一URL的并发请求共享一次上游下载
         logger.info(f"开始从源服务器获取音频文件...")
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(audio_url, headers=headers, stream=True, timeout=30)
-        response.raise_for_status()
+        upstream = proxy_downloader.open(audio_url)
+        close_callbacks.append(upstream.close)
+        upstream_headers = upstream.wait_headers()
         
         # 获取文件大小
-        content_length = response.headers.get('Content-Length')
+        content_length = upstream_headers['content_length']
         if content_length:
             size_mb = int(content_length) / 1024 / 1024
             logger.info(f"文件大小: {size_mb:.2f} MB")
@@ -185,7 +455,7 @@ def download_episode_file():
             logger.warning("无法获取文件大小信息")
         
         # 确定文件扩展名
-        content_type = response.headers.get('Content-Type', '')
+        content_type = upstream_headers['content_type']
         if 'mp3' in content_type or audio_url.endswith('.mp3'):
             ext = 'mp3'
         elif 'm4a' in content_type or audio_url.endswith('.m4a'):
@@ -200,42 +470,110 @@ def download_episode_file():
         server_file_handle = None
         file_id = None
         
-        if save_to_server:
+        if save_to_server and not (convert_to_mp3 and ext == 'm4a'):
+            # 原始文件在共享下载结束后保存，同一URL的并发请求只保存一份
+            upstream.request_save({
+                'audio_url': audio_url,
+                'title': filename,
+                'filename': f'{safe_filename}.{ext}',
+                'username': username
+            })
+        elif save_to_server:
             # 使用download_manager生成唯一文件名并创建文件
             logger.info(f"准备保存文件到服务器...")
             file_id = download_manager._get_file_id(audio_url)
-            safe_server_filename = download_manager._sanitize_filename(f'{safe_filename}.{ext}')
-            server_file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], safe_server_filename)
-            
-            # 处理文件名冲突
-            base_name, file_ext = os.path.splitext(safe_server_filename)
-            counter = 1
-            while os.path.exists(server_file_path):
-                safe_server_filename = f"{base_name}_{counter}{file_ext}"
-                server_file_path = os.path.join(app.config['DOWNLOAD_FOLDER'], safe_server_filename)
-                counter += 1
+            server_file_path = get_unique_server_path(f'{safe_filename}.{ext}', file_id, username)
             
             logger.info(f"服务器保存路径: {server_file_path}")
             server_file_handle = open(server_file_path, 'wb')
+            server_file_state = {'completed': False}
+            
+            def discard_incomplete_server_file():
+                """响应关闭时关闭服务器文件，转换未完成（包括generate()从未执行）时删除不完整的文件"""
+                server_file_handle.close()
+                if not server_file_state['completed'] and os.path.exists(server_file_path):
+                    os.unlink(server_file_path)
+            close_callbacks.append(discard_incomplete_server_file)
         
         # 如果需要转换且文件是m4a格式
         if convert_to_mp3 and ext == 'm4a':
             logger.info(f"检测到M4A格式，准备转换为MP3...")
             if not check_ffmpeg():
                 logger.error("ffmpeg未安装，无法转换格式")
+                upstream.close()
                 if server_file_handle:
                     server_file_handle.close()
                     if os.path.exists(server_file_path):
                         os.unlink(server_file_path)
                 return jsonify({'error': 'ffmpeg未安装，无法转换格式。请安装ffmpeg或取消转换选项。'}), 400
             
+            upstream_chunks = upstream.iter_chunks(chunk_size=8192)
+            streamable = False
+            if stream_convert:
+                # 预读文件头，moov在mdat之前的m4a才能通过管道转换
+                streamable, upstream_chunks = peek_streamable_m4a(upstream_chunks)
+                if not streamable:
+                    logger.info("M4A文件的moov位于文件末尾，无法流式转换，回退到临时文件转换")
+        
+        if convert_to_mp3 and ext == 'm4a' and streamable:
+            # 流式转换：上游数据直接送入ffmpeg，转换结果边产出边发送（同时保存到服务器），不产生临时文件
+            logger.info(f"开始流式转换M4A为MP3...")
+            mp3_chunks = stream_convert_to_mp3(upstream_chunks)
+            close_callbacks.append(mp3_chunks.close)
+            
+            def generate():
+                completed = False
+                try:
+                    streamed_size = 0
+                    for chunk in mp3_chunks:
+                        if server_file_handle:
+                            server_file_handle.write(chunk)
+                        streamed_size += len(chunk)
+                        yield chunk
+                    completed = True
+                    if server_file_handle:
+                        server_file_state['completed'] = True
+                    logger.info(f"流式转换传输完成，总大小: {streamed_size / 1024 / 1024:.2f} MB")
+                except Exception as e:
+                    logger.error(f"流式转换过程出错: {str(e)}")
+                    # 重新抛出以中断连接，让客户端感知传输不完整
+                    raise
+                finally:
+                    mp3_chunks.close()
+                    upstream.close()
+                    if server_file_handle:
+                        server_file_handle.close()
+                        if completed and os.path.exists(server_file_path):
+                            if download_manager.add_file(file_id, {
+                                'file_id': file_id,
+                                'filename': os.path.basename(server_file_path),
+                                'file_path': server_file_path,
+                                'size': os.path.getsize(server_file_path),
+                                'downloaded_at': datetime.now().isoformat(),
+                                'username': username,
+                                'owners': [username or 'unknown'],
+                                'episode_info': {
+                                    'title': filename,
+                                    'audio_url': audio_url
+                                }
+                            }):
+                                logger.info(f"文件已保存到服务器: {server_file_path}, 文件ID: {file_id}")
+                        elif os.path.exists(server_file_path):
+                            # 转换未完成，删除不完整的服务器文件
+                            os.unlink(server_file_path)
+            
+            ext = 'mp3'
+            content_type = 'audio/mpeg'
+            # 转换后的大小无法预知
+            content_length = None
+        elif convert_to_mp3 and ext == 'm4a':
             # 创建临时文件保存m4a
             logger.info(f"开始下载原始M4A文件到临时目录...")
             with tempfile.NamedTemporaryFile(delete=False, suffix='.m4a') as temp_m4a:
                 temp_m4a_path = temp_m4a.name
                 # 下载到临时文件
                 downloaded_size = 0
-                for chunk in response.iter_content(chunk_size=8192):
+                for chunk in upstream_chunks:
                     if chunk:
                         temp_m4a.write(chunk)
                         downloaded_size += len(chunk)
@@ -272,32 +610,37 @@ def download_episode_file():
                                 if server_file_handle:
                                     server_file_handle.write(chunk)
                                 yield chunk
+                        if server_file_handle:
+                            server_file_state['completed'] = True
                     finally:
-                        # 关闭服务器文件
+                        # 关闭服务器文件，传输未完成时由discard_incomplete_server_file删除
                         if server_file_handle:
                             server_file_handle.close()
                             # 保存元数据
-                            if save_to_server and os.path.exists(server_file_path):
-                                download_manager.metadata[file_id] = {
+                            if server_file_state['completed'] and os.path.exists(server_file_path):
+                                if download_manager.add_file(file_id, {
                                     'file_id': file_id,
                                     'filename': os.path.basename(server_file_path),
                                     'file_path': server_file_path,
                                     'size': os.path.getsize(server_file_path),
                                     'downloaded_at': datetime.now().isoformat(),
                                     'username': username,
+                                    'owners': [username or 'unknown'],
                                     'episode_info': {
                                         'title': filename,
                                         'audio_url': audio_url
                                     }
-                                }
-                                download_manager._save_metadata()
-                                logger.info(f"文件已保存到服务器: {server_file_path}, 文件ID: {file_id}")
+                                }):
+                                    logger.info(f"文件已保存到服务器: {server_file_path}, 文件ID: {file_id}")
                         
-                        # 清理临时文件
-                        if os.path.exists(temp_m4a_path):
-                            os.unlink(temp_m4a_path)
-                        if os.path.exists(temp_mp3_path):
-                            os.unlink(temp_mp3_path)
+                        remove_temp_files()
+                
+                def remove_temp_files():
+                    """清理临时文件"""
+                    for path in (temp_m4a_path, temp_mp3_path):
+                        if os.path.exists(path):
+                            os.unlink(path)
+                close_callbacks.append(remove_temp_files)
                 
                 ext = 'mp3'
                 content_type = 'audio/mpeg'
@@ -317,39 +660,19 @@ def download_episode_file():
                         os.unlink(server_file_path)
                 return jsonify({'error': f'转换过程出错: {str(e)}'}), 500
         else:
-            # 直接流式传输（同时保存到服务器）
+            # 直接流式传输（需要保存时由共享下载在结束后保存到服务器）
             logger.info(f"开始流式传输文件（格式: {ext.upper()}）...")
+            chunks = upstream.iter_chunks(chunk_size=65536)
             def generate():
                 try:
                     streamed_size = 0
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            # 如果需要保存到服务器
-                            if server_file_handle:
-                                server_file_handle.write(chunk)
-                            streamed_size += len(chunk)
-                            yield chunk
+                    for chunk in chunks:
+                        streamed_size += len(chunk)
+                        yield chunk
                     logger.info(f"流式传输完成，总大小: {streamed_size / 1024 / 1024:.2f} MB")
                 finally:
-                    # 关闭服务器文件
-                    if server_file_handle:
-                        server_file_handle.close()
-                        # 保存元数据
-                        if save_to_server and os.path.exists(server_file_path):
-                            download_manager.metadata[file_id] = {
-                                'file_id': file_id,
-                                'filename': os.path.basename(server_file_path),
-                                'file_path': server_file_path,
-                                'size': os.path.getsize(server_file_path),
-                                'downloaded_at': datetime.now().isoformat(),
-                                'username': username,
-                                'episode_info': {
-                                    'title': filename,
-                                    'audio_url': audio_url
-                                }
-                            }
-                            download_manager._save_metadata()
-                            logger.info(f"文件已保存到服务器: {server_file_path}, 文件ID: {file_id}")
+                    chunks.close()
+                    upstream.close()
         
         # 使用RFC 5987格式支持中文文件名
         # HTTP头必须使用latin-1编码，所以filename部分只使用ASCII字符
@@ -375,13 +698,20 @@ def download_episode_file():
         logger.info(f"准备返回响应 - 文件名: {full_filename}, Content-Type: {content_type or 'audio/mpeg'}")
         logger.info(f"=== 下载请求处理完成，开始流式传输 ===")
         
-        return Response(
+        response = Response(
             generate(),
             mimetype=content_type or 'audio/mpeg',
             headers=response_headers
         )
+        # 客户端在第一个数据块之前断开或HEAD请求时，服务器不会迭代响应体，generate()中的finally不会执行；
+        # 响应关闭时再释放一次共享下载（重复关闭没有影响），否则暂存文件不会被删除，该下载也会一直可以加入
+        for callback in close_callbacks:
+            response.call_on_close(callback)
+        return response
     except Exception as e:
         logger.exception(f"下载处理异常: {str(e)}")
+        for callback in close_callbacks:
+            callback()
         return jsonify({'error': f'下载失败: {str(e)}'}), 500
 
 @app.route('/api/user/create', methods=['POST'])
@@ -393,49 +723,24 @@ def create_user():
     if not username:
         return jsonify({'error': '请提供用户名'}), 400
     
-    user_file = os.path.join(app.config['USERS_FOLDER'], f'{username}.json')
-    if os.path.exists(user_file):
+    try:
+        created, user_data = user_store.create(username)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not created:
         # 如果用户已存在，返回用户信息
-        with open(user_file, 'r', encoding='utf-8') as f:
-            user_data = json.load(f)
         return jsonify({
             'message': '用户已存在，已加载',
             'username': username,
             'subscriptions': user_data.get('subscriptions', [])
         })
     
-    user_data = {
-        'username': username,
-        'created_at': datetime.now().isoformat(),
-        'subscriptions': [],
-        'tasks': []
-    }
-    
-    with open(user_file, 'w', encoding='utf-8') as f:
-        json.dump(user_data, f, ensure_ascii=False, indent=2)
-    
     return jsonify({'message': '用户创建成功', 'username': username})
 
 @app.route('/api/users', methods=['GET'])
 def list_users():
     """列出所有用户"""
-    users = []
-    if os.path.exists(app.config['USERS_FOLDER']):
-        for filename in os.listdir(app.config['USERS_FOLDER']):
-            if filename.endswith('.json'):
-                username = filename[:-5]  # 移除.json后缀
-                user_file = os.path.join(app.config['USERS_FOLDER'], filename)
-                try:
-                    with open(user_file, 'r', encoding='utf-8') as f:
-                        user_data = json.load(f)
-                    users.append({
-                        'username': username,
-                        'created_at': user_data.get('created_at', ''),
-                        'subscriptions_count': len(user_data.get('subscriptions', []))
-                    })
-                except:
-                    pass
-    return jsonify({'users': users})
+    return jsonify({'users': user_store.list_users()})
 
 @app.route('/api/user/<username>/opml', methods=['POST'])
 def upload_opml(username):
@@ -452,19 +757,9 @@ def upload_opml(username):
         subscriptions = parse_opml(opml_content)
         
         # 保存订阅信息到用户文件
-        user_file = os.path.join(app.config['USERS_FOLDER'], f'{username}.json')
-        if not os.path.exists(user_file):
+        if user_store.update(username, subscriptions=subscriptions) is None:
             return jsonify({'error': '用户不存在'}), 404
         
-        with open(user_file, 'r', encoding='utf-8') as f:
-            user_data = json.load(f)
-        
-        user_data['subscriptions'] = subscriptions
-        user_data['updated_at'] = datetime.now().isoformat()
-        
-        with open(user_file, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
-        
         return jsonify({
             'message': 'OPML文件解析成功',
             'subscriptions': subscriptions
@@ -475,28 +770,21 @@ def upload_opml(username):
 @app.route('/api/user/<username>/subscriptions', methods=['GET'])
 def get_subscriptions(username):
     """获取用户的订阅列表"""
-    user_file = os.path.join(app.config['USERS_FOLDER'], f'{username}.json')
-    if not os.path.exists(user_file):
+    subscriptions = user_store.get_subscriptions(username)
+    if subscriptions is None:
         return jsonify({'error': '用户不存在'}), 404
     
-    with open(user_file, 'r', encoding='utf-8') as f:
-        user_data = json.load(f)
-    
     return jsonify({
-        'subscriptions': user_data.get('subscriptions', [])
+        'subscriptions': subscriptions
     })
 
 @app.route('/api/user/<username>/subscriptions/<int:sub_id>/episodes', methods=['GET'])
 def get_subscription_episodes(username, sub_id):
     """获取订阅的节目列表"""
-    user_file = os.path.join(app.config['USERS_FOLDER'], f'{username}.json')
-    if not os.path.exists(user_file):
+    subscriptions = user_store.get_subscriptions(username)
+    if subscriptions is None:
         return jsonify({'error': '用户不存在'}), 404
     
-    with open(user_file, 'r', encoding='utf-8') as f:
-        user_data = json.load(f)
-    
-    subscriptions = user_data.get('subscriptions', [])
     if sub_id >= len(subscriptions):
         return jsonify({'error': '订阅不存在'}), 404
     
@@ -518,17 +806,16 @@ def download_latest(username):
     data = request.json or {}
     count = int(data.get('count', 5))
     convert_to_mp3 = data.get('convert_to_mp3', False)
+    # backfill: 批量补录，优先级低于交互下载和监听任务
+    priority = data.get('priority', PRIORITY_INTERACTIVE)
+    if priority not in (PRIORITY_INTERACTIVE, PRIORITY_BACKFILL):
+        return jsonify({'error': f'无效的优先级: {priority}'}), 400
     
-    user_file = os.path.join(app.config['USERS_FOLDER'], f'{username}.json')
-    if not os.path.exists(user_file):
+    subscriptions = user_store.get_subscriptions(username)
+    if subscriptions is None:
         return jsonify({'error': '用户不存在'}), 404
     
-    with open(user_file, 'r', encoding='utf-8') as f:
-        user_data = json.load(f)
-    
-    subscriptions = user_data.get('subscriptions', [])
-    
-    task_id = task_manager.create_download_latest_task(username, subscriptions, count, convert_to_mp3)
+    task_id = task_manager.create_download_latest_task(username, subscriptions, count, convert_to_mp3, priority=priority)
     
     return jsonify({
         'message': '下载任务已创建',
@@ -541,15 +828,10 @@ def start_monitor(username):
     data = request.json or {}
     convert_to_mp3 = data.get('convert_to_mp3', False)
     
-    user_file = os.path.join(app.config['USERS_FOLDER'], f'{username}.json')
-    if not os.path.exists(user_file):
+    subscriptions = user_store.get_subscriptions(username)
+    if subscriptions is None:
         return jsonify({'error': '用户不存在'}), 404
     
-    with open(user_file, 'r', encoding='utf-8') as f:
-        user_data = json.load(f)
-    
-    subscriptions = user_data.get('subscriptions', [])
-    
     task_id = task_manager.create_monitor_task(username, subscriptions, convert_to_mp3)
     
     return jsonify({
@@ -559,9 +841,95 @@ def start_monitor(username):
 
 @app.route('/api/tasks', methods=['GET'])
 def get_tasks():
-    """获取所有任务"""
-    tasks = task_manager.get_all_tasks()
-    return jsonify({'tasks': tasks})
+    """获取所有任务，summary=1时只返回任务摘要（不含完整结果列表）"""
+    if request.args.get('summary') in ('1', 'true'):
+        tasks = task_manager.get_all_task_summaries()
+    else:
+        tasks = task_manager.get_all_tasks()
+    return jsonify({
+        'tasks': tasks,
+        'scheduler': task_manager.get_scheduler_stats(),
+        'version': task_manager.change_version
+    })
+
+@app.route('/api/tasks/stream', methods=['GET'])
+def stream_tasks():
+    """
+    通过Server-Sent Events推送任务变化
+    连接时先发送snapshot事件（全部任务摘要），之后有变化时发送delta事件（变化的任务摘要和已移除的任务ID）；
+    事件id为变更版本号，断线重连时浏览器通过Last-Event-ID继续，无法增量时重新发送snapshot
+    """
+    from flask import Response, stream_with_context
+    
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        since = None
+    
+    def event(name, version, payload):
+        return f"event: {name}\nid: {version}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    
+    def generate():
+        version = since
+        # 告诉浏览器断线后3秒重连
+        yield 'retry: 3000\n\n'
+        if version is None:
+            version = task_manager.change_version
+            yield event('snapshot', version, {
+                'tasks': task_manager.get_all_task_summaries(),
+                'scheduler': task_manager.get_scheduler_stats()
+            })
+        deadline = time.time() + app.config['TASK_STREAM_MAX_SECONDS']
+        # 服务停止时结束连接，浏览器会重连到其他实例
+        while time.time() < deadline and not request_tracker.draining:
+            new_version, changed_ids, removed_ids, reset = task_manager.wait_for_changes(version, timeout=15)
+            if reset:
+                version = task_manager.change_version
+                yield event('snapshot', version, {
+                    'tasks': task_manager.get_all_task_summaries(),
+                    'scheduler': task_manager.get_scheduler_stats()
+                })
+            elif new_version != version:
+                version = new_version
+                tasks = []
+                for task_id in changed_ids:
+                    summary = task_manager.get_task_summary(task_id)
+                    if summary:
+                        tasks.append(summary)
+                    else:
+                        removed_ids.append(task_id)
+                yield event('delta', version, {
+                    'tasks': tasks,
+                    'removed': removed_ids,
+                    'scheduler': task_manager.get_scheduler_stats()
+                })
+                # 合并短时间内的多次变化，限制推送频率
+                time.sleep(app.config['TASK_STREAM_MIN_INTERVAL'])
+            else:
+                # 心跳，防止代理因空闲断开连接
+                yield ': keepalive\n\n'
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # 禁止nginx缓冲事件流
+        }
+    )
+
+@app.route('/api/tasks/history', methods=['GET'])
+def get_task_history():
+    """获取已归档的历史任务，支持按用户过滤和分页"""
+    username = request.args.get('username')
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    offset = request.args.get('offset', 0, type=int)
+    return jsonify({
+        'tasks': task_manager.get_task_history(username=username, limit=limit, offset=offset),
+        'limit': limit,
+        'offset': offset
+    })
 
 @app.route('/api/tasks/<task_id>', methods=['GET'])
 def get_task(task_id):
@@ -583,59 +951,179 @@ def cancel_task(task_id):
 
 @app.route('/api/downloads', methods=['GET'])
 def get_downloads():
-    """获取已下载的文件，支持按用户过滤"""
-    username = request.args.get('username')  # 可选的用户名过滤参数
-    downloads = download_manager.list_downloads(username=username)
+    """
+    获取已下载的文件，支持按用户过滤（按下载时间倒序）
+    可选参数:
+        offset/limit: 分页，返回total为总数
+        since: 上次响应中的version，只返回之后新增或修改的条目（upserted）和删除的file_id（deleted）；
+               reset为True时需要重新加载完整列表
+    响应中的version用于下一次增量请求
+    """
+    username = request.args.get('username') or None  # 可选的用户名过滤参数
+    since = request.args.get('since', type=int)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', type=int)
     users = download_manager.get_users()  # 获取所有用户列表
+    
+    if since is not None:
+        return jsonify({**download_manager.get_changes(since, username=username), 'users': users})
+    
+    if limit is not None:
+        limit = min(max(1, limit), 500)
+        return jsonify({**download_manager.list_downloads_page(offset, limit, username=username), 'users': users})
+    
+    # 先取版本再取列表，期间的变化会在下一次增量请求中重复返回，不会遗漏
+    version = download_manager.get_version()
+    downloads = download_manager.list_downloads(username=username)
     return jsonify({
         'downloads': downloads,
-        'users': users
+        'users': users,
+        'version': version
     })
 
 @app.route('/api/downloads/<file_id>', methods=['DELETE'])
 def delete_download(file_id):
-    """删除已下载的文件"""
-    success = download_manager.delete_file(file_id)
+    """
+    删除已下载的文件
+    可选参数 username：只移除该用户的引用，其他用户也下载过的文件保留
+    """
+    username = request.args.get('username') or None
+    success = download_manager.delete_file(file_id, username)
     if success:
+        if download_manager.get_file_info(file_id) is None:
+            derivative_cache.invalidate(file_id)
         return jsonify({'message': '文件已删除'})
     else:
         return jsonify({'error': '文件不存在'}), 404
 
+@app.route('/api/downloads/<file_id>/pin', methods=['POST'])
+def pin_download(file_id):
+    """固定或取消固定文件（pinned，默认true），固定的文件不会因存储配额被淘汰"""
+    data = request.json or {}
+    pinned = bool(data.get('pinned', True))
+    if download_manager.set_pinned(file_id, pinned):
+        return jsonify({'message': '已固定' if pinned else '已取消固定', 'pinned': pinned})
+    else:
+        return jsonify({'error': '文件不存在'}), 404
+
+def get_download_filename(file_info, serve_path):
+    """下载时使用的文件名：优先使用节目标题，扩展名与实际发送的文件一致"""
+    episode_info = file_info.get('episode_info', {})
+    if episode_info and episode_info.get('title'):
+        # 从标题生成安全的文件名
+        safe_title = re.sub(r'[<>:"/\\|?*]', '_', episode_info['title'])
+        safe_title = safe_title.strip()[:100]  # 限制长度
+        # 保持实际发送文件的扩展名
+        ext = os.path.splitext(serve_path)[1]
+        return f"{safe_title}{ext}"
+    filename = file_info['filename']
+    if serve_path != file_info['file_path']:
+        filename = os.path.splitext(filename)[0] + os.path.splitext(serve_path)[1]
+    return filename
+
+def download_content_disposition(filename):
+    """下载文件的Content-Disposition：使用RFC 5987格式支持中文文件名，filename部分只使用ASCII字符"""
+    from urllib.parse import quote
+    
+    encoded_filename = quote(filename.encode('utf-8'))
+    stem, ext = os.path.splitext(filename)
+    ascii_filename = (stem.encode('ascii', 'ignore').decode('ascii').strip() or 'download') + ext
+    return f'attachment; filename="{ascii_filename}"; filename*=UTF-8\'\'{encoded_filename}'
+
+def redirect_to_storage(file_info, filename):
+    """保存在对象存储中的文件：重定向到预签名URL，由对象存储直接发送文件（包括Range请求）"""
+    from flask import redirect
+    
+    url = download_manager.get_download_url(
+        file_info, download_content_disposition(filename), mimetypes.guess_type(filename)[0]
+    )
+    if not url:
+        return jsonify({'error': '文件所在的存储后端未配置'}), 404
+    response = redirect(url, code=302)
+    # 预签名URL会过期，不缓存重定向
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def send_download_file(serve_path, filename, mimetype, etag_key):
+    """
+    发送下载目录或派生缓存中的文件
+    支持Range（206）和条件请求（ETag/Last-Modified，304）；配置了FILE_OFFLOAD时由前端服务器发送文件
+    """
+    from flask import Response
+    
+    content_disposition = download_content_disposition(filename)
+    
+    if app.config['FILE_OFFLOAD'] == OFFLOAD_X_ACCEL:
+        accel_uri = accel_redirect_uri(serve_path, [
+            (app.config['DOWNLOAD_FOLDER'], f"{app.config['X_ACCEL_PREFIX']}/downloads"),
+            (app.config['DERIVATIVE_FOLDER'], f"{app.config['X_ACCEL_PREFIX']}/derivatives")
+        ])
+        if accel_uri:
+            # 由nginx直接发送文件（包括Range和条件请求），应用只返回内部跳转
+            response = Response(mimetype=mimetype or mimetypes.guess_type(serve_path)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = accel_uri
+            response.headers['Content-Disposition'] = content_disposition
+            return response
+        logger.warning(f"文件不在X-Accel映射的目录中，由应用发送: {serve_path}")
+    
+    # ETag与文件标识和内容绑定（派生格式各自独立），Range/If-Range/If-None-Match由send_file处理；
+    # USE_X_SENDFILE开启时只返回X-Sendfile头，由前端服务器发送文件
+    # 相对路径按工作目录解析（send_file会把相对路径当作相对于应用目录）
+    response = send_file(
+        os.path.abspath(serve_path),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=filename,
+        conditional=True,
+        etag=file_etag(serve_path, etag_key)
+    )
+    
+    # 添加正确的Content-Disposition头支持中文
+    response.headers['Content-Disposition'] = content_disposition
+    
+    return response
+
 @app.route('/downloads/<file_id>', methods=['GET'])
 def download_file(file_id):
-    """下载文件"""
-    from flask import Response
-    from urllib.parse import quote
+    """
+    下载文件
+    可选参数 format（mp3/m4a/aac/opus）和 bitrate（如128k）：返回派生格式，首次请求时生成并缓存，
+    编码兼容时只换封装不重新编码
+    支持Range（206）和条件请求（ETag/Last-Modified，304），播放器拖动进度时只传输需要的部分
+    保存在对象存储中的文件重定向（302）到预签名URL
+    """
+    target_format = request.args.get('format', '').strip().lower() or None
+    bitrate = request.args.get('bitrate', '').strip().lower() or None
+    if target_format and target_format not in AUDIO_FORMATS:
+        return jsonify({'error': f'不支持的格式: {target_format}'}), 400
+    if bitrate and not re.fullmatch(r'\d{1,3}k', bitrate):
+        return jsonify({'error': f'无效的比特率: {bitrate}'}), 400
+    if bitrate and not target_format:
+        return jsonify({'error': '指定比特率时必须同时指定格式'}), 400
     
-    file_info = download_manager.metadata.get(file_id)
+    file_info = download_manager.get_file_info(file_id)
+    if file_info and not download_manager.is_local(file_info):
+        # 对象存储中的文件没有派生缓存，只能按原格式下载
+        if bitrate or (target_format and not file_info['file_path'].lower().endswith(f'.{target_format}')):
+            return jsonify({'error': '对象存储中的文件不支持格式转换'}), 400
+        download_manager.touch(file_id)
+        return redirect_to_storage(file_info, get_download_filename(file_info, file_info['file_path']))
     if file_info and os.path.exists(file_info['file_path']):
-        # 优先使用节目标题作为文件名
-        episode_info = file_info.get('episode_info', {})
-        if episode_info and episode_info.get('title'):
-            # 从标题生成安全的文件名
-            import re
-            safe_title = re.sub(r'[<>:"/\\|?*]', '_', episode_info['title'])
-            safe_title = safe_title.strip()[:100]  # 限制长度
-            # 保持原文件扩展名
-            ext = os.path.splitext(file_info['filename'])[1]
-            filename = f"{safe_title}{ext}"
-        else:
-            filename = file_info['filename']
-        
-        # 使用RFC 5987格式支持中文文件名
-        encoded_filename = quote(filename.encode('utf-8'))
-        ascii_filename = filename.encode('ascii', 'ignore').decode('ascii') or 'download'
-        
-        response = send_file(
-            file_info['file_path'],
-            as_attachment=True,
-            download_name=filename
-        )
-        
-        # 添加正确的Content-Disposition头支持中文
-        response.headers['Content-Disposition'] = f'attachment; filename="{ascii_filename}"; filename*=UTF-8\'\'{encoded_filename}'
+        serve_path = file_info['file_path']
+        mimetype = None
+        if needs_derivative(serve_path, target_format, bitrate):
+            if not check_ffmpeg():
+                return jsonify({'error': 'ffmpeg未安装，无法转换格式'}), 400
+            success, serve_path, error = derivative_cache.get(file_id, file_info['file_path'], target_format, bitrate)
+            if not success:
+                logger.error(f"生成派生文件失败 - 文件ID: {file_id}, 格式: {target_format}, 错误: {error}")
+                return jsonify({'error': f'转换失败: {error}'}), 500
+            mimetype = AUDIO_FORMATS[target_format]['mimetype']
         
-        return response
+        # 记录播放时间，配额淘汰时优先保留最近播放的文件
+        download_manager.touch(file_id)
+        filename = get_download_filename(file_info, serve_path)
+        return send_download_file(serve_path, filename, mimetype, f"{file_id}:{target_format or ''}:{bitrate or ''}")
     else:
         return jsonify({'error': '文件不存在'}), 404
 
@@ -648,9 +1136,14 @@ def convert_audio():
     if not file_id:
         return jsonify({'error': '请提供文件ID'}), 400
     
-    file_info = download_manager.metadata.get(file_id)
+    file_info = download_manager.get_file_info(file_id)
+    if file_info and not download_manager.is_local(file_info):
+        return jsonify({'error': '对象存储中的文件不支持格式转换'}), 400
     if not file_info or not os.path.exists(file_info['file_path']):
         return jsonify({'error': '文件不存在'}), 404
+    # 多个用户共享的文件不替换（其他用户下载的是原格式）
+    if len(entry_owners(file_info)) > 1:
+        return jsonify({'error': f'文件由多个用户共享，不转换；需要mp3时请通过 /downloads/{file_id}?format=mp3 获取'}), 409
     
     file_path = file_info['file_path']
     audio_format = get_audio_format(file_path)
@@ -670,21 +1163,11 @@ def convert_audio():
     success, converted_path, error = convert_m4a_to_mp3(file_path, output_path)
     
     if success:
-        # 删除原始文件
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"已删除原始文件: {file_path}")
-        except Exception as e:
-            logger.warning(f"删除原始文件失败: {file_path}, 错误: {str(e)}")
-        
-        # 更新元数据（保持原file_id，替换文件信息）
+        # 更新元数据（保持原file_id，替换文件信息）后再删除原始文件
+        if not download_manager.replace_converted_file(file_id, file_path, converted_path):
+            logger.warning(f"文件已被共享、删除或替换，放弃转换结果 - 文件ID: {file_id}")
+            return jsonify({'error': '文件已被共享、删除或替换，放弃转换结果'}), 409
         new_filename = os.path.basename(converted_path)
-        download_manager.metadata[file_id]['filename'] = new_filename
-        download_manager.metadata[file_id]['file_path'] = converted_path
-        download_manager.metadata[file_id]['size'] = os.path.getsize(converted_path)
-        download_manager.metadata[file_id]['downloaded_at'] = datetime.now().isoformat()
-        download_manager._save_metadata()
         
         logger.info(f"音频转换成功并替换原文件 - 文件ID: {file_id}, 输出文件: {converted_path}")
         return jsonify({
@@ -710,7 +1193,11 @@ def batch_delete_downloads():
         if not file_ids:
             return jsonify({'error': '请提供要删除的文件ID列表'}), 400
         
-        success_count, failed_ids = download_manager.delete_files_batch(file_ids)
+        # 提供username时只移除该用户的引用
+        success_count, failed_ids = download_manager.delete_files_batch(file_ids, data.get('username') or None)
+        for file_id in file_ids:
+            if file_id not in failed_ids and download_manager.get_file_info(file_id) is None:
+                derivative_cache.invalidate(file_id)
         
         return jsonify({
             'message': f'成功删除{success_count}个文件',
@@ -722,6 +1209,49 @@ def batch_delete_downloads():
         logger.error(f"批量删除文件失败: {str(e)}")
         return jsonify({'error': f'批量删除失败: {str(e)}'}), 500
 
+@app.route('/api/downloads/batch/archive', methods=['POST'])
+def batch_download_archive():
+    """
+    批量下载：把选中的文件打包为ZIP流式返回（存储模式，不重新压缩）
+    参数 file_ids 可以是JSON数组，也可以是表单字段（页面通过表单提交，浏览器直接保存而不是缓存在内存中）
+    """
+    from flask import Response, stream_with_context
+    from urllib.parse import quote
+    
+    if request.is_json:
+        file_ids = (request.json or {}).get('file_ids', [])
+    else:
+        file_ids = request.form.getlist('file_ids')
+    if not file_ids:
+        return jsonify({'error': '请提供要下载的文件ID列表'}), 400
+    
+    entries = []
+    used_names = set()
+    for file_id in file_ids:
+        file_info = download_manager.get_file_info(file_id)
+        if file_info and not download_manager.is_local(file_info):
+            logger.warning(f"批量下载 - 对象存储中的文件不支持打包: {file_id}")
+            continue
+        if not file_info or not os.path.exists(file_info['file_path']):
+            logger.warning(f"批量下载 - 文件不存在: {file_id}")
+            continue
+        filename = get_download_filename(file_info, file_info['file_path'])
+        entries.append((unique_arcname(filename, used_names), file_info['file_path']))
+    if not entries:
+        return jsonify({'error': '文件不存在'}), 404
+    
+    archive_name = f"podcasts-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    logger.info(f"批量下载 - 打包{len(entries)}个文件: {archive_name}")
+    return Response(
+        stream_with_context(stream_zip(entries)),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f"attachment; filename=\"{archive_name}\"; filename*=UTF-8''{quote(archive_name)}",
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @app.route('/api/audio/batch/convert', methods=['POST'])
 def batch_convert_audio():
     """批量转换音频格式（m4a转mp3）"""
@@ -743,7 +1273,14 @@ def batch_convert_audio():
         
         for file_id in file_ids:
             try:
-                file_info = download_manager.metadata.get(file_id)
+                file_info = download_manager.get_file_info(file_id)
+                if file_info and not download_manager.is_local(file_info):
+                    results.append({
+                        'file_id': file_id,
+                        'success': False,
+                        'error': '对象存储中的文件不支持格式转换'
+                    })
+                    continue
                 if not file_info or not os.path.exists(file_info['file_path']):
                     results.append({
                         'file_id': file_id,
@@ -776,6 +1313,15 @@ def batch_convert_audio():
                     })
                     continue
                 
+                # 多个用户共享的文件不替换（其他用户下载的是原格式）
+                if len(entry_owners(file_info)) > 1:
+                    results.append({
+                        'file_id': file_id,
+                        'success': False,
+                        'error': f'文件由多个用户共享，不转换；需要mp3时请通过 /downloads/{file_id}?format=mp3 获取'
+                    })
+                    continue
+                
                 # 生成输出路径
                 base_name = os.path.splitext(file_path)[0]
                 output_path = f"{base_name}.mp3"
@@ -784,34 +1330,30 @@ def batch_convert_audio():
                 logger.info(f"批量转换 - 文件ID: {file_id}, 输入: {file_path}, 输出: {output_path}")
                 success, converted_path, error = convert_m4a_to_mp3(file_path, output_path)
                 
-                if success:
-                    # 删除原始文件
-                    try:
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"批量转换 - 已删除原始文件: {file_path}")
-                    except Exception as e:
-                        logger.warning(f"批量转换 - 删除原始文件失败: {file_path}, 错误: {str(e)}")
-                    
-                    # 更新元数据（保持原file_id，替换文件信息）
-                    new_filename = os.path.basename(converted_path)
-                    download_manager.metadata[file_id]['filename'] = new_filename
-                    download_manager.metadata[file_id]['file_path'] = converted_path
-                    download_manager.metadata[file_id]['size'] = os.path.getsize(converted_path)
-                    download_manager.metadata[file_id]['downloaded_at'] = datetime.now().isoformat()
-                    download_manager._save_metadata()
-                    success_count += 1
+                if not success:
                     results.append({
                         'file_id': file_id,
-                        'success': True,
-                        'filename': new_filename
+                        'success': False,
+                        'error': error
                     })
-                else:
+                    continue
+                
+                # 更新元数据（保持原file_id，替换文件信息）后再删除原始文件
+                if not download_manager.replace_converted_file(file_id, file_path, converted_path):
+                    logger.warning(f"批量转换 - 文件已被共享、删除或替换，放弃转换结果 - 文件ID: {file_id}")
                     results.append({
                         'file_id': file_id,
                         'success': False,
-                        'error': error
+                        'error': '文件已被共享、删除或替换，放弃转换结果'
                     })
+                    continue
+                new_filename = os.path.basename(converted_path)
+                success_count += 1
+                results.append({
+                    'file_id': file_id,
+                    'success': True,
+                    'filename': new_filename
+                })
             except Exception as e:
                 logger.error(f"批量转换单个文件时出错 - 文件ID: {file_id}, 错误: {str(e)}")
                 results.append({
@@ -830,6 +1372,59 @@ def batch_convert_audio():
         logger.error(f"批量转换音频失败: {str(e)}")
         return jsonify({'error': f'批量转换失败: {str(e)}'}), 500
 
+@app.route('/api/derivatives/stats', methods=['GET'])
+def get_derivative_stats():
+    """获取派生文件缓存统计"""
+    return jsonify(derivative_cache.get_stats())
+
+@app.route('/api/proxy/stats', methods=['GET'])
+def get_proxy_stats():
+    """获取代理下载统计：下载库命中次数、上游请求次数、合并的请求次数和命中率"""
+    return jsonify(proxy_downloader.get_stats())
+
+@app.route('/api/storage/tiering', methods=['GET'])
+def get_tiering_status():
+    """获取存储分层状态和最近一次的报告（包含节省的字节数）"""
+    return jsonify(storage_tiering.get_status())
+
+@app.route('/api/storage/tiering/run', methods=['POST'])
+def run_tiering():
+    """立即在后台执行一轮存储分层，可通过 max_age_days 覆盖默认的天数阈值"""
+    data = request.json or {}
+    max_age_days = data.get('max_age_days')
+    if max_age_days is not None:
+        try:
+            max_age_days = int(max_age_days)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'max_age_days必须是整数'}), 400
+    if storage_tiering.running:
+        return jsonify({'error': '分层任务正在运行'}), 409
+    
+    thread = threading.Thread(target=storage_tiering.run_once, args=(max_age_days,), daemon=True)
+    thread.start()
+    return jsonify({'message': '分层任务已启动'})
+
+@app.route('/api/storage/reconcile', methods=['GET'])
+def get_reconcile_status():
+    """获取一致性检查状态和最近一次的报告（包括耗时）"""
+    return jsonify(reconciler.get_status())
+
+@app.route('/api/storage/reconcile/run', methods=['POST'])
+def run_reconcile():
+    """立即在后台执行一轮一致性检查，dry_run为true时只报告不修改"""
+    data = request.json or {}
+    if reconciler.running:
+        return jsonify({'error': '一致性检查正在运行'}), 409
+    
+    thread = threading.Thread(target=reconciler.run_once, args=(bool(data.get('dry_run')),), daemon=True)
+    thread.start()
+    return jsonify({'message': '一致性检查已启动'})
+
+@app.route('/api/storage/quota', methods=['GET'])
+def get_quota_status():
+    """获取存储配额、全局和各用户的占用情况以及淘汰统计"""
+    return jsonify(download_manager.get_quota_status())
+
 @app.route('/api/ffmpeg/check', methods=['GET'])
 def check_ffmpeg_api():
     """检查ffmpeg是否可用"""
@@ -840,7 +1435,14 @@ def check_ffmpeg_api():
     })
 
 if __name__ == '__main__':
-    # 启动后台任务处理线程
-    task_manager.start_background_thread()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # 调试模式的自动重载会在父进程和子进程中各执行一次这里，后台线程只在实际处理请求的子进程中启动，
+    # 否则已保存的任务会被恢复两次，监听、分层和一致性检查线程也会重复运行
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # 启动后台任务处理线程
+        task_manager.start_background_thread()
+        if app.config['TIERING_ENABLED'] and task_manager.role != ROLE_API:
+            storage_tiering.start_background_thread(app.config['TIERING_INTERVAL_HOURS'], should_run=task_manager.is_maintenance_leader)
+        if app.config['RECONCILE_ENABLED'] and task_manager.role != ROLE_API:
+            reconciler.start_background_thread(app.config['RECONCILE_INTERVAL_HOURS'], should_run=task_manager.is_maintenance_leader)
+    app.run(debug=True, use_reloader=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,32 @@
+"""
+下载库目录布局迁移工具
+修改 LIBRARY_LAYOUT 后，把已有文件移动到新布局下的目录，服务运行期间可以执行（元数据通过文件锁与服务进程同步）
+用法:
+    LIBRARY_LAYOUT=user/shard python migrate_library.py --dry-run
+    LIBRARY_LAYOUT=user/shard python migrate_library.py --pause 0.05
+"""
+import os
+import json
+import argparse
+import logging
+
+from utils.download_manager import DownloadManager
+from utils.library_migration import migrate_library
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+def main():
+    parser = argparse.ArgumentParser(description='把下载库迁移到 LIBRARY_LAYOUT 指定的目录布局')
+    parser.add_argument('--folder', default='downloads', help='下载目录（默认 downloads）')
+    parser.add_argument('--layout', default=os.getenv('LIBRARY_LAYOUT', ''), help='目标布局，默认读取环境变量 LIBRARY_LAYOUT')
+    parser.add_argument('--dry-run', action='store_true', help='只统计需要移动的文件')
+    parser.add_argument('--pause', type=float, default=0.0, help='每移动一个文件后休眠的秒数')
+    parser.add_argument('--limit', type=int, default=None, help='最多移动的文件数')
+    args = parser.parse_args()
+
+    download_manager = DownloadManager(args.folder, layout=args.layout)
+    report = migrate_library(download_manager, dry_run=args.dry_run, pause=args.pause, limit=args.limit)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+生产环境入口
+使用waitress（多线程WSGI服务器）提供服务，收到SIGTERM/SIGINT时优雅停止：
+    1. 进入排空状态，/readyz返回503，新请求返回503
+    2. 等待进行中的请求、流式下载和转换完成，同时后台任务不再开始新的下载
+    3. 超过SHUTDOWN_TIMEOUT仍未完成的后台任务被中断并保存进度，重启后继续
+用法: python serve.py
+"""
+import os
+import signal
+import threading
+import time
+import logging
+
+from waitress import create_server
+
+from app import app, task_manager, task_store, storage_tiering, reconciler, request_tracker
+from utils.coordination import ROLE_API
+
+logger = logging.getLogger(__name__)
+
+# HOST/PORT: 监听地址和端口
+# SERVE_THREADS: 处理请求的线程数，每个进行中的流式下载占用一个线程
+# SERVE_CONNECTION_LIMIT: 同时打开的连接数上限
+# SHUTDOWN_TIMEOUT: 停止时等待进行中的请求和后台任务的最长秒数（Docker的stop_grace_period应大于该值）
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '5000'))
+SERVE_THREADS = int(os.getenv('SERVE_THREADS', '16'))
+SERVE_CONNECTION_LIMIT = int(os.getenv('SERVE_CONNECTION_LIMIT', '200'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '60'))
+
+def drain(server, timeout):
+    """排空请求和后台任务后关闭服务器"""
+    deadline = time.time() + timeout
+    request_tracker.start_draining()
+    # 让SSE连接尽快结束
+    task_manager.wake_subscribers()
+
+    # 请求和后台任务同时排空
+    tasks_thread = threading.Thread(target=task_manager.shutdown, args=(timeout,), name='task-shutdown')
+    tasks_thread.start()
+
+    if request_tracker.wait_idle(timeout):
+        logger.info("进行中的请求已全部结束")
+    else:
+        logger.warning(f"等待请求结束超时，仍有 {request_tracker.get_status()['in_flight']} 个请求未结束")
+    tasks_thread.join(max(0.0, deadline - time.time()) + 15)
+
+    server.close()
+    task_store.close()
+
+def main():
+    server = create_server(
+        app,
+        host=HOST,
+        port=PORT,
+        threads=SERVE_THREADS,
+        connection_limit=SERVE_CONNECTION_LIMIT
+    )
+
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"收到信号 {signal.Signals(signum).name}，开始停止服务")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    task_manager.start_background_thread()
+    if app.config['TIERING_ENABLED'] and task_manager.role != ROLE_API:
+        storage_tiering.start_background_thread(app.config['TIERING_INTERVAL_HOURS'], should_run=task_manager.is_maintenance_leader)
+    if app.config['RECONCILE_ENABLED'] and task_manager.role != ROLE_API:
+        reconciler.start_background_thread(app.config['RECONCILE_INTERVAL_HOURS'], should_run=task_manager.is_maintenance_leader)
+
+    server_thread = threading.Thread(target=server.run, name='waitress', daemon=True)
+    server_thread.start()
+    logger.info(f"服务已启动 - 地址: http://{HOST}:{PORT}, 线程数: {SERVE_THREADS}, 角色: {task_manager.role}")
+
+    # 带超时等待，保证主线程能及时处理信号
+    while not stop_event.wait(1):
+        pass
+    drain(server, SHUTDOWN_TIMEOUT)
+    logger.info("服务已停止")
+
+if __name__ == '__main__':
+    main()
@@ -45,21 +45,82 @@ function initNavigation() {
     });
 }
 
-// 启动任务刷新定时器
-function startTaskRefreshTimer() {
-    setInterval(() => {
-        const tasksPage = document.getElementById('tasks-page');
-        if (tasksPage && tasksPage.classList.contains('active')) {
-            loadTasks();
+// 任务列表状态：task_id -> 任务摘要
+let taskState = new Map();
+let taskScheduler = null;
+let taskEventSource = null;
+let taskPollTimer = null;
+let taskStreamFailed = false; // SSE不可用时改用轮询
+
+// 开始接收任务更新：优先使用SSE推送，不支持或连接失败时每5秒轮询
+function startTaskUpdates() {
+    stopTaskUpdates();
+    if (window.EventSource && !taskStreamFailed) {
+        openTaskStream();
+    } else {
+        taskPollTimer = setInterval(loadTasks, 5000);
+    }
+}
+
+// 停止接收任务更新（离开任务页时调用）
+function stopTaskUpdates() {
+    if (taskEventSource) {
+        taskEventSource.close();
+        taskEventSource = null;
+    }
+    if (taskPollTimer) {
+        clearInterval(taskPollTimer);
+        taskPollTimer = null;
+    }
+}
+
+function openTaskStream() {
+    let receivedAny = false;
+    let errorCount = 0;
+    const source = new EventSource(apiUrl('/api/tasks/stream'));
+    taskEventSource = source;
+    
+    // 全量快照：连接建立或服务器无法提供增量时发送
+    source.addEventListener('snapshot', (e) => {
+        const data = JSON.parse(e.data);
+        receivedAny = true;
+        errorCount = 0;
+        taskState = new Map(data.tasks.map(task => [task.task_id, task]));
+        taskScheduler = data.scheduler;
+        renderTasks();
+    });
+    
+    // 增量：只包含变化的任务和已移除的任务ID
+    source.addEventListener('delta', (e) => {
+        const data = JSON.parse(e.data);
+        receivedAny = true;
+        errorCount = 0;
+        data.tasks.forEach(task => taskState.set(task.task_id, task));
+        data.removed.forEach(taskId => taskState.delete(taskId));
+        taskScheduler = data.scheduler;
+        renderTasks();
+    });
+    
+    source.onerror = () => {
+        errorCount++;
+        // 从未收到数据或连续失败时放弃SSE，改用轮询
+        if (source.readyState === EventSource.CLOSED || (!receivedAny && errorCount >= 3) || errorCount >= 10) {
+            console.warn('任务推送连接失败，改用轮询');
+            taskStreamFailed = true;
+            startTaskUpdates();
         }
-    }, 5000);
+    };
 }
 
 // 统一的初始化函数
 function initApp() {
     console.log('初始化应用，APPLICATION_ROOT:', APPLICATION_ROOT);
     initNavigation();
-    startTaskRefreshTimer();
+    const tasksPage = document.getElementById('tasks-page');
+    if (tasksPage && tasksPage.classList.contains('active')) {
+        loadTasks();
+        startTaskUpdates();
+    }
 }
 
 // 等待DOM加载完成后初始化
@@ -79,8 +140,12 @@ function switchPage(pageName) {
     // 加载对应页面的数据
     if (pageName === 'tasks') {
         loadTasks();
-    } else if (pageName === 'downloads') {
-        loadDownloads();
+        startTaskUpdates();
+    } else {
+        stopTaskUpdates();
+        if (pageName === 'downloads') {
+            loadDownloads();
+        }
     }
 }
 
@@ -426,6 +491,215 @@ async function uploadOPML() {
     }
 }
 
+// 虚拟列表：只渲染滚动容器可见区域附近的条目，DOM数量和渲染时间与列表长度无关
+// renderItem(item, index) 必须返回只有一个根元素的HTML；条目高度在渲染后测量并缓存
+// 提供loadPage(offset, limit)时按页加载条目，返回 {items, total}
+class VirtualList {
+    constructor(container, options) {
+        this.container = container;
+        this.renderItem = options.renderItem;
+        this.getKey = options.getKey || ((item, index) => index);
+        this.estimatedHeight = options.estimatedHeight || 100;
+        this.overscan = options.overscan || 5;
+        this.pageSize = options.pageSize || 100;
+        this.loadPage = options.loadPage || null;
+        this.emptyHtml = options.emptyHtml || '';
+        this.onTotal = options.onTotal || null;
+        this.items = [];
+        this.total = 0;
+        this.heights = new Map(); // 条目key -> 测量到的高度（含外边距）
+        this.loadedPages = new Set();
+        this.loadingPages = new Set();
+        this.generation = 0; // reload后丢弃之前发出的分页请求结果
+        this.range = null;
+        this.frame = null;
+        this.content = document.createElement('div');
+        this.container.innerHTML = '';
+        this.container.appendChild(this.content);
+        this.container.addEventListener('scroll', () => this.scheduleRender());
+        // 图片加载完成后条目高度可能变化（load事件不冒泡，在捕获阶段监听）
+        this.content.addEventListener('load', () => this.measure(), true);
+    }
+
+    scheduleRender() {
+        if (this.frame !== null) return;
+        this.frame = requestAnimationFrame(() => {
+            this.frame = null;
+            this.render();
+        });
+    }
+
+    // 一次性设置全部条目
+    setItems(items) {
+        this.items = items.slice();
+        this.total = items.length;
+        this.loadPage = null;
+        this.render(true);
+    }
+
+    // 设置从offset开始的一页条目（offset为pageSize的整数倍）
+    setPage(offset, items, total) {
+        this.setTotal(total);
+        items.forEach((item, i) => {
+            if (offset + i < this.total) {
+                this.items[offset + i] = item;
+            }
+        });
+        this.loadedPages.add(Math.floor(offset / this.pageSize));
+    }
+
+    setTotal(total) {
+        if (total === this.total) return;
+        this.total = total;
+        this.items.length = total;
+        if (this.onTotal) this.onTotal(total);
+    }
+
+    isLoaded(index) {
+        return !this.loadPage || this.loadedPages.has(Math.floor(index / this.pageSize));
+    }
+
+    heightOf(index) {
+        const item = this.items[index];
+        if (item === undefined) {
+            // 已加载的页中缺少的条目（服务器跳过了不存在的文件）不占高度
+            return this.isLoaded(index) ? 0 : this.estimatedHeight;
+        }
+        const height = this.heights.get(this.getKey(item, index));
+        return height === undefined ? this.estimatedHeight : height;
+    }
+
+    render(force = false) {
+        if (this.total === 0) {
+            this.content.style.paddingTop = '0px';
+            this.content.style.paddingBottom = '0px';
+            this.content.innerHTML = this.emptyHtml;
+            this.range = null;
+            return;
+        }
+        
+        // 找到可见区域的第一个和最后一个条目
+        const scrollTop = this.container.scrollTop;
+        const viewportBottom = scrollTop + this.container.clientHeight;
+        let start = 0;
+        let position = 0;
+        while (start < this.total - 1 && position + this.heightOf(start) <= scrollTop) {
+            position += this.heightOf(start);
+            start++;
+        }
+        let end = start;
+        let bottom = position;
+        while (end < this.total && bottom < viewportBottom) {
+            bottom += this.heightOf(end);
+            end++;
+        }
+        const from = Math.max(0, start - this.overscan);
+        const to = Math.min(this.total, Math.max(end, start + 1) + this.overscan);
+        
+        let paddingTop = position;
+        for (let i = from; i < start; i++) paddingTop -= this.heightOf(i);
+        let paddingBottom = 0;
+        for (let i = to; i < this.total; i++) paddingBottom += this.heightOf(i);
+        this.content.style.paddingTop = `${paddingTop}px`;
+        this.content.style.paddingBottom = `${paddingBottom}px`;
+        
+        this.requestPages(from, to);
+        if (!force && this.range && this.range[0] === from && this.range[1] === to) return;
+        this.range = [from, to];
+        
+        const indices = [];
+        const rows = [];
+        for (let i = from; i < to; i++) {
+            const item = this.items[i];
+            if (item !== undefined) {
+                rows.push(this.renderItem(item, i));
+            } else if (!this.isLoaded(i)) {
+                rows.push(`<div class="virtual-list-placeholder" style="height: ${this.estimatedHeight}px;">加载中...</div>`);
+            } else {
+                continue;
+            }
+            indices.push(i);
+        }
+        this.content.innerHTML = rows.join('');
+        Array.from(this.content.children).forEach((element, n) => {
+            element.dataset.virtualIndex = indices[n];
+        });
+        this.measure();
+    }
+
+    // 测量已渲染条目的高度（条目展开、收起后也需要调用），高度变化时重新计算占位
+    measure() {
+        let changed = false;
+        Array.from(this.content.children).forEach(element => {
+            const index = parseInt(element.dataset.virtualIndex, 10);
+            const item = this.items[index];
+            if (item === undefined) return;
+            const style = getComputedStyle(element);
+            const height = element.offsetHeight + parseFloat(style.marginTop) + parseFloat(style.marginBottom);
+            const key = this.getKey(item, index);
+            if (this.heights.get(key) !== height) {
+                this.heights.set(key, height);
+                changed = true;
+            }
+        });
+        if (changed) {
+            this.render();
+        }
+    }
+
+    requestPages(from, to) {
+        if (!this.loadPage) return;
+        const firstPage = Math.floor(from / this.pageSize);
+        const lastPage = Math.floor(Math.max(from, to - 1) / this.pageSize);
+        for (let page = firstPage; page <= lastPage; page++) {
+            if (this.loadedPages.has(page) || this.loadingPages.has(page)) continue;
+            this.loadingPages.add(page);
+            const generation = this.generation;
+            const offset = page * this.pageSize;
+            this.loadPage(offset, this.pageSize)
+                .then(result => {
+                    if (generation !== this.generation) return;
+                    this.setPage(offset, result.items, result.total);
+                    this.render(true);
+                })
+                .catch(error => console.error('加载列表失败:', error))
+                .finally(() => {
+                    if (generation === this.generation) {
+                        this.loadingPages.delete(page);
+                    }
+                });
+        }
+    }
+
+    // 丢弃已加载的条目，重新加载当前可见区域（保持滚动位置）
+    reload() {
+        this.generation++;
+        this.items = new Array(this.total);
+        this.loadedPages.clear();
+        this.loadingPages.clear();
+        this.render(true);
+    }
+
+    // 条目的显示状态（选中、展开）变化后重新渲染可见区域
+    refresh() {
+        this.render(true);
+    }
+
+    find(key) {
+        return this.items.find((item, index) => item !== undefined && this.getKey(item, index) === key);
+    }
+
+    // 原地替换已加载的条目，条目未加载时返回false
+    replace(key, newItem) {
+        const index = this.items.findIndex((item, i) => item !== undefined && this.getKey(item, i) === key);
+        if (index < 0) return false;
+        this.items[index] = newItem;
+        this.heights.delete(key);
+        this.render(true);
+        return true;
+    }
+}
+
 // 加载订阅列表
 async function loadSubscriptions() {
     const currentUsername = getCurrentUser();
@@ -455,6 +729,38 @@ async function loadSubscriptions() {
     }
 }
 
+// 节目列表的虚拟列表
+let episodesList = null;
+
+// 渲染单个节目条目
+function renderEpisodeItem(episode, idx) {
+    // 清理文件名，移除非法字符并转义单引号
+    const safeTitle = (episode.title || '未知标题').replace(/[<>:"/\\|?*]/g, '_').trim().replace(/'/g, "\\'");
+    const safeAudioUrl = (episode.audio_url || '').replace(/'/g, "\\'");
+    // 处理描述中的链接，确保在新窗口打开
+    const processedDescription = addTargetBlankToLinks(episode.description || '');
+    return `
+        <div class="episode-item" data-index="${idx}">
+            <img src="${episode.cover || 'data:image/svg+xml,<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"80\" height=\"80\"><rect width=\"80\" height=\"80\" fill=\"%23ddd\"/></svg>'}" 
+                 alt="封面" onerror="this.src='data:image/svg+xml,<svg xmlns=\\'http://www.w3.org/2000/svg\\' width=\\'80\\' height=\\'80\\'><rect width=\\'80\\' height=\\'80\\' fill=\\'%23ddd\\'/></svg>'">
+            <div class="episode-item-content">
+                <h5>${episode.title}</h5>
+                <p>${processedDescription}</p>
+                ${episode.audio_url ? `
+                    <div class="convert-checkbox-container">
+                        <input type="checkbox" id="convert-sub-${idx}" style="width: auto;">
+                        <label for="convert-sub-${idx}">如果是m4a格式，自动转换为mp3</label>
+                    </div>
+                    <button onclick="downloadEpisodeFile('${safeAudioUrl}', '${safeTitle}', ${idx})" 
+                            class="download-btn" style="padding: 8px 16px; font-size: 14px; margin-top: 8px;">
+                        下载
+                    </button>
+                ` : '<span style="color: #999;">暂无下载链接</span>'}
+            </div>
+        </div>
+    `;
+}
+
 // 加载节目列表
 async function loadEpisodes(subIndex) {
     const currentUsername = getCurrentUser();
@@ -474,39 +780,18 @@ async function loadEpisodes(subIndex) {
         const data = await response.json();
         
         if (response.ok) {
-            const episodesHtml = data.episodes.map((episode, idx) => {
-                // 清理文件名，移除非法字符并转义单引号
-                const safeTitle = (episode.title || '未知标题').replace(/[<>:"/\\|?*]/g, '_').trim().replace(/'/g, "\\'");
-                const safeAudioUrl = (episode.audio_url || '').replace(/'/g, "\\'");
-                // 处理描述中的链接，确保在新窗口打开
-                const processedDescription = addTargetBlankToLinks(episode.description || '');
-                return `
-                    <div class="episode-item">
-                        <img src="${episode.cover || 'data:image/svg+xml,<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"80\" height=\"80\"><rect width=\"80\" height=\"80\" fill=\"%23ddd\"/></svg>'}" 
-                             alt="封面" onerror="this.src='data:image/svg+xml,<svg xmlns=\\'http://www.w3.org/2000/svg\\' width=\\'80\\' height=\\'80\\'><rect width=\\'80\\' height=\\'80\\' fill=\\'%23ddd\\'/></svg>'">
-                        <div class="episode-item-content">
-                            <h5>${episode.title}</h5>
-                            <p>${processedDescription}</p>
-                            ${episode.audio_url ? `
-                                <div class="convert-checkbox-container">
-                                    <input type="checkbox" id="convert-sub-${idx}" style="width: auto;">
-                                    <label for="convert-sub-${idx}">如果是m4a格式，自动转换为mp3</label>
-                                </div>
-                                <button onclick="downloadEpisodeFile('${safeAudioUrl}', '${safeTitle}', ${idx})" 
-                                        class="download-btn" style="padding: 8px 16px; font-size: 14px; margin-top: 8px;">
-                                    下载
-                                </button>
-                            ` : '<span style="color: #999;">暂无下载链接</span>'}
-                        </div>
-                    </div>
-                `;
-            }).join('');
-            
             listDiv.innerHTML = `
                 <button onclick="loadSubscriptions()" style="margin-bottom: 15px;">← 返回订阅列表</button>
                 <h4>${data.subscription.title} - 节目列表</h4>
-                ${episodesHtml}
+                <div id="episodes-scroll" class="virtual-list"></div>
             `;
+            // 节目较多时只渲染可见部分
+            episodesList = new VirtualList(document.getElementById('episodes-scroll'), {
+                renderItem: renderEpisodeItem,
+                estimatedHeight: 150,
+                emptyHtml: '<p>暂无节目</p>'
+            });
+            episodesList.setItems(data.episodes);
         } else {
             listDiv.innerHTML = `
                 <div class="status-message error">加载失败: ${data.error || '未知错误'}</div>
@@ -558,10 +843,10 @@ async function downloadEpisodeFile(audioUrl, title, index) {
         const convertCheckbox = document.getElementById(`convert-sub-${index}`);
         const convertToMp3 = convertCheckbox ? convertCheckbox.checked : false;
         
-        // 显示下载中状态
-        const buttons = document.querySelectorAll('.episode-item button.download-btn');
-        if (buttons[index]) {
-            const originalText = buttons[index].textContent;
+        // 显示下载中状态（节目列表是虚拟列表，按条目序号查找按钮）
+        const button = document.querySelector(`.episode-item[data-index="${index}"] button.download-btn`);
+        if (button) {
+            const originalText = button.textContent;
             
             // 创建或获取状态提示元素
             const statusHintId = `status-hint-${index}`;
@@ -574,19 +859,19 @@ async function downloadEpisodeFile(audioUrl, title, index) {
                 statusHint.style.fontSize = '13px';
                 statusHint.style.color = '#666';
                 statusHint.style.fontStyle = 'italic';
-                buttons[index].parentNode.insertBefore(statusHint, buttons[index].nextSibling);
+                button.parentNode.insertBefore(statusHint, button.nextSibling);
             }
             
             // 根据是否需要转换显示不同的提示
             if (convertToMp3) {
-                buttons[index].textContent = '处理中...';
+                button.textContent = '处理中...';
                 statusHint.innerHTML = '⚙️ 正在下载并转换格式，请稍候...';
             } else {
-                buttons[index].textContent = '准备下载...';
+                button.textContent = '准备下载...';
                 statusHint.innerHTML = '📥 正在准备下载...';
             }
             
-            buttons[index].disabled = true;
+            button.disabled = true;
             
             // 通过服务器下载，设置正确的文件名，同时保存到服务器
             const response = await fetch(apiUrl('/api/episode/download'), {
@@ -632,8 +917,8 @@ async function downloadEpisodeFile(audioUrl, title, index) {
                     statusHint.remove();
                 }
                 
-                buttons[index].textContent = originalText;
-                buttons[index].disabled = false;
+                button.textContent = originalText;
+                button.disabled = false;
                 return;
             }
             
@@ -664,7 +949,7 @@ async function downloadEpisodeFile(audioUrl, title, index) {
                             <div id="progress-fill-${index}" class="progress-fill" style="width: 0%"></div>
                         </div>
                     `;
-                    const insertAfter = statusHint || buttons[index];
+                    const insertAfter = statusHint || button;
                     insertAfter.parentNode.insertBefore(progressContainer, insertAfter.nextSibling);
                 }
                 
@@ -750,7 +1035,7 @@ async function downloadEpisodeFile(audioUrl, title, index) {
                     statusHint.innerHTML = '✅ 全部完成！';
                 }
                 
-                buttons[index].textContent = '下载完成';
+                button.textContent = '下载完成';
                 setTimeout(() => {
                     if (progressContainer && progressContainer.parentNode) {
                         progressContainer.remove();
@@ -758,8 +1043,8 @@ async function downloadEpisodeFile(audioUrl, title, index) {
                     if (statusHint && statusHint.parentNode) {
                         statusHint.remove();
                     }
-                    buttons[index].textContent = originalText;
-                    buttons[index].disabled = false;
+                    button.textContent = originalText;
+                    button.disabled = false;
                 }, 2000);
             }
         }
@@ -775,11 +1060,11 @@ async function downloadEpisodeFile(audioUrl, title, index) {
         }
         alert(errorMessage);
         
-        const buttons = document.querySelectorAll('.episode-item button.download-btn');
-        if (buttons[index]) {
-            const originalText = buttons[index].getAttribute('data-original-text') || '下载';
-            buttons[index].textContent = originalText;
-            buttons[index].disabled = false;
+        const button = document.querySelector(`.episode-item[data-index="${index}"] button.download-btn`);
+        if (button) {
+            const originalText = button.getAttribute('data-original-text') || '下载';
+            button.textContent = originalText;
+            button.disabled = false;
             
             // 清理状态提示（在catch块中需要重新获取，因为statusHint可能不在作用域内）
             const errorStatusHint = document.getElementById(`status-hint-${index}`);
@@ -866,54 +1151,110 @@ async function startMonitor() {
     }
 }
 
-// 加载任务列表
+// 加载任务列表（只获取任务摘要，不含完整结果列表）
 async function loadTasks() {
     try {
-        const response = await fetch(apiUrl('/api/tasks'));
+        const response = await fetch(apiUrl('/api/tasks?summary=1'));
         const data = await response.json();
         
         if (response.ok) {
-            const listDiv = document.getElementById('tasks-list');
-            if (data.tasks.length === 0) {
-                listDiv.innerHTML = '<p>暂无任务</p>';
-            } else {
-                listDiv.innerHTML = data.tasks.map(task => {
-                    const progress = task.progress || {};
-                    const progressPercent = progress.total > 0 
-                        ? Math.round((progress.completed / progress.total) * 100) 
-                        : 0;
-                    
-                    return `
-                        <div class="task-item ${task.status}">
-                            <div class="task-header">
-                                <h4>${task.type === 'download_latest' ? '下载最新节目' : '监听任务'} - ${task.username}</h4>
-                                <span class="task-status ${task.status}">${getStatusText(task.status)}</span>
-                            </div>
-                            <p>创建时间: ${new Date(task.created_at).toLocaleString('zh-CN')}</p>
-                            ${task.type === 'download_latest' ? `
-                                <div class="task-progress">
-                                    <p>进度: ${progress.completed}/${progress.total} (成功: ${progress.completed - (progress.failed || 0)}, 失败: ${progress.failed || 0})</p>
-                                    <div class="progress-bar">
-                                        <div class="progress-fill" style="width: ${progressPercent}%"></div>
-                                    </div>
-                                </div>
-                            ` : `
-                                <p>已下载: ${task.downloaded_count || 0} 集</p>
-                                <p>最后检查: ${new Date(task.last_check).toLocaleString('zh-CN')}</p>
-                            `}
-                            ${task.status === 'running' || task.status === 'pending' ? 
-                                `<button onclick="cancelTask('${task.task_id}')" class="delete-btn">取消任务</button>` : ''
-                            }
-                        </div>
-                    `;
-                }).join('');
-            }
+            taskState = new Map(data.tasks.map(task => [task.task_id, task]));
+            taskScheduler = data.scheduler;
+            renderTasks();
         }
     } catch (error) {
         console.error('加载任务失败:', error);
     }
 }
 
+// 根据taskState渲染任务列表
+function renderTasks() {
+    const listDiv = document.getElementById('tasks-list');
+    if (!listDiv) {
+        return;
+    }
+    const tasks = Array.from(taskState.values());
+    const scheduler = taskScheduler;
+    const schedulerHtml = scheduler ? `
+        <p class="help-text">执行中: ${scheduler.running}/${scheduler.max_workers} | 排队: ${scheduler.queued}
+            (交互 ${scheduler.queues.interactive.depth} / 监听 ${scheduler.queues.monitor.depth} / 补录 ${scheduler.queues.backfill.depth})</p>
+    ` : '';
+    if (tasks.length === 0) {
+        listDiv.innerHTML = schedulerHtml + '<p>暂无任务</p>';
+        return;
+    }
+    listDiv.innerHTML = schedulerHtml + tasks.map(task => {
+        const progress = task.progress || {};
+        const progressPercent = progress.total > 0 
+            ? Math.round((progress.completed / progress.total) * 100) 
+            : 0;
+        const recentResults = task.recent_results || [];
+        // 下载统计只在任务执行中显示
+        const transfer = task.status === 'running' ? task.transfer : null;
+        
+        return `
+            <div class="task-item ${task.status}">
+                <div class="task-header">
+                    <h4>${task.type === 'download_latest' ? '下载最新节目' : '监听任务'} - ${task.username}</h4>
+                    <span class="task-status ${task.status}">${getStatusText(task.status)}</span>
+                </div>
+                <p>创建时间: ${new Date(task.created_at).toLocaleString('zh-CN')}</p>
+                ${task.queue ? `<p>排队中: 已等待 ${Math.round(task.queue.wait_seconds)} 秒</p>` : ''}
+                ${task.type === 'download_latest' ? `
+                    <div class="task-progress">
+                        <p>进度: ${progress.completed}/${progress.total} (成功: ${progress.completed - (progress.failed || 0)}, 失败: ${progress.failed || 0})</p>
+                        <div class="progress-bar">
+                            <div class="progress-fill" style="width: ${progressPercent}%"></div>
+                        </div>
+                    </div>
+                ` : `
+                    <p>已下载: ${task.downloaded_count || 0} 集</p>
+                    <p>最后检查: ${new Date(task.last_check).toLocaleString('zh-CN')}</p>
+                `}
+                ${transfer ? `
+                    <div class="task-transfer">
+                        <p>速度: ${formatSpeed(transfer.current_bytes_per_sec)} (平均 ${formatSpeed(transfer.average_bytes_per_sec)})
+                            | 剩余时间: ${transfer.eta_seconds !== null ? formatDuration(transfer.eta_seconds) : '未知'}
+                            | 首字节: ${transfer.ttfb.last !== null ? transfer.ttfb.last.toFixed(2) + 's' : '-'}</p>
+                        ${transfer.active_downloads.map(d => `
+                            <p>${d.title || ''}: ${(d.downloaded / 1024 / 1024).toFixed(2)}MB${d.total ? ` / ${(d.total / 1024 / 1024).toFixed(2)}MB (${d.percent}%)` : ''}</p>
+                        `).join('')}
+                    </div>
+                ` : ''}
+                ${recentResults.length > 0 ? `
+                    <ul class="task-results">
+                        ${recentResults.map(r => `<li>${r.status === 'completed' ? '✓' : '✗'} ${r.title || r.file_id || ''}${r.bytes ? ` (${(r.bytes / 1024 / 1024).toFixed(2)}MB)` : ''}</li>`).join('')}
+                    </ul>
+                ` : ''}
+                ${task.status === 'running' || task.status === 'pending' ? 
+                    `<button onclick="cancelTask('${task.task_id}')" class="delete-btn">取消任务</button>` : ''
+                }
+            </div>
+        `;
+    }).join('');
+}
+
+function formatSpeed(bytesPerSec) {
+    if (!bytesPerSec) {
+        return '0 KB/s';
+    }
+    if (bytesPerSec >= 1024 * 1024) {
+        return `${(bytesPerSec / 1024 / 1024).toFixed(2)} MB/s`;
+    }
+    return `${(bytesPerSec / 1024).toFixed(1)} KB/s`;
+}
+
+function formatDuration(seconds) {
+    seconds = Math.round(seconds);
+    if (seconds < 60) {
+        return `${seconds}秒`;
+    }
+    if (seconds < 3600) {
+        return `${Math.floor(seconds / 60)}分${seconds % 60}秒`;
+    }
+    return `${Math.floor(seconds / 3600)}小时${Math.floor((seconds % 3600) / 60)}分`;
+}
+
 function getStatusText(status) {
     const statusMap = {
         'pending': '等待中',
@@ -951,15 +1292,103 @@ async function cancelTask(taskId) {
 // 加载下载列表
 let selectedDownloads = new Set(); // 存储选中的文件ID
 let currentDownloadUser = ''; // 当前筛选的用户
+let expandedDownloads = new Set(); // 已展开详情的文件ID
+let downloadsList = null; // 下载列表的虚拟列表
+let downloadsVersion = null; // 下载列表版本，刷新时只获取之后的变化
+const DOWNLOADS_PAGE_SIZE = 100;
+
+function downloadsUrl(params) {
+    const query = new URLSearchParams(params);
+    if (currentDownloadUser) {
+        query.set('username', currentDownloadUser);
+    }
+    return apiUrl(`/api/downloads?${query.toString()}`);
+}
+
+async function fetchDownloadsPage(offset, limit) {
+    const response = await fetch(downloadsUrl({ offset, limit }));
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || '加载下载列表失败');
+    }
+    return { items: data.downloads, total: data.total };
+}
+
+// 渲染单个下载条目
+function renderDownloadItem(download) {
+    const size = (download.size / 1024 / 1024).toFixed(2);
+    const episodeInfo = download.episode_info || {};
+    const fileExt = download.filename.split('.').pop().toLowerCase();
+    const isM4A = fileExt === 'm4a';
+    // 多个用户下载过同一节目时共享一个文件
+    const owners = download.owners || [download.username || 'unknown'];
+    const isChecked = selectedDownloads.has(download.file_id);
+    const isExpanded = expandedDownloads.has(download.file_id);
+    
+    // 构建详情内容（包括描述和封面）
+    const hasDetails = (episodeInfo.description && episodeInfo.description.trim()) || episodeInfo.cover;
+    let detailsContent = '';
+    
+    if (hasDetails) {
+        if (episodeInfo.cover) {
+            detailsContent += `<img src="${episodeInfo.cover}" alt="封面" class="episode-detail-cover" onerror="this.style.display='none'">`;
+        }
+        if (episodeInfo.description) {
+            // 处理描述中的链接，确保在新窗口打开
+            const processedDescription = addTargetBlankToLinks(episodeInfo.description);
+            detailsContent += `<p class="episode-description">${processedDescription}</p>`;
+        }
+    }
+    
+    return `
+        <div class="download-item ${isChecked ? 'selected' : ''}" data-file-id="${download.file_id}">
+            <div class="download-item-checkbox">
+                <input type="checkbox" id="check-${download.file_id}" 
+                       ${isChecked ? 'checked' : ''}
+                       onchange="toggleDownloadSelection('${download.file_id}')"
+                       onclick="event.stopPropagation()">
+            </div>
+            <div class="download-item-info">
+                <h5>
+                    ${episodeInfo.title || download.filename}
+                    ${owners.map(owner => `<span class="user-badge">${owner}</span>`).join(' ')}
+                    ${download.pinned ? '<span class="user-badge pinned-badge" title="不会因存储配额被自动清理">已固定</span>' : ''}
+                </h5>
+                ${episodeInfo.podcast_title ? `<p class="podcast-channel">频道: ${episodeInfo.podcast_title}</p>` : ''}
+                <p class="file-meta">
+                    大小: ${size} MB | 格式: ${fileExt.toUpperCase()} | 下载时间: ${new Date(download.downloaded_at).toLocaleString('zh-CN')}
+                </p>
+                ${hasDetails ? `
+                    <div class="details-container">
+                        <button class="expand-btn ${isExpanded ? 'expanded' : ''}" id="expand-btn-${download.file_id}" onclick="toggleDescription('${download.file_id}', event)">
+                            ${isExpanded ? '收起详情 ▲' : '展开详情 ▼'}
+                        </button>
+                        <div class="details-content" id="details-${download.file_id}" style="display: ${isExpanded ? 'block' : 'none'};">
+                            ${detailsContent}
+                        </div>
+                    </div>
+                ` : ''}
+            </div>
+            <div class="download-item-actions">
+                <a href="${apiUrl('/downloads/' + download.file_id)}" download class="download-btn">下载</a>
+                ${isM4A ? `<a href="${apiUrl('/downloads/' + download.file_id + '?format=mp3')}" download class="download-btn" title="按需生成MP3，保留原M4A文件">下载MP3</a>` : ''}
+                ${isM4A ? `<button onclick="convertToMp3('${download.file_id}')" class="monitor-btn">转MP3格式</button>` : ''}
+                <button onclick="pinDownload('${download.file_id}', ${!download.pinned})" class="monitor-btn" title="固定的文件不会因存储配额被自动清理">${download.pinned ? '取消固定' : '固定'}</button>
+                <button onclick="deleteDownload('${download.file_id}')" class="delete-btn">删除</button>
+            </div>
+        </div>
+    `;
+}
 
 async function loadDownloads(username = '') {
     try {
         currentDownloadUser = username;
-        const url = username ? apiUrl(`/api/downloads?username=${encodeURIComponent(username)}`) : apiUrl('/api/downloads');
-        const response = await fetch(url);
+        // 第一页同时返回总数、用户列表和版本，其余页滚动到附近时再加载
+        const response = await fetch(downloadsUrl({ offset: 0, limit: DOWNLOADS_PAGE_SIZE }));
         const data = await response.json();
         
         if (response.ok) {
+            downloadsVersion = data.version;
             const listDiv = document.getElementById('downloads-list');
             
             // 构建用户过滤器和批量操作工具栏
@@ -973,7 +1402,7 @@ async function loadDownloads(username = '') {
                                 `<option value="${user}" ${user === username ? 'selected' : ''}>${user}</option>`
                             ).join('')}
                         </select>
-                        <span style="margin-left: 15px; color: #666;">共 ${data.downloads.length} 个文件</span>
+                        <span id="downloads-count" style="margin-left: 15px; color: #666;">共 ${data.total} 个文件</span>
                         <button onclick="selectAll()" class="select-all-btn">全选</button>
                     </div>
                     <div class="batch-actions" style="display: none;">
@@ -986,80 +1415,65 @@ async function loadDownloads(username = '') {
                 </div>
             `;
             
-            if (data.downloads.length === 0) {
-                listDiv.innerHTML = toolbar + '<p style="margin-top: 20px;">暂无下载文件</p>';
-            } else {
-                const downloadsList = data.downloads.map((download, index) => {
-                    const size = (download.size / 1024 / 1024).toFixed(2);
-                    const episodeInfo = download.episode_info || {};
-                    const fileExt = download.filename.split('.').pop().toLowerCase();
-                    const isM4A = fileExt === 'm4a';
-                    const username = download.username || 'unknown';
-                    const isChecked = selectedDownloads.has(download.file_id);
-                    
-                    // 构建详情内容（包括描述和封面）
-                    const hasDetails = (episodeInfo.description && episodeInfo.description.trim()) || episodeInfo.cover;
-                    let detailsContent = '';
-                    
-                    if (hasDetails) {
-                        if (episodeInfo.cover) {
-                            detailsContent += `<img src="${episodeInfo.cover}" alt="封面" class="episode-detail-cover" onerror="this.style.display='none'">`;
-                        }
-                        if (episodeInfo.description) {
-                            // 处理描述中的链接，确保在新窗口打开
-                            const processedDescription = addTargetBlankToLinks(episodeInfo.description);
-                            detailsContent += `<p class="episode-description">${processedDescription}</p>`;
-                        }
-                    }
-                    
-                    return `
-                        <div class="download-item ${isChecked ? 'selected' : ''}" data-file-id="${download.file_id}">
-                            <div class="download-item-checkbox">
-                                <input type="checkbox" id="check-${download.file_id}" 
-                                       ${isChecked ? 'checked' : ''}
-                                       onchange="toggleDownloadSelection('${download.file_id}')"
-                                       onclick="event.stopPropagation()">
-                            </div>
-                            <div class="download-item-info">
-                                <h5>
-                                    ${episodeInfo.title || download.filename}
-                                    <span class="user-badge">${username}</span>
-                                </h5>
-                                ${episodeInfo.podcast_title ? `<p class="podcast-channel">频道: ${episodeInfo.podcast_title}</p>` : ''}
-                                <p class="file-meta">
-                                    大小: ${size} MB | 格式: ${fileExt.toUpperCase()} | 下载时间: ${new Date(download.downloaded_at).toLocaleString('zh-CN')}
-                                </p>
-                                ${hasDetails ? `
-                                    <div class="details-container">
-                                        <button class="expand-btn" id="expand-btn-${download.file_id}" onclick="toggleDescription('${download.file_id}', event)">
-                                            展开详情 ▼
-                                        </button>
-                                        <div class="details-content" id="details-${download.file_id}" style="display: none;">
-                                            ${detailsContent}
-                                        </div>
-                                    </div>
-                                ` : ''}
-                            </div>
-                            <div class="download-item-actions">
-                                <a href="${apiUrl('/downloads/' + download.file_id)}" download class="download-btn">下载</a>
-                                ${isM4A ? `<button onclick="convertToMp3('${download.file_id}')" class="monitor-btn">转MP3格式</button>` : ''}
-                                <button onclick="deleteDownload('${download.file_id}')" class="delete-btn">删除</button>
-                            </div>
-                        </div>
-                    `;
-                }).join('');
-                
-                listDiv.innerHTML = toolbar + downloadsList;
-                
-                // 更新批量操作工具栏显示
-                updateBatchToolbar();
-            }
+            listDiv.innerHTML = toolbar + '<div id="downloads-scroll" class="virtual-list"></div>';
+            downloadsList = new VirtualList(document.getElementById('downloads-scroll'), {
+                renderItem: renderDownloadItem,
+                getKey: download => download.file_id,
+                estimatedHeight: 110,
+                pageSize: DOWNLOADS_PAGE_SIZE,
+                loadPage: fetchDownloadsPage,
+                emptyHtml: '<p style="margin-top: 20px;">暂无下载文件</p>',
+                onTotal: total => {
+                    const count = document.getElementById('downloads-count');
+                    if (count) count.textContent = `共 ${total} 个文件`;
+                }
+            });
+            downloadsList.setPage(0, data.downloads, data.total);
+            downloadsList.refresh();
+            
+            // 更新批量操作工具栏显示
+            updateBatchToolbar();
         }
     } catch (error) {
         console.error('加载下载列表失败:', error);
     }
 }
 
+// 操作后刷新下载列表：只获取上次加载之后的变化，不重新渲染整个列表
+async function refreshDownloads() {
+    if (!downloadsList || downloadsVersion === null) {
+        return loadDownloads(currentDownloadUser);
+    }
+    try {
+        const response = await fetch(downloadsUrl({ since: downloadsVersion }));
+        const data = await response.json();
+        if (!response.ok) return;
+        if (data.reset) {
+            return loadDownloads(currentDownloadUser);
+        }
+        downloadsVersion = data.version;
+        data.deleted.forEach(fileId => {
+            selectedDownloads.delete(fileId);
+            expandedDownloads.delete(fileId);
+        });
+        updateBatchToolbar();
+        if (data.upserted.length === 0 && data.deleted.length === 0) return;
+        
+        // 只修改了已加载的条目且排序不变时原地更新；新增、删除会改变条目位置，重新加载可见区域
+        const inPlace = data.deleted.length === 0 && data.upserted.every(download => {
+            const current = downloadsList.find(download.file_id);
+            return current && current.downloaded_at === download.downloaded_at;
+        });
+        if (inPlace) {
+            data.upserted.forEach(download => downloadsList.replace(download.file_id, download));
+        } else {
+            downloadsList.reload();
+        }
+    } catch (error) {
+        console.error('刷新下载列表失败:', error);
+    }
+}
+
 // 切换描述展开/收起
 function toggleDescription(fileId, event) {
     event.stopPropagation();
@@ -1072,10 +1486,17 @@ function toggleDescription(fileId, event) {
         details.style.display = 'block';
         btn.textContent = '收起详情 ▲';
         btn.classList.add('expanded');
+        expandedDownloads.add(fileId);
     } else {
         details.style.display = 'none';
         btn.textContent = '展开详情 ▼';
         btn.classList.remove('expanded');
+        expandedDownloads.delete(fileId);
+    }
+    
+    // 条目高度变化，重新测量
+    if (downloadsList) {
+        downloadsList.measure();
     }
 }
 
@@ -1089,12 +1510,12 @@ function toggleDownloadSelection(fileId) {
     const checkbox = document.getElementById(`check-${fileId}`);
     const downloadItem = document.querySelector(`[data-file-id="${fileId}"]`);
     
-    if (checkbox.checked) {
+    if (checkbox && checkbox.checked) {
         selectedDownloads.add(fileId);
-        downloadItem.classList.add('selected');
+        if (downloadItem) downloadItem.classList.add('selected');
     } else {
         selectedDownloads.delete(fileId);
-        downloadItem.classList.remove('selected');
+        if (downloadItem) downloadItem.classList.remove('selected');
     }
     
     updateBatchToolbar();
@@ -1115,30 +1536,32 @@ function updateBatchToolbar() {
     }
 }
 
-// 全选
-function selectAll() {
-    const checkboxes = document.querySelectorAll('.download-item-checkbox input[type="checkbox"]');
-    checkboxes.forEach(cb => {
-        cb.checked = true;
-        const fileId = cb.id.replace('check-', '');
-        selectedDownloads.add(fileId);
-        const downloadItem = document.querySelector(`[data-file-id="${fileId}"]`);
-        if (downloadItem) {
-            downloadItem.classList.add('selected');
+// 全选：选择当前筛选条件下的全部文件（包括尚未渲染的条目）
+async function selectAll() {
+    try {
+        const limit = 500;
+        let offset = 0;
+        while (true) {
+            const page = await fetchDownloadsPage(offset, limit);
+            page.items.forEach(download => selectedDownloads.add(download.file_id));
+            offset += limit;
+            if (offset >= page.total) break;
         }
-    });
+    } catch (error) {
+        console.error('全选失败:', error);
+    }
+    if (downloadsList) {
+        downloadsList.refresh();
+    }
     updateBatchToolbar();
 }
 
 // 清除选择
 function clearSelection() {
     selectedDownloads.clear();
-    document.querySelectorAll('.download-item-checkbox input[type="checkbox"]').forEach(cb => {
-        cb.checked = false;
-    });
-    document.querySelectorAll('.download-item').forEach(item => {
-        item.classList.remove('selected');
-    });
+    if (downloadsList) {
+        downloadsList.refresh();
+    }
     updateBatchToolbar();
 }
 
@@ -1149,20 +1572,32 @@ async function batchDownload() {
         return;
     }
     
-    // 依次触发下载
-    for (const fileId of selectedDownloads) {
+    // 只选了一个文件时直接下载
+    if (selectedDownloads.size === 1) {
         const link = document.createElement('a');
-        link.href = apiUrl(`/downloads/${fileId}`);
+        link.href = apiUrl(`/downloads/${Array.from(selectedDownloads)[0]}`);
         link.download = '';
         document.body.appendChild(link);
         link.click();
         document.body.removeChild(link);
-        
-        // 延迟一下，避免浏览器阻止多个下载
-        await new Promise(resolve => setTimeout(resolve, 500));
+        return;
     }
     
-    alert(`已触发${selectedDownloads.size}个文件的下载`);
+    // 多个文件打包为一个ZIP下载：通过表单提交，由浏览器直接保存，不在页面内存中缓存
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = apiUrl('/api/downloads/batch/archive');
+    form.style.display = 'none';
+    for (const fileId of selectedDownloads) {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = 'file_ids';
+        input.value = fileId;
+        form.appendChild(input);
+    }
+    document.body.appendChild(form);
+    form.submit();
+    document.body.removeChild(form);
 }
 
 // 批量转换为MP3格式
@@ -1221,8 +1656,8 @@ async function batchConvert() {
             alert(message);
             
             // 刷新列表并清除选择
-            await loadDownloads(currentDownloadUser);
             clearSelection();
+            await refreshDownloads();
         } else {
             alert('批量处理失败: ' + (data.error || '未知错误'));
         }
@@ -1250,7 +1685,8 @@ async function batchDelete() {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                file_ids: Array.from(selectedDownloads)
+                file_ids: Array.from(selectedDownloads),
+                username: currentDownloadUser || null
             })
         });
         
@@ -1272,7 +1708,7 @@ async function batchDelete() {
             }
             alert(message);
             clearSelection();
-            loadDownloads(currentDownloadUser);
+            refreshDownloads();
         } else {
             alert('批量删除失败: ' + (data.error || '未知错误'));
         }
@@ -1301,7 +1737,7 @@ async function convertToMp3(fileId) {
         
         if (response.ok) {
             alert('转换成功！原M4A文件已被MP3文件替换。');
-            loadDownloads();
+            refreshDownloads();
         } else {
             alert('转换失败: ' + (data.error || '未知错误'));
         }
@@ -1311,20 +1747,45 @@ async function convertToMp3(fileId) {
 }
 
 // 删除下载文件
+// 固定/取消固定文件
+async function pinDownload(fileId, pinned) {
+    try {
+        const response = await fetch(apiUrl(`/api/downloads/${fileId}/pin`), {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ pinned })
+        });
+        
+        const data = await response.json();
+        
+        if (response.ok) {
+            refreshDownloads();
+        } else {
+            alert('操作失败: ' + (data.error || '未知错误'));
+        }
+    } catch (error) {
+        alert('请求失败: ' + error.message);
+    }
+}
+
 async function deleteDownload(fileId) {
     if (!confirm('确定要删除这个文件吗？')) {
         return;
     }
     
     try {
-        const response = await fetch(apiUrl(`/api/downloads/${fileId}`), {
+        // 按用户筛选时只移除该用户的引用，其他用户下载过的文件保留
+        const query = currentDownloadUser ? `?username=${encodeURIComponent(currentDownloadUser)}` : '';
+        const response = await fetch(apiUrl(`/api/downloads/${fileId}${query}`), {
             method: 'DELETE'
         });
         
         const data = await response.json();
         
         if (response.ok) {
-            loadDownloads();
+            refreshDownloads();
         } else {
             alert('删除失败: ' + (data.error || '未知错误'));
         }
@@ -1,11 +1,15 @@
 """
 音频格式转换工具
-使用ffmpeg将m4a转换为mp3
+使用ffmpeg将m4a转换为mp3，支持文件转换和管道流式转换
 """
 import os
 import subprocess
 import shutil
 import logging
+import threading
+import itertools
+import json
+from utils.cancellation import CancelledError
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +17,74 @@ def check_ffmpeg():
     """检查ffmpeg是否可用"""
     return shutil.which('ffmpeg') is not None
 
-def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8):
+def detect_mp3_encoder():
+    """
+    检测ffmpeg可用的mp3编码器
+    
+    返回: 'libmp3lame'、'mp3'（内置编码器）或 'aac'（mp3编码器都不可用时的备选）
+    """
+    # 检查ffmpeg支持的编码器
+    check_cmd = ['ffmpeg', '-encoders']
+    check_result = subprocess.run(
+        check_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding='utf-8',
+        errors='ignore',  # 忽略无法解码的字符
+        timeout=5
+    )
+    
+    # 确定使用哪个mp3编码器
+    mp3_encoder = 'libmp3lame'  # 默认
+    if check_result.returncode == 0:
+        encoders_output = check_result.stdout + check_result.stderr
+        if 'libmp3lame' not in encoders_output:
+            # 如果没有libmp3lame，尝试使用内置的mp3编码器
+            if 'mp3' in encoders_output.lower():
+                mp3_encoder = 'mp3'
+                logger.info("检测到libmp3lame不可用，使用内置mp3编码器")
+            else:
+                # 如果mp3编码器都不可用，使用aac作为备选
+                mp3_encoder = 'aac'
+                logger.warning("mp3编码器不可用，使用aac编码器，输出格式改为m4a")
+        else:
+            logger.info("使用libmp3lame编码器")
+    else:
+        # 如果检查失败，先尝试libmp3lame，失败后再尝试mp3
+        logger.warning("无法检测编码器，将尝试多种编码器")
+    return mp3_encoder
+
+def _run_ffmpeg(cmd, timeout=3600, cancel_token=None, preexec_fn=None):
+    """
+    执行ffmpeg命令并收集输出
+    cancel_token: 可选的CancelToken，取消时立即终止ffmpeg进程并抛出CancelledError
+    返回: subprocess.CompletedProcess
+    """
+    if cancel_token:
+        cancel_token.raise_if_cancelled()
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding='utf-8',
+        errors='ignore',  # 忽略无法解码的字符
+        preexec_fn=preexec_fn
+    )
+    kill_handle = cancel_token.register(process.kill) if cancel_token else None
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    finally:
+        if cancel_token:
+            cancel_token.unregister(kill_handle)
+    if cancel_token and cancel_token.cancelled:
+        raise CancelledError("转换已取消")
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8, cancel_token=None):
     """
     将m4a文件转换为mp3
     
@@ -22,6 +93,7 @@ def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8):
         output_path: 输出文件路径（如果为None，则自动生成）
         quality: 音频质量 (0-9, 0最高质量，默认5)
         threads: 使用的线程数（默认8）
+        cancel_token: 可选的CancelToken，取消时终止ffmpeg并删除不完整的输出
     
     返回:
         (success, output_path, error_message)
@@ -39,36 +111,9 @@ def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8):
     
     try:
         # 首先尝试检测可用的mp3编码器
-        # 检查ffmpeg支持的编码器
-        check_cmd = ['ffmpeg', '-encoders']
-        check_result = subprocess.run(
-            check_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            errors='ignore',  # 忽略无法解码的字符
-            timeout=5
-        )
-        
-        # 确定使用哪个mp3编码器
-        mp3_encoder = 'libmp3lame'  # 默认
-        if check_result.returncode == 0:
-            encoders_output = check_result.stdout + check_result.stderr
-            if 'libmp3lame' not in encoders_output:
-                # 如果没有libmp3lame，尝试使用内置的mp3编码器
-                if 'mp3' in encoders_output.lower():
-                    mp3_encoder = 'mp3'
-                    logger.info("检测到libmp3lame不可用，使用内置mp3编码器")
-                else:
-                    # 如果mp3编码器都不可用，使用aac作为备选
-                    mp3_encoder = 'aac'
-                    output_path = output_path.replace('.mp3', '.m4a')
-                    logger.warning("mp3编码器不可用，使用aac编码器，输出格式改为m4a")
-            else:
-                logger.info("使用libmp3lame编码器")
-        else:
-            # 如果检查失败，先尝试libmp3lame，失败后再尝试mp3
-            logger.warning("无法检测编码器，将尝试多种编码器")
+        mp3_encoder = detect_mp3_encoder()
+        if mp3_encoder == 'aac':
+            output_path = output_path.replace('.mp3', '.m4a')
         
         # 构建ffmpeg命令
         # -y: 覆盖输出文件
@@ -125,14 +170,7 @@ def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8):
         
         # 执行转换，记录详细输出
         logger.info(f"执行ffmpeg命令: {' '.join(cmd)}")
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            errors='ignore',  # 忽略无法解码的字符
-            timeout=3600  # 1小时超时
-        )
+        result = _run_ffmpeg(cmd, timeout=3600, cancel_token=cancel_token)  # 1小时超时
         
         if result.returncode == 0 and os.path.exists(output_path):
             logger.info(f"转换成功 - 输入: {input_path}, 输出: {output_path}, 编码器: {mp3_encoder}")
@@ -157,14 +195,7 @@ def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8):
                     output_path
                 ]
                 logger.info(f"重试ffmpeg命令: {' '.join(cmd_mp3)}")
-                result = subprocess.run(
-                    cmd_mp3,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    encoding='utf-8',
-                    errors='ignore',  # 忽略无法解码的字符
-                    timeout=3600
-                )
+                result = _run_ffmpeg(cmd_mp3, timeout=3600, cancel_token=cancel_token)
                 
                 if result.returncode == 0 and os.path.exists(output_path):
                     logger.info(f"转换成功（使用内置mp3编码器） - 输入: {input_path}, 输出: {output_path}")
@@ -177,9 +208,186 @@ def convert_m4a_to_mp3(input_path, output_path=None, quality=5, threads=8):
             logger.error(f"ffmpeg stderr: {result.stderr}")
             return False, None, error_msg
             
+    except CancelledError:
+        logger.info(f"转换已取消 - 输入: {input_path}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return False, None, "转换已取消"
+    except Exception as e:
+        logger.exception(f"转换过程发生异常 - 输入: {input_path}, 输出: {output_path}, 异常: {str(e)}")
+        return False, None, f"转换过程出错: {str(e)}"
+
+# 支持的目标格式：编码格式、ffmpeg编码器、封装格式（muxer）、扩展名和MIME类型
+AUDIO_FORMATS = {
+    'mp3': {'codec': 'mp3', 'encoder': 'libmp3lame', 'muxer': 'mp3', 'ext': 'mp3', 'mimetype': 'audio/mpeg'},
+    'm4a': {'codec': 'aac', 'encoder': 'aac', 'muxer': 'ipod', 'ext': 'm4a', 'mimetype': 'audio/mp4'},
+    'aac': {'codec': 'aac', 'encoder': 'aac', 'muxer': 'adts', 'ext': 'aac', 'mimetype': 'audio/aac'},
+    'opus': {'codec': 'opus', 'encoder': 'libopus', 'muxer': 'ogg', 'ext': 'opus', 'mimetype': 'audio/ogg'},
+}
+
+def check_ffprobe():
+    """检查ffprobe是否可用"""
+    return shutil.which('ffprobe') is not None
+
+def probe_audio(file_path):
+    """
+    使用ffprobe获取音频流信息
+    
+    返回: {'codec': 编码格式, 'bit_rate': 比特率(bps，可能为None)}，失败返回None
+    """
+    if not os.path.exists(file_path) or not check_ffprobe():
+        return None
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name,bit_rate:format=bit_rate',
+        '-of', 'json',
+        file_path
+    ]
+    try:
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            errors='ignore',
+            timeout=30
+        )
+        if result.returncode != 0:
+            logger.warning(f"ffprobe失败 - 文件: {file_path}, 错误: {result.stderr}")
+            return None
+        data = json.loads(result.stdout or '{}')
+        streams = data.get('streams') or []
+        if not streams:
+            return None
+        bit_rate = streams[0].get('bit_rate') or data.get('format', {}).get('bit_rate')
+        return {
+            'codec': streams[0].get('codec_name'),
+            'bit_rate': int(bit_rate) if bit_rate and str(bit_rate).isdigit() else None
+        }
+    except Exception as e:
+        logger.warning(f"ffprobe执行异常 - 文件: {file_path}, 异常: {str(e)}")
+        return None
+
+def parse_bitrate(bitrate):
+    """将'128k'形式的比特率转换为bps，无效时返回None"""
+    if not bitrate:
+        return None
+    bitrate = str(bitrate).strip().lower()
+    try:
+        if bitrate.endswith('k'):
+            return int(bitrate[:-1]) * 1000
+        return int(bitrate)
+    except ValueError:
+        return None
+
+def can_remux(input_path, target_format, bitrate=None):
+    """
+    判断是否可以只换封装（stream copy）而不重新编码
+    源编码与目标编码一致，且未要求更低的比特率时可以直接复制音频流
+    """
+    format_info = AUDIO_FORMATS.get(target_format)
+    if not format_info:
+        return False
+    info = probe_audio(input_path)
+    if not info or info['codec'] != format_info['codec']:
+        return False
+    target_bps = parse_bitrate(bitrate)
+    if target_bps and (not info['bit_rate'] or info['bit_rate'] > target_bps * 1.1):
+        return False
+    return True
+
+def _lower_priority():
+    """在子进程中降低CPU调度优先级"""
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+
+def convert_audio(input_path, output_path, target_format, bitrate=None, threads=8, remux=False, extra_args=None,
+                  low_priority=False, cancel_token=None):
+    """
+    通用音频格式转换
+    
+    参数:
+        input_path: 输入文件路径
+        output_path: 输出文件路径
+        target_format: 目标格式（AUDIO_FORMATS中的键）
+        bitrate: 目标比特率（如'128k'），None使用编码器默认质量
+        threads: 使用的线程数
+        remux: True时只复制音频流并更换封装，不重新编码
+        extra_args: 额外的ffmpeg输出参数
+        low_priority: True时以最低CPU优先级运行ffmpeg（仅POSIX系统），用于后台批量任务
+        cancel_token: 可选的CancelToken，取消时终止ffmpeg
+    
+    返回:
+        (success, output_path, error_message)
+    """
+    if not os.path.exists(input_path):
+        return False, None, "输入文件不存在"
+    
+    if not check_ffmpeg():
+        return False, None, "ffmpeg未安装或不在PATH中"
+    
+    format_info = AUDIO_FORMATS.get(target_format)
+    if not format_info:
+        return False, None, f"不支持的目标格式: {target_format}"
+    
+    if remux:
+        codec_args = ['-codec:a', 'copy']
+    else:
+        encoder = format_info['encoder']
+        if target_format == 'mp3':
+            encoder = detect_mp3_encoder()
+            if encoder == 'aac':
+                return False, None, "mp3编码器不可用"
+        codec_args = ['-codec:a', encoder]
+        if bitrate:
+            codec_args += ['-b:a', bitrate]
+        elif encoder == 'libmp3lame':
+            codec_args += ['-qscale:a', '5']
+    
+    # 先写入临时文件，完成后再替换，避免留下不完整的输出
+    temp_path = f"{output_path}.part"
+    cmd = [
+        'ffmpeg',
+        '-y',
+        '-threads', str(threads),
+        '-i', input_path,
+        '-vn',
+        *codec_args,
+        '-map_metadata', '0',
+        *(extra_args or []),
+        '-f', format_info['muxer'],
+        temp_path
+    ]
+    
+    try:
+        logger.info(f"执行ffmpeg命令: {' '.join(cmd)}")
+        result = _run_ffmpeg(
+            cmd,
+            timeout=3600,  # 1小时超时
+            cancel_token=cancel_token,
+            preexec_fn=_lower_priority if low_priority and hasattr(os, 'nice') else None
+        )
+        if result.returncode == 0 and os.path.exists(temp_path):
+            os.replace(temp_path, output_path)
+            logger.info(f"转换成功 - 输入: {input_path}, 输出: {output_path}, 方式: {'remux' if remux else 'encode'}")
+            return True, output_path, None
+        
+        logger.error(f"转换失败 - 输入: {input_path}, 输出: {output_path}, ffmpeg返回码: {result.returncode}")
+        logger.error(f"ffmpeg stderr: {result.stderr}")
+        return False, None, result.stderr or "转换失败"
+    except CancelledError:
+        logger.info(f"转换已取消 - 输入: {input_path}")
+        return False, None, "转换已取消"
     except Exception as e:
         logger.exception(f"转换过程发生异常 - 输入: {input_path}, 输出: {output_path}, 异常: {str(e)}")
         return False, None, f"转换过程出错: {str(e)}"
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 def get_audio_format(file_path):
     """获取音频文件格式"""
@@ -193,6 +401,176 @@ def get_audio_format(file_path):
         return 'm4a'
     elif ext in ['.aac']:
         return 'aac'
+    elif ext in ['.opus', '.ogg']:
+        return 'opus'
     else:
         return None
 
+
+# 流式转换时预读上游数据的上限，超过仍无法判断时回退到临时文件转换
+STREAM_PEEK_LIMIT = 1024 * 1024
+
+# 不影响moov/mdat判断的顶层box，可以直接跳过
+_SKIPPABLE_MP4_BOXES = {b'ftyp', b'free', b'skip', b'wide', b'pdin', b'uuid', b'styp', b'sidx'}
+
+def check_mp4_streamable(head):
+    """
+    根据MP4/M4A文件头部数据判断moov是否位于mdat之前（faststart）
+    
+    ffmpeg从管道读取时无法回跳，moov在文件末尾的m4a必须先落盘才能转换
+    
+    返回: True（可流式转换）、False（需要seek）或 None（数据不足，无法判断）
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        box_size = int.from_bytes(head[offset:offset + 4], 'big')
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if box_type not in _SKIPPABLE_MP4_BOXES:
+            # 不认识的box，无法确定布局
+            return False
+        if box_size == 1:
+            # 64位largesize
+            if offset + 16 > len(head):
+                return None
+            box_size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        elif box_size == 0:
+            # box延伸到文件末尾，后面不会再有moov
+            return False
+        if box_size < 8:
+            return False
+        offset += box_size
+    return None
+
+def peek_streamable_m4a(chunks, peek_limit=STREAM_PEEK_LIMIT):
+    """
+    预读上游数据块，判断m4a能否通过管道流式转换
+    
+    参数:
+        chunks: 上游数据块迭代器（如response.iter_content()）
+        peek_limit: 最多预读的字节数
+    
+    返回:
+        (streamable, chunks) - chunks是包含已预读数据的完整迭代器，调用方应使用它代替原迭代器
+    """
+    chunks = iter(chunks)
+    buffered = []
+    head = b''
+    streamable = None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffered.append(chunk)
+        head += chunk
+        streamable = check_mp4_streamable(head)
+        if streamable is not None or len(head) >= peek_limit:
+            break
+    return bool(streamable), itertools.chain(buffered, chunks)
+
+def _build_stream_encode_args(mp3_encoder, quality):
+    """构建流式转换的编码参数"""
+    if mp3_encoder == 'libmp3lame':
+        return ['-codec:a', 'libmp3lame', '-qscale:a', str(quality)]
+    bitrate_map = {0: '320k', 1: '256k', 2: '224k', 3: '192k', 4: '192k',
+                  5: '192k', 6: '160k', 7: '128k', 8: '128k', 9: '128k'}
+    return ['-codec:a', 'mp3', '-b:a', bitrate_map.get(quality, '192k')]
+
+def stream_convert_to_mp3(chunks, quality=5, threads=8, read_size=65536):
+    """
+    通过管道流式转换为mp3：上游数据写入ffmpeg stdin，边转换边从stdout产出mp3数据
+    
+    参数:
+        chunks: 输入音频数据块迭代器（m4a需为faststart布局，见peek_streamable_m4a）
+        quality: 音频质量 (0-9, 0最高质量，默认5)
+        threads: 使用的线程数（默认8）
+        read_size: 每次从ffmpeg读取的最大字节数
+    
+    返回:
+        生成器，逐块产出mp3数据；ffmpeg失败时抛出RuntimeError
+    """
+    mp3_encoder = detect_mp3_encoder()
+    if mp3_encoder == 'aac':
+        raise RuntimeError("mp3编码器不可用，无法流式转换为mp3")
+    
+    cmd = [
+        'ffmpeg',
+        '-hide_banner',
+        '-loglevel', 'error',
+        '-threads', str(threads),
+        '-i', 'pipe:0',
+        '-vn',
+        *_build_stream_encode_args(mp3_encoder, quality),
+        '-map_metadata', '0',
+        '-f', 'mp3',
+        'pipe:1'
+    ]
+    logger.info(f"执行ffmpeg流式转换命令: {' '.join(cmd)}")
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    
+    feed_error = []
+    stderr_output = []
+    
+    def feed_input():
+        """把上游数据写入ffmpeg stdin"""
+        try:
+            for chunk in chunks:
+                if chunk:
+                    process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError, OSError):
+            # ffmpeg已退出或被终止
+            pass
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+    
+    def drain_stderr():
+        """持续读取stderr，避免管道写满导致ffmpeg阻塞"""
+        for line in process.stderr:
+            if len(stderr_output) < 100:
+                stderr_output.append(line.decode('utf-8', errors='ignore'))
+    
+    feeder = threading.Thread(target=feed_input, daemon=True)
+    stderr_reader = threading.Thread(target=drain_stderr, daemon=True)
+    feeder.start()
+    stderr_reader.start()
+    
+    finished = False
+    try:
+        stdout_fd = process.stdout.fileno()
+        while True:
+            # os.read有数据就返回，不必等满read_size，保证首字节尽快发出
+            data = os.read(stdout_fd, read_size)
+            if not data:
+                break
+            yield data
+        process.wait()
+        feeder.join()
+        stderr_reader.join(timeout=5)
+        finished = True
+        
+        if feed_error:
+            raise RuntimeError(f"读取上游数据失败: {feed_error[0]}")
+        if process.returncode != 0:
+            error_msg = ''.join(stderr_output).strip() or f"ffmpeg返回码: {process.returncode}"
+            logger.error(f"流式转换失败 - ffmpeg返回码: {process.returncode}, stderr: {error_msg}")
+            raise RuntimeError(error_msg)
+        logger.info(f"流式转换成功 - 编码器: {mp3_encoder}")
+    finally:
+        if not finished:
+            # 客户端断开或出错时终止ffmpeg
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        process.stdout.close()
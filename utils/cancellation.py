@@ -0,0 +1,121 @@
+"""
+协作式取消
+任务持有一个CancelToken，下载循环和ffmpeg子进程在令牌上注册中止回调，
+取消时立即关闭网络连接、终止编码进程
+"""
+import socket
+import threading
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+class CancelledError(Exception):
+    """操作已被取消"""
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_handle = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """取消：设置标记并执行所有已注册的中止回调"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"执行取消回调失败: {str(e)}")
+
+    def register(self, callback):
+        """
+        注册中止回调，返回句柄用于注销
+        如果已经取消，回调会立即执行
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._next_handle += 1
+                self._callbacks[self._next_handle] = callback
+                return self._next_handle
+        callback()
+        return None
+
+    def unregister(self, handle):
+        """注销中止回调"""
+        if handle is None:
+            return
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+    def raise_if_cancelled(self):
+        """已取消时抛出CancelledError"""
+        if self._event.is_set():
+            raise CancelledError("操作已取消")
+
+    def wait(self, timeout=None):
+        """等待取消，返回是否已取消（可用于可中断的休眠）"""
+        return self._event.wait(timeout)
+
+def abort_response(response):
+    """
+    中止requests的流式响应
+    先shutdown底层socket，让阻塞在recv上的读取线程立即返回，再关闭响应
+    """
+    sock = None
+    raw = getattr(response, 'raw', None)
+    connection = getattr(raw, '_connection', None)
+    if connection is not None:
+        sock = getattr(connection, 'sock', None)
+    if sock is None:
+        fp = getattr(getattr(raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+def cancellable_get(url, cancel_token=None, **kwargs):
+    """
+    发起可取消的requests.get请求（通常配合stream=True）
+    发出请求前就在令牌上注册中止回调，收到响应后取消会立即中止连接；
+    建立连接、等待响应头期间无法中断，请求返回后立即检查是否已取消，已取消时中止响应并抛出CancelledError
+    返回: (response, handle)，调用方用完响应后需要cancel_token.unregister(handle)
+    """
+    if cancel_token is None:
+        return requests.get(url, **kwargs), None
+    cancel_token.raise_if_cancelled()
+    state = {'response': None}
+
+    def abort():
+        if state['response'] is not None:
+            abort_response(state['response'])
+
+    handle = cancel_token.register(abort)
+    try:
+        response = requests.get(url, **kwargs)
+    except BaseException:
+        cancel_token.unregister(handle)
+        raise
+    # 先记录响应再检查标记：请求期间已执行过的回调没有可中止的响应，由这里补上
+    state['response'] = response
+    if cancel_token.cancelled:
+        cancel_token.unregister(handle)
+        abort_response(response)
+        raise CancelledError("操作已取消")
+    return response, handle
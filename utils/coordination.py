@@ -0,0 +1,414 @@
+"""
+多进程协调
+多个API进程和下载工作进程之间共享的任务队列、租约（用于选主）和取消请求。
+提供两种后端：
+    sqlite:///data/coordination.db   单机多进程（同一数据目录）
+    redis://host:6379/0              多机部署，需要安装redis包
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# 进程角色：all为单进程全部功能；api只处理HTTP请求并提交任务；worker只执行任务
+ROLE_ALL = 'all'
+ROLE_API = 'api'
+ROLE_WORKER = 'worker'
+ROLES = (ROLE_ALL, ROLE_API, ROLE_WORKER)
+
+# 只在主节点运行的后台任务，非主节点每隔多少秒重新检查一次是否已成为主节点
+LEADER_RECHECK_SECONDS = 60
+
+def make_owner_id():
+    """生成实例标识：主机名:进程ID:随机后缀（同一进程内的多个实例也不会重复）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class Coordinator:
+    """
+    协调后端接口
+
+    租约（lease）: 同一名称同一时间只有一个持有者，持有者需要在过期前续约，用于选主
+    任务队列（job）: enqueue按job_id去重；claim领取任务并设置租约，工作进程退出或失联导致租约过期后，
+        任务会被其他工作进程重新领取；完成后ack删除
+    取消请求: 任务可能在其他进程中执行，取消时登记请求，由执行该任务的进程处理
+    """
+    def acquire_lease(self, name, owner, ttl):
+        """获取或续约租约，返回是否持有租约"""
+        raise NotImplementedError
+
+    def release_lease(self, name, owner):
+        """释放自己持有的租约"""
+        raise NotImplementedError
+
+    def enqueue(self, queue, job_id, payload):
+        """提交任务，job_id已存在时忽略，返回是否新提交"""
+        raise NotImplementedError
+
+    def claim(self, queue, owner, lease_seconds):
+        """领取一个任务，返回(job_id, payload)，队列为空时返回None"""
+        raise NotImplementedError
+
+    def extend(self, job_id, owner, lease_seconds):
+        """延长已领取任务的租约，返回是否仍由owner持有"""
+        raise NotImplementedError
+
+    def ack(self, job_id):
+        """任务完成，从队列删除"""
+        raise NotImplementedError
+
+    def remove_unclaimed(self, job_id):
+        """删除尚未被领取的任务，返回是否删除成功"""
+        raise NotImplementedError
+
+    def request_cancel(self, job_id):
+        """登记取消请求"""
+        raise NotImplementedError
+
+    def get_cancel_requests(self):
+        """获取所有待处理的取消请求"""
+        raise NotImplementedError
+
+    def clear_cancel_request(self, job_id):
+        """取消请求已处理"""
+        raise NotImplementedError
+
+    def get_stats(self):
+        """获取队列统计"""
+        raise NotImplementedError
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    queue TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    owner TEXT,
+    lease_expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (queue, created_at);
+CREATE TABLE IF NOT EXISTS cancel_requests (
+    job_id TEXT PRIMARY KEY,
+    requested_at REAL NOT NULL
+);
+'''
+
+class SQLiteCoordinator(Coordinator):
+    """基于SQLite文件的协调后端，适合同一台机器上的多个进程"""
+    def __init__(self, db_path='data/coordination.db'):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # 其他进程持有写锁时最多等待10秒
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SQLITE_SCHEMA)
+
+    def _transaction(self, func):
+        """在写事务中执行func(conn)，BEGIN IMMEDIATE保证跨进程的读-改-写是原子的"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(self.conn)
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+
+        def acquire(conn):
+            row = conn.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)',
+                (name, owner, now + ttl)
+            )
+            return True
+        return self._transaction(acquire)
+
+    def release_lease(self, name, owner):
+        with self.lock:
+            self.conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+    def enqueue(self, queue, job_id, payload):
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO jobs (job_id, queue, payload, created_at) VALUES (?, ?, ?, ?)',
+                (job_id, queue, json.dumps(payload, ensure_ascii=False), time.time())
+            )
+            return cursor.rowcount > 0
+
+    def claim(self, queue, owner, lease_seconds):
+        now = time.time()
+
+        def claim_one(conn):
+            row = conn.execute(
+                'SELECT job_id, payload FROM jobs WHERE queue = ? AND (owner IS NULL OR lease_expires_at < ?) '
+                'ORDER BY created_at LIMIT 1',
+                (queue, now)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                'UPDATE jobs SET owner = ?, lease_expires_at = ?, attempts = attempts + 1 WHERE job_id = ?',
+                (owner, now + lease_seconds, row[0])
+            )
+            return row[0], json.loads(row[1])
+        return self._transaction(claim_one)
+
+    def extend(self, job_id, owner, lease_seconds):
+        with self.lock:
+            cursor = self.conn.execute(
+                'UPDATE jobs SET lease_expires_at = ? WHERE job_id = ? AND owner = ?',
+                (time.time() + lease_seconds, job_id, owner)
+            )
+            return cursor.rowcount > 0
+
+    def ack(self, job_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+    def remove_unclaimed(self, job_id):
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                'DELETE FROM jobs WHERE job_id = ? AND (owner IS NULL OR lease_expires_at < ?)',
+                (job_id, now)
+            )
+            return cursor.rowcount > 0
+
+    def request_cancel(self, job_id):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cancel_requests (job_id, requested_at) VALUES (?, ?)',
+                (job_id, time.time())
+            )
+
+    def get_cancel_requests(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT job_id FROM cancel_requests').fetchall()
+        return [job_id for (job_id,) in rows]
+
+    def clear_cancel_request(self, job_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM cancel_requests WHERE job_id = ?', (job_id,))
+
+    def get_stats(self):
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT queue, SUM(CASE WHEN owner IS NULL OR lease_expires_at < ? THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN owner IS NOT NULL AND lease_expires_at >= ? THEN 1 ELSE 0 END) '
+                'FROM jobs GROUP BY queue',
+                (now, now)
+            ).fetchall()
+            leases = self.conn.execute(
+                'SELECT name, owner, expires_at FROM leases WHERE expires_at >= ?', (now,)
+            ).fetchall()
+        return {
+            'backend': 'sqlite',
+            'queues': {queue: {'queued': queued or 0, 'claimed': claimed or 0} for queue, queued, claimed in rows},
+            'leases': {name: {'owner': owner, 'expires_in': round(expires_at - now, 1)} for name, owner, expires_at in leases}
+        }
+
+# 领取任务：先把租约过期的任务放回队列，再从队列取出一个任务并登记租约
+_REDIS_CLAIM_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], job_id)
+    redis.call('RPUSH', KEYS[1], job_id)
+end
+local job_id = redis.call('RPOP', KEYS[1])
+if not job_id then
+    return nil
+end
+redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+redis.call('HSET', KEYS[3], job_id, ARGV[3])
+return {job_id, redis.call('HGET', KEYS[4], job_id)}
+'''
+
+# 只有持有者才能续约或释放租约
+_REDIS_RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+_REDIS_RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+class RedisCoordinator(Coordinator):
+    """基于Redis（或兼容Redis协议的服务）的协调后端，适合多机部署"""
+    def __init__(self, url, prefix='xyz'):
+        if redis is None:
+            raise RuntimeError("使用Redis协调后端需要安装redis包: pip install redis")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.claim_script = self.client.register_script(_REDIS_CLAIM_SCRIPT)
+        self.renew_script = self.client.register_script(_REDIS_RENEW_SCRIPT)
+        self.release_script = self.client.register_script(_REDIS_RELEASE_SCRIPT)
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def acquire_lease(self, name, owner, ttl):
+        key = self._key('lease', name)
+        ttl_ms = int(ttl * 1000)
+        if self.client.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        return bool(self.renew_script(keys=[key], args=[owner, ttl_ms]))
+
+    def release_lease(self, name, owner):
+        self.release_script(keys=[self._key('lease', name)], args=[owner])
+
+    def enqueue(self, queue, job_id, payload):
+        if not self.client.hsetnx(self._key('jobs'), job_id, json.dumps(payload, ensure_ascii=False)):
+            return False
+        self.client.hset(self._key('job_queue'), job_id, queue)
+        self.client.lpush(self._key('queue', queue), job_id)
+        return True
+
+    def claim(self, queue, owner, lease_seconds):
+        now = time.time()
+        result = self.claim_script(
+            keys=[self._key('queue', queue), self._key('claims', queue), self._key('owners'), self._key('jobs')],
+            args=[now, now + lease_seconds, owner]
+        )
+        if not result:
+            return None
+        job_id, payload = result
+        return job_id, json.loads(payload) if payload else {}
+
+    def extend(self, job_id, owner, lease_seconds):
+        if self.client.hget(self._key('owners'), job_id) != owner:
+            return False
+        queue = self.client.hget(self._key('job_queue'), job_id)
+        if not queue:
+            return False
+        self.client.zadd(self._key('claims', queue), {job_id: time.time() + lease_seconds}, xx=True)
+        return True
+
+    def ack(self, job_id):
+        queue = self.client.hget(self._key('job_queue'), job_id)
+        pipe = self.client.pipeline()
+        if queue:
+            pipe.zrem(self._key('claims', queue), job_id)
+            pipe.lrem(self._key('queue', queue), 0, job_id)
+        pipe.hdel(self._key('jobs'), job_id)
+        pipe.hdel(self._key('job_queue'), job_id)
+        pipe.hdel(self._key('owners'), job_id)
+        pipe.execute()
+
+    def remove_unclaimed(self, job_id):
+        queue = self.client.hget(self._key('job_queue'), job_id)
+        if not queue or not self.client.lrem(self._key('queue', queue), 0, job_id):
+            return False
+        self.ack(job_id)
+        return True
+
+    def request_cancel(self, job_id):
+        self.client.sadd(self._key('cancel_requests'), job_id)
+
+    def get_cancel_requests(self):
+        return list(self.client.smembers(self._key('cancel_requests')))
+
+    def clear_cancel_request(self, job_id):
+        self.client.srem(self._key('cancel_requests'), job_id)
+
+    def get_stats(self):
+        queues = {}
+        for job_id, queue in self.client.hgetall(self._key('job_queue')).items():
+            queues.setdefault(queue, {'queued': 0, 'claimed': 0})
+        for queue in queues:
+            queues[queue]['queued'] = self.client.llen(self._key('queue', queue))
+            queues[queue]['claimed'] = self.client.zcard(self._key('claims', queue))
+        return {'backend': 'redis', 'queues': queues}
+
+def create_coordinator(url):
+    """
+    根据URL创建协调后端
+    url为空时返回None（单进程模式，不需要协调）
+    """
+    if not url:
+        return None
+    if url.startswith('sqlite:///'):
+        return SQLiteCoordinator(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCoordinator(url)
+    raise ValueError(f"不支持的协调后端: {url}")
+
+class LeaderElection:
+    """
+    基于租约的选主
+    后台线程定期获取或续约租约，持有租约的进程为主节点（例如负责执行监听检查）
+    """
+    def __init__(self, coordinator, name, owner=None, ttl=30.0):
+        self.coordinator = coordinator
+        self.name = name
+        self.owner = owner or make_owner_id()
+        self.ttl = ttl
+        self.is_leader = False
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """启动续约线程"""
+        if self.thread:
+            return
+        self._renew()
+        self.thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """停止续约并释放租约，其他进程可以立即接替"""
+        self.stopped.set()
+        if self.is_leader:
+            try:
+                self.coordinator.release_lease(self.name, self.owner)
+            except Exception as e:
+                logger.warning(f"释放租约失败: {str(e)}")
+        self.is_leader = False
+
+    def _renew(self):
+        try:
+            leader = self.coordinator.acquire_lease(self.name, self.owner, self.ttl)
+        except Exception as e:
+            # 无法确认租约时按非主节点处理，避免出现两个主节点
+            logger.warning(f"续约失败: {str(e)}")
+            leader = False
+        if leader != self.is_leader:
+            logger.info(f"{'成为' if leader else '不再是'}主节点 - {self.name}, 进程: {self.owner}")
+        self.is_leader = leader
+
+    def _run(self):
+        # 在租约过期前续约
+        while not self.stopped.wait(self.ttl / 3):
+            self._renew()
@@ -0,0 +1,273 @@
+"""
+派生文件缓存
+按 (file_id, 格式, 比特率) 缓存转换后的文件，保留原始文件，
+超过容量上限时按最近最少使用（LRU）淘汰
+"""
+import os
+import json
+import time
+import weakref
+import threading
+import logging
+from contextlib import contextmanager
+from collections import OrderedDict
+from utils.audio_converter import AUDIO_FORMATS, get_audio_format, can_remux, convert_audio
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，只支持单进程
+    fcntl = None
+
+class DerivativeCache:
+    def __init__(self, cache_folder='cache/derivatives', max_bytes=2 * 1024 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_folder, 'index.json')
+        # 多个进程共享缓存目录时，用文件锁串行化对index.json的读改写
+        self.lock_file = f"{self.index_file}.lock"
+        os.makedirs(cache_folder, exist_ok=True)
+        self.lock = threading.Lock()
+        # 同一派生文件只生成一次，其他请求等待生成结果；没有请求使用的锁自动移除
+        self.key_locks = weakref.WeakValueDictionary()
+        # 正在后台生成的缓存键（见prefetch）
+        self.prefetching = set()
+        self.stats = {'hits': 0, 'misses': 0, 'remuxed': 0, 'encoded': 0, 'evicted': 0}
+        self._load_index()
+
+    @contextmanager
+    def _file_lock(self):
+        """跨进程的索引文件锁（调用方需持有self.lock）"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        """读取磁盘上的缓存索引"""
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"加载派生缓存索引失败: {str(e)}")
+            return {}
+
+    def _set_entries(self, entries):
+        """按最近访问时间恢复LRU顺序，忽略文件已不存在的缓存项"""
+        ordered = sorted(entries.items(), key=lambda kv: kv[1].get('last_access', 0))
+        self.entries = OrderedDict(
+            (key, entry) for key, entry in ordered if os.path.exists(entry.get('path', ''))
+        )
+        self.total_bytes = sum(entry.get('size', 0) for entry in self.entries.values())
+
+    def _load_index(self):
+        """加载缓存索引"""
+        self.entries = OrderedDict()
+        with self.lock:
+            with self._file_lock():
+                self._set_entries(self._read_index())
+
+    def _merge_index(self):
+        """
+        合并其他进程写入索引的缓存项（调用方需持有self.lock和文件锁）
+        两边都有的缓存项保留较新的一份；已被删除文件的缓存项丢弃
+        """
+        entries = self._read_index()
+        for key, entry in self.entries.items():
+            other = entries.get(key)
+            if not other or other.get('created_at', 0) <= entry.get('created_at', 0):
+                entries[key] = entry
+            else:
+                other['last_access'] = max(other.get('last_access', 0), entry.get('last_access', 0))
+        self._set_entries(entries)
+
+    def _write_index(self):
+        """写入缓存索引（调用方需持有self.lock和文件锁）"""
+        temp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(temp_file, self.index_file)
+
+    def _save_index(self, keep=None):
+        """合并磁盘上的索引，超过容量时淘汰，再保存（调用方需持有self.lock）"""
+        with self._file_lock():
+            self._merge_index()
+            self._evict(keep=keep)
+            self._write_index()
+
+    @staticmethod
+    def make_key(file_id, target_format, bitrate=None):
+        """缓存键：file_id + 编码格式 + 比特率"""
+        return f"{file_id}.{target_format}.{bitrate or 'auto'}"
+
+    def get(self, file_id, source_path, target_format, bitrate=None):
+        """
+        获取派生文件，不存在时生成
+        源文件与目标编码兼容时只换封装（remux），否则重新编码
+
+        返回: (success, derivative_path, error_message)
+        """
+        if target_format not in AUDIO_FORMATS:
+            return False, None, f"不支持的格式: {target_format}"
+        if not os.path.exists(source_path):
+            return False, None, "源文件不存在"
+
+        key = self.make_key(file_id, target_format, bitrate)
+        source_stat = os.stat(source_path)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                path = self._cached_path(key, source_stat)
+                if path:
+                    return True, path, None
+                self.stats['misses'] += 1
+
+            output_path = os.path.join(self.cache_folder, f"{key}.{AUDIO_FORMATS[target_format]['ext']}")
+            remux = can_remux(source_path, target_format, bitrate)
+            logger.info(f"生成派生文件 - 文件ID: {file_id}, 格式: {target_format}, 比特率: {bitrate or 'auto'}, 方式: {'remux' if remux else 'encode'}")
+            success, output_path, error = convert_audio(
+                source_path, output_path, target_format,
+                bitrate=None if remux else bitrate,
+                remux=remux
+            )
+            if not success:
+                return False, None, error
+
+            with self.lock:
+                size = os.path.getsize(output_path)
+                self.entries[key] = {
+                    'file_id': file_id,
+                    'format': target_format,
+                    'bitrate': bitrate,
+                    'path': output_path,
+                    'size': size,
+                    'remuxed': remux,
+                    'source_size': source_stat.st_size,
+                    'source_mtime': source_stat.st_mtime,
+                    'created_at': time.time(),
+                    'last_access': time.time()
+                }
+                self.total_bytes += size
+                self.stats['remuxed' if remux else 'encoded'] += 1
+                self._save_index(keep=key)
+            return True, output_path, None
+
+    def _cached_path(self, key, source_stat):
+        """
+        有效的派生文件路径，记录一次命中；没有或源文件已变化时返回None（调用方需持有self.lock）
+        """
+        entry = self.entries.get(key)
+        if not entry:
+            # 可能由其他进程生成
+            with self._file_lock():
+                self._merge_index()
+            entry = self.entries.get(key)
+        if (entry and os.path.exists(entry['path'])
+                and entry.get('source_size') == source_stat.st_size
+                and entry.get('source_mtime') == source_stat.st_mtime):
+            entry['last_access'] = time.time()
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry['path']
+        if entry:
+            # 源文件已变化，旧的派生文件失效
+            self._remove_entry(key)
+        return None
+
+    def lookup(self, file_id, source_path, target_format, bitrate=None):
+        """只查询已生成的派生文件，不生成；返回路径，没有时返回None"""
+        if target_format not in AUDIO_FORMATS or not os.path.exists(source_path):
+            return None
+        key = self.make_key(file_id, target_format, bitrate)
+        with self.lock:
+            return self._cached_path(key, os.stat(source_path))
+
+    def prefetch(self, file_id, source_path, target_format, bitrate=None):
+        """
+        在后台线程中生成派生文件，调用方不等待（例如先回源流式转换，下次请求命中缓存）
+        返回: 是否启动了生成（同一派生文件正在生成时不重复启动）
+        """
+        key = self.make_key(file_id, target_format, bitrate)
+        with self.lock:
+            if key in self.prefetching:
+                return False
+            self.prefetching.add(key)
+
+        def run():
+            try:
+                success, _, error = self.get(file_id, source_path, target_format, bitrate)
+                if not success:
+                    logger.warning(f"后台生成派生文件失败 - 文件ID: {file_id}, 错误: {error}")
+            except Exception as e:
+                logger.warning(f"后台生成派生文件失败 - 文件ID: {file_id}, 错误: {str(e)}")
+            finally:
+                with self.lock:
+                    self.prefetching.discard(key)
+
+        threading.Thread(target=run, name=f"derivative-{key}", daemon=True).start()
+        return True
+
+    def _remove_entry(self, key):
+        """删除缓存项及其文件（调用方需持有self.lock）"""
+        entry = self.entries.pop(key, None)
+        if not entry:
+            return
+        self.total_bytes -= entry.get('size', 0)
+        try:
+            if os.path.exists(entry['path']):
+                os.remove(entry['path'])
+        except OSError as e:
+            logger.warning(f"删除派生文件失败: {entry['path']}, 错误: {str(e)}")
+
+    def _evict(self, keep=None):
+        """超过容量上限时淘汰最久未访问的派生文件（调用方需持有self.lock）"""
+        while self.total_bytes > self.max_bytes and self.entries:
+            oldest_key = next(iter(self.entries))
+            if oldest_key == keep:
+                if len(self.entries) == 1:
+                    break
+                self.entries.move_to_end(oldest_key)
+                continue
+            logger.info(f"派生缓存超出容量，淘汰: {oldest_key}")
+            self._remove_entry(oldest_key)
+            self.stats['evicted'] += 1
+
+    def invalidate(self, file_id):
+        """删除某个文件的所有派生文件（源文件被删除或替换时调用）"""
+        with self.lock:
+            with self._file_lock():
+                self._merge_index()
+                keys = [key for key, entry in self.entries.items() if entry.get('file_id') == file_id]
+                for key in keys:
+                    self._remove_entry(key)
+                if keys:
+                    self._write_index()
+        return len(keys)
+
+    def get_stats(self):
+        """获取缓存统计"""
+        with self.lock:
+            return {
+                **self.stats,
+                'entries': len(self.entries),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+def needs_derivative(file_path, target_format, bitrate=None):
+    """判断请求的格式是否与原文件不同，需要使用派生文件"""
+    if not target_format:
+        return False
+    return bool(bitrate) or get_audio_format(file_path) != target_format
@@ -0,0 +1,136 @@
+"""
+下载列表索引
+在内存中维护按下载时间排序的下载列表和每个条目的变更版本，分页查询不需要遍历和排序全部元数据；
+客户端用上次得到的版本号请求增量变化（新增、修改、删除的条目）
+版本号是单调递增的微秒时间戳，同一下载目录的多个进程之间可以比较
+"""
+import time
+import copy
+import bisect
+
+def _now_version():
+    return time.time_ns() // 1000
+
+def entry_owners(info):
+    """条目的所有者：同一文件被多个用户下载时只保存一份，由owners记录引用它的用户（旧数据只有username）"""
+    return info.get('owners') or [info.get('username') or 'unknown']
+
+class DownloadIndex:
+    def __init__(self, max_tombstones=10000):
+        """
+        参数:
+            max_tombstones: 保留的删除记录数，更早的删除无法增量同步，客户端需要重新加载
+        """
+        self.max_tombstones = max_tombstones
+        # file_id -> (版本, 元数据快照)，条目变化时移到末尾，字典顺序即版本顺序
+        self.entries = {}
+        # 按 (下载时间, file_id) 升序排列
+        self.order = []
+        # 用户名 -> 该用户拥有的条目（共享的文件在每个所有者下各出现一次），排序同上
+        self.user_order = {}
+        # [(版本, file_id)]，按版本升序
+        self.tombstones = []
+        self.version = _now_version()
+        # 早于该版本的增量请求需要重新加载（索引建立前或删除记录已被清理）
+        self.base_version = self.version
+
+    @staticmethod
+    def _key(file_id, info):
+        return (info.get('downloaded_at') or '', file_id)
+
+    def _next_version(self):
+        # 系统时间回拨时仍保持递增
+        self.version = max(self.version + 1, _now_version())
+        return self.version
+
+    def _insert(self, file_id, info):
+        key = self._key(file_id, info)
+        bisect.insort(self.order, key)
+        for username in entry_owners(info):
+            bisect.insort(self.user_order.setdefault(username, []), key)
+
+    def _remove(self, file_id, info):
+        key = self._key(file_id, info)
+        owners = entry_owners(info)
+        for keys in [self.order] + [self.user_order.get(username, []) for username in owners]:
+            index = bisect.bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+        for username in owners:
+            if username in self.user_order and not self.user_order[username]:
+                del self.user_order[username]
+
+    def sync(self, metadata):
+        """
+        与元数据对比，为新增、修改、删除的条目分配新版本（调用方需持有下载管理器的锁）
+        返回: 变化的条目数
+        """
+        changed = 0
+        for file_id, info in metadata.items():
+            entry = self.entries.get(file_id)
+            if entry is not None and entry[1] == info:
+                continue
+            if entry is not None:
+                self._remove(file_id, entry[1])
+                del self.entries[file_id]
+            snapshot = copy.deepcopy(info)
+            self.entries[file_id] = (self._next_version(), snapshot)
+            self._insert(file_id, snapshot)
+            changed += 1
+        for file_id in [file_id for file_id in self.entries if file_id not in metadata]:
+            _, info = self.entries.pop(file_id)
+            self._remove(file_id, info)
+            self.tombstones.append((self._next_version(), file_id))
+            changed += 1
+        if len(self.tombstones) > self.max_tombstones:
+            dropped = self.tombstones[:-self.max_tombstones]
+            self.tombstones = self.tombstones[-self.max_tombstones:]
+            self.base_version = dropped[-1][0]
+        return changed
+
+    def users(self):
+        """有下载记录的用户名（排序）"""
+        return sorted(self.user_order)
+
+    def page(self, offset=0, limit=50, username=None, exists=None):
+        """
+        按下载时间倒序分页
+        exists: 可选的文件存在性检查 exists(info)，只对本页的条目调用，不存在的条目不返回
+        返回: (本页条目列表 [{'file_id', 'version', ...}], 总数)
+        """
+        keys = self.order if username is None else self.user_order.get(username, [])
+        total = len(keys)
+        start = max(0, total - offset - limit)
+        end = max(0, total - offset)
+        items = []
+        for _, file_id in reversed(keys[start:end]):
+            version, info = self.entries[file_id]
+            if exists and not exists(info):
+                continue
+            items.append({'file_id': file_id, **copy.deepcopy(info), 'version': version})
+        return items, total
+
+    def changes_since(self, since, username=None):
+        """
+        获取版本since之后的变化
+        返回: (新增或修改的条目列表, 删除的file_id列表)；since早于可增量同步的版本时返回None
+        """
+        if since < self.base_version:
+            return None
+        upserted = []
+        deleted = []
+        # 从最新的条目往前找，遇到不晚于since的条目即可停止
+        for file_id in reversed(self.entries):
+            version, info = self.entries[file_id]
+            if version <= since:
+                break
+            if username is None or username in entry_owners(info):
+                upserted.append({'file_id': file_id, **copy.deepcopy(info), 'version': version})
+            else:
+                # 该用户不再拥有此条目，从按用户过滤的列表中移除
+                deleted.append(file_id)
+        index = bisect.bisect_right(self.tombstones, since, key=lambda tombstone: tombstone[0])
+        # 删除后又重新添加的条目已在upserted中
+        deleted.extend(file_id for _, file_id in self.tombstones[index:] if file_id not in self.entries)
+        upserted.sort(key=lambda item: self._key(item['file_id'], item), reverse=True)
+        return upserted, deleted
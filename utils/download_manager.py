@@ -2,16 +2,55 @@
 下载管理器
 """
 import os
-import requests
 import hashlib
 from datetime import datetime
 import json
 import re
+import threading
+import logging
+from contextlib import contextmanager
+from utils.cancellation import CancelledError, cancellable_get
+from utils.download_index import DownloadIndex, entry_owners
+from utils.library_layout import LibraryLayout
+from utils.storage_quota import StorageQuota, QuotaExceededError
+from utils.storage_backend import LocalStorage, STORAGE_LOCAL, entry_storage
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，只支持单进程
+    fcntl = None
 
 class DownloadManager:
-    def __init__(self, download_folder='downloads'):
+    def __init__(self, download_folder='downloads', layout='', quota=None, storage=None):
+        """
+        参数:
+            download_folder: 下载目录
+            layout: 目录布局（见LibraryLayout），为空时文件直接保存在下载目录中
+            quota: 可选的StorageQuota，超出配额时淘汰最久未使用的文件，默认不限制
+            storage: 新文件使用的存储后端（见storage_backend），默认保存在下载目录中
+        """
         self.download_folder = download_folder
+        self.layout = LibraryLayout(download_folder, layout)
+        # 已有条目按元数据中的storage字段找到所在的后端，本地后端始终可用
+        self.storage = storage or LocalStorage(download_folder)
+        self.backends = {STORAGE_LOCAL: LocalStorage(download_folder), self.storage.name: self.storage}
         self.metadata_file = os.path.join(download_folder, 'metadata.json')
+        # 保护元数据的读改写，后台任务和请求线程会并发修改
+        self.lock = threading.RLock()
+        # 多个进程共享下载目录时，用文件锁串行化对metadata.json的读改写
+        self.lock_file = f"{self.metadata_file}.lock"
+        self._file_lock_handle = None
+        self._file_lock_depth = 0
+        self.metadata_mtime = None
+        # 按下载时间排序的列表索引和变更版本，元数据加载或保存后同步
+        self.index = DownloadIndex()
+        # 配额和按使用时间排序的淘汰索引，同上
+        self.quota = quota or StorageQuota()
+        # 可选回调 on_evict(file_id)，文件因配额被淘汰后调用（例如清理派生缓存）
+        self.on_evict = None
         os.makedirs(download_folder, exist_ok=True)
         self._load_metadata()
     
@@ -20,13 +59,337 @@ class DownloadManager:
         if os.path.exists(self.metadata_file):
             with open(self.metadata_file, 'r', encoding='utf-8') as f:
                 self.metadata = json.load(f)
+            self.metadata_mtime = os.stat(self.metadata_file).st_mtime_ns
         else:
             self.metadata = {}
+            self.metadata_mtime = None
+        self.index.sync(self.metadata)
+        self.quota.sync(self.metadata)
+    
+    def _refresh_metadata(self):
+        """其他进程修改了metadata.json时重新加载"""
+        with self.lock:
+            try:
+                mtime = os.stat(self.metadata_file).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self.metadata_mtime:
+                self._load_metadata()
+    
+    @contextmanager
+    def _file_lock(self):
+        """跨进程的元数据文件锁（可重入，调用方需持有self.lock）"""
+        if fcntl is None:
+            yield
+            return
+        if self._file_lock_depth == 0:
+            self._file_lock_handle = open(self.lock_file, 'a')
+            fcntl.flock(self._file_lock_handle, fcntl.LOCK_EX)
+        self._file_lock_depth += 1
+        try:
+            yield
+        finally:
+            self._file_lock_depth -= 1
+            if self._file_lock_depth == 0:
+                fcntl.flock(self._file_lock_handle, fcntl.LOCK_UN)
+                self._file_lock_handle.close()
+                self._file_lock_handle = None
+    
+    @contextmanager
+    def metadata_transaction(self):
+        """
+        修改元数据的事务：持有线程锁和跨进程文件锁，先加载其他进程写入的变化，正常退出时保存；
+        出现异常时丢弃内存中的部分修改，重新加载磁盘上的元数据
+        用法:
+            with download_manager.metadata_transaction() as metadata:
+                metadata[file_id] = {...}
+        """
+        with self.lock:
+            with self._file_lock():
+                self._refresh_metadata()
+                try:
+                    yield self.metadata
+                except BaseException:
+                    self._load_metadata()
+                    raise
+                self._save_metadata()
     
     def _save_metadata(self):
-        """保存下载元数据"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        """保存下载元数据（先写临时文件再替换，避免写入中断导致文件损坏）"""
+        with self.lock:
+            with self._file_lock():
+                temp_file = f"{self.metadata_file}.tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+                os.replace(temp_file, self.metadata_file)
+                self.metadata_mtime = os.stat(self.metadata_file).st_mtime_ns
+                self.index.sync(self.metadata)
+                self.quota.sync(self.metadata)
+    
+    def get_file_info(self, file_id):
+        """获取文件元数据（副本），不存在时返回None"""
+        with self.lock:
+            self._refresh_metadata()
+            info = self.metadata.get(file_id)
+            return dict(info) if info else None
+    
+    def set_file_info(self, file_id, info):
+        """添加或替换文件元数据并保存"""
+        with self.metadata_transaction() as metadata:
+            metadata[file_id] = info
+    
+    def update_file_info(self, file_id, expected_path=None, **fields):
+        """
+        原子地更新文件元数据并保存
+        expected_path: 可选，只有元数据中的file_path仍为该值时才更新（防止与并发的删除/转换冲突）
+        返回: 是否更新成功
+        """
+        with self.lock:
+            with self._file_lock():
+                self._refresh_metadata()
+                info = self.metadata.get(file_id)
+                if not info:
+                    return False
+                if expected_path is not None and info.get('file_path') != expected_path:
+                    return False
+                info.update(fields)
+                self._save_metadata()
+                return True
+    
+    def replace_converted_file(self, file_id, file_path, converted_path):
+        """
+        用转换结果替换原文件：元数据仍指向file_path且只有一个所有者时才更新元数据，之后再删除原文件；
+        转换期间文件被其他用户共享、删除或替换时删除转换结果，原文件和元数据保持不变
+        返回: 是否已替换
+        """
+        with self.lock:
+            with self._file_lock():
+                self._refresh_metadata()
+                info = self.metadata.get(file_id)
+                replaced = bool(info and info.get('file_path') == file_path and len(entry_owners(info)) <= 1)
+                if replaced:
+                    with self.metadata_transaction() as metadata:
+                        metadata[file_id].update(
+                            filename=os.path.basename(converted_path),
+                            file_path=converted_path,
+                            size=os.path.getsize(converted_path),
+                            downloaded_at=datetime.now().isoformat()
+                        )
+        if not replaced:
+            if converted_path != file_path and os.path.exists(converted_path):
+                os.remove(converted_path)
+            return False
+        # 元数据已指向转换结果，删除原始文件
+        try:
+            if file_path != converted_path and os.path.exists(file_path):
+                os.remove(file_path)
+                logger.info(f"已删除原始文件: {file_path}")
+        except OSError as e:
+            logger.warning(f"删除原始文件失败: {file_path}, 错误: {str(e)}")
+        return True
+    
+    @staticmethod
+    def _release(info, username):
+        """从元数据中移除一个所有者（调用方需确认还有其他所有者）"""
+        owners = [owner for owner in entry_owners(info) if owner != username]
+        info['owners'] = owners
+        if info.get('username') not in owners:
+            info['username'] = owners[0]
+    
+    def _evict(self, victims):
+        """
+        执行配额淘汰（调用方需持有锁，并负责保存元数据）
+        victims: plan_eviction的结果，{file_id: 用户名或None}
+        返回: 被删除的file_id列表（只移除引用的不包括在内）
+        """
+        deleted = []
+        for file_id, username in victims.items():
+            info = self.metadata[file_id]
+            if username is not None and len(entry_owners(info)) > 1:
+                self._release(info, username)
+                self.quota.update(file_id, info)
+                self.quota.record_release()
+                logger.info(f"超出存储配额，移除用户对共享文件的引用 - 文件ID: {file_id}, 用户: {username}")
+                continue
+            del self.metadata[file_id]
+            self.quota.discard(file_id)
+            self.quota.record_eviction(info.get('size') or 0)
+            self._delete_stored(info)
+            logger.info(f"超出存储配额，淘汰最久未使用的文件 - 文件ID: {file_id}, 文件: {info['file_path']}")
+            deleted.append(file_id)
+        return deleted
+    
+    def _backend_for(self, info):
+        """条目所在的存储后端，未配置该后端时返回None"""
+        return self.backends.get(entry_storage(info))
+    
+    def _file_exists(self, info):
+        backend = self._backend_for(info)
+        return backend is not None and backend.exists(info)
+    
+    def _delete_stored(self, info):
+        """删除条目对应的文件或对象"""
+        backend = self._backend_for(info)
+        if backend is None:
+            logger.warning(f"未配置存储后端 {entry_storage(info)}，无法删除: {info['file_path']}")
+            return
+        try:
+            backend.delete(info)
+        except Exception as e:
+            logger.warning(f"删除文件失败: {info['file_path']}, 错误: {e}")
+    
+    def is_local(self, info):
+        """条目是否保存在本地下载目录中（格式转换、存储分层等需要本地文件）"""
+        return entry_storage(info) == STORAGE_LOCAL
+    
+    def get_download_url(self, info, content_disposition=None, content_type=None):
+        """保存在对象存储中的条目的预签名下载URL，本地文件返回None"""
+        backend = self._backend_for(info)
+        if backend is None:
+            return None
+        return backend.get_download_url(info, content_disposition, content_type)
+    
+    def _offload(self, info):
+        """
+        新文件使用远程存储时，把已保存在本地的文件（例如代理下载、边下载边转换保存的文件）上传后删除本地文件
+        上传失败时保留本地文件
+        """
+        if self.storage.name == STORAGE_LOCAL or not self.is_local(info) or not os.path.exists(info['file_path']):
+            return info
+        try:
+            stored = self.storage.upload_file(info['file_path'], info['file_path'])
+        except Exception as e:
+            logger.warning(f"上传到{self.storage.name}失败，保留本地文件: {info['file_path']}, 错误: {e}", exc_info=True)
+            return info
+        os.remove(info['file_path'])
+        return dict(info, **stored)
+    
+    def _notify_evicted(self, file_ids):
+        if self.on_evict:
+            for file_id in file_ids:
+                self.on_evict(file_id)
+    
+    def make_room(self, username, size, exclude=()):
+        """
+        为用户即将保存的size字节腾出配额空间，必要时淘汰最久未使用的未固定文件
+        exclude: 不能淘汰的file_id
+        返回: 是否有足够空间（淘汰所有未固定的文件也放不下时不淘汰任何文件，返回False）
+        """
+        deleted = []
+        with self.lock:
+            with self._file_lock():
+                self._refresh_metadata()
+                victims = self.quota.plan_eviction(username or 'unknown', size, exclude)
+                if victims is None:
+                    self.quota.record_rejection()
+                    return False
+                if victims:
+                    deleted = self._evict(victims)
+                    self._save_metadata()
+        self._notify_evicted(deleted)
+        return True
+    
+    def add_file(self, file_id, info):
+        """
+        登记已保存到下载目录的文件：超出配额时先淘汰其他最久未使用的文件，
+        仍然放不下时删除该文件，不登记
+        已有其他用户保存了同一文件时合并所有者；并发下载产生了两份时保留先登记的一份，删除新文件
+        返回: 是否登记成功
+        """
+        info = self._offload(info)
+        new_info = info
+        new_path = info['file_path']
+        username = info.get('username') or 'unknown'
+        duplicate = False
+        deleted = []
+        with self.lock:
+            with self._file_lock():
+                self._refresh_metadata()
+                previous = self.metadata.get(file_id)
+                if previous:
+                    owners = entry_owners(previous)
+                    owners = owners + [owner for owner in entry_owners(info) if owner not in owners]
+                    if previous['file_path'] != new_path and self._file_exists(previous):
+                        duplicate = True
+                        info = previous
+                    info = dict(info, owners=owners, username=owners[0])
+                self.quota.update(file_id, info)
+                victims = self.quota.plan_eviction(username, 0, (file_id,))
+                if victims is None:
+                    if previous:
+                        self.quota.update(file_id, previous)
+                    else:
+                        self.quota.discard(file_id)
+                    self.quota.record_rejection()
+                else:
+                    deleted = self._evict(victims)
+                    self.metadata[file_id] = info
+                    self._save_metadata()
+        if duplicate or victims is None:
+            if not previous or previous['file_path'] != new_path:
+                self._delete_stored(new_info)
+        if victims is None:
+            logger.warning(f"超出存储配额，未保存文件: {new_path}")
+            return False
+        self._notify_evicted(deleted)
+        return True
+    
+    def add_owner(self, file_id, username):
+        """
+        为已保存的文件增加一个所有者（引用），同一节目只下载、保存一份
+        返回: 文件元数据；未保存过或文件已不存在时返回None
+        该用户超出配额且无法腾出空间时抛出QuotaExceededError
+        """
+        username = username or 'unknown'
+        with self.lock:
+            with self._file_lock():
+                self._refresh_metadata()
+                info = self.metadata.get(file_id)
+                if not info or not self._file_exists(info):
+                    return None
+                owners = entry_owners(info)
+                if username in owners:
+                    return dict(info)
+                updated = dict(info, owners=owners + [username])
+                self.quota.update(file_id, updated)
+                victims = self.quota.plan_eviction(username, 0, (file_id,))
+                if victims is None:
+                    self.quota.update(file_id, info)
+                    self.quota.record_rejection()
+                    raise QuotaExceededError(f"超出存储配额: {username}")
+                deleted = self._evict(victims)
+                self.metadata[file_id] = updated
+                self._save_metadata()
+        self._notify_evicted(deleted)
+        return dict(updated)
+    
+    def touch(self, file_id, min_interval=600):
+        """
+        记录文件被播放/下载的时间，作为配额淘汰的依据
+        min_interval: 距上次记录不足该秒数时不更新（播放器拖动进度会产生大量请求，避免频繁写入元数据）
+        """
+        info = self.get_file_info(file_id)
+        if not info:
+            return
+        now = datetime.now()
+        last_accessed = info.get('last_accessed')
+        if last_accessed:
+            try:
+                if (now - datetime.fromisoformat(last_accessed)).total_seconds() < min_interval:
+                    return
+            except ValueError:
+                pass
+        self.update_file_info(file_id, last_accessed=now.isoformat())
+    
+    def set_pinned(self, file_id, pinned=True):
+        """固定或取消固定文件，固定的文件不会因配额被淘汰；返回: 文件是否存在"""
+        return self.update_file_info(file_id, pinned=bool(pinned))
+    
+    def get_quota_status(self):
+        """获取配额和各用户的占用情况"""
+        with self.lock:
+            self._refresh_metadata()
+            return self.quota.get_status()
     
     def _get_file_id(self, url):
         """生成文件ID"""
@@ -50,6 +413,19 @@ class DownloadManager:
             filename = filename[:200]
         return filename or 'episode'
     
+    def get_unique_path(self, file_id, filename, username=None, episode_info=None):
+        """按目录布局为文件生成不冲突的保存路径（会创建所在目录）"""
+        folder = self.layout.directory_for(file_id, username, episode_info)
+        os.makedirs(folder, exist_ok=True)
+        file_path = os.path.join(folder, filename)
+        base_name, file_ext = os.path.splitext(filename)
+        counter = 1
+        # 本地保存后可能再上传到对象存储，同名对象也视为冲突
+        while self.storage.path_taken(file_path):
+            file_path = os.path.join(folder, f"{base_name}_{counter}{file_ext}")
+            counter += 1
+        return file_path
+    
     def _get_file_extension(self, url, content_type=None):
         """获取文件扩展名"""
         # 先尝试从URL获取
@@ -73,19 +449,34 @@ class DownloadManager:
         # 默认返回mp3
         return 'mp3'
     
-    def download_file(self, url, filename=None, episode_info=None, username=None):
+    def download_file(self, url, filename=None, episode_info=None, username=None, cancel_token=None,
+                      raise_errors=False, progress_callback=None):
         """
         下载文件
+        cancel_token: 可选的CancelToken，取消时立即中断连接并删除未完成的文件
+        raise_errors: True时不吞掉异常，由调用方根据异常类型决定是否重试
+        progress_callback: 可选回调 progress_callback(downloaded, total)，收到响应头后先以downloaded=0调用一次，
+            之后每写入一块数据调用一次；total为Content-Length，未知时为None
         返回: (success, file_id, file_path)
         """
+        response = None
+        abort_handle = None
+        writer = None
         try:
             file_id = self._get_file_id(url)
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            
+            # 其他用户已下载过同一节目时只增加引用，不重复下载
+            existing = self.add_owner(file_id, username)
+            if existing:
+                return True, file_id, existing['file_path']
             
             # 下载文件前先获取Content-Type
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
-            response = requests.get(url, headers=headers, stream=True, timeout=30)
+            response, abort_handle = cancellable_get(url, cancel_token, headers=headers, stream=True, timeout=30)
             response.raise_for_status()
             
             # 获取文件扩展名
@@ -106,108 +497,166 @@ class DownloadManager:
                     else:
                         filename = f'{file_id}.{file_ext}'
             
-            # 处理文件名冲突：如果同名文件已存在但是不同的URL，添加数字后缀
+            # 按目录布局确定保存目录
+            folder = self.layout.directory_for(file_id, username, episode_info)
+            
+            # 处理文件名冲突：同名文件属于其他URL（同一URL已在上面直接返回），添加数字后缀
             original_filename = filename
-            file_path = os.path.join(self.download_folder, filename)
+            file_path = os.path.join(folder, filename)
             counter = 1
             
-            while os.path.exists(file_path):
-                # 检查是否是同一个文件（通过file_id）
-                existing_file_id = None
-                for fid, info in self.metadata.items():
-                    if info.get('file_path') == file_path:
-                        existing_file_id = fid
-                        break
-                
-                if existing_file_id == file_id:
-                    # 是同一个文件，直接返回
-                    if file_id not in self.metadata:
-                        self.metadata[file_id] = {
-                            'url': url,
-                            'filename': filename,
-                            'file_path': file_path,
-                            'downloaded_at': datetime.now().isoformat(),
-                            'size': os.path.getsize(file_path),
-                            'episode_info': episode_info or {},
-                            'username': username or 'unknown'
-                        }
-                        self._save_metadata()
-                    return True, file_id, file_path
-                
-                # 不是同一个文件，需要重命名
+            while self.storage.path_taken(file_path):
                 base_name, ext = os.path.splitext(original_filename)
                 filename = f"{base_name}_{counter}{ext}"
-                file_path = os.path.join(self.download_folder, filename)
+                file_path = os.path.join(folder, filename)
                 counter += 1
             
-            # 保存文件
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # 保存文件：本地先写入.part临时文件，完整下载后再改名；对象存储边下载边分片上传，完成后才生成对象
+            content_length = response.headers.get('Content-Length')
+            total = int(content_length) if content_length and content_length.isdigit() else None
+            # 已知文件大小时先腾出配额空间，放不下时不开始下载
+            if total and not self.make_room(username, total, (file_id,)):
+                raise QuotaExceededError(f"超出存储配额: {username or 'unknown'}")
+            downloaded = 0
+            if progress_callback:
+                progress_callback(downloaded, total)
+            writer = self.storage.open_writer(file_path, content_type or None)
+            for chunk in response.iter_content(chunk_size=8192):
+                if cancel_token and cancel_token.cancelled:
+                    raise CancelledError("下载已取消")
+                writer.write(chunk)
+                downloaded += len(chunk)
+                if progress_callback:
+                    progress_callback(downloaded, total)
+            # 取消时连接被关闭，iter_content可能正常结束，提交前再检查一次，避免保存不完整的文件
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            stored = writer.commit()
+            size = writer.size
+            writer = None
             
-            # 保存元数据
-            self.metadata[file_id] = {
+            # 保存元数据（大小未知时在此检查配额）
+            if not self.add_file(file_id, {
                 'url': url,
                 'filename': filename,
                 'file_path': file_path,
                 'downloaded_at': datetime.now().isoformat(),
-                'size': os.path.getsize(file_path),
+                'size': size,
                 'episode_info': episode_info or {},
-                'username': username or 'unknown'  # 添加用户信息
-            }
-            self._save_metadata()
+                'username': username or 'unknown',  # 添加用户信息
+                'owners': [username or 'unknown'],
+                **stored
+            }):
+                raise QuotaExceededError(f"超出存储配额: {username or 'unknown'}")
             
             return True, file_id, file_path
         except Exception as e:
-            print(f"下载失败: {e}")
+            if cancel_token and cancel_token.cancelled:
+                logger.info(f"下载已取消: {url}")
+            else:
+                logger.exception(f"下载失败: {url}, 错误: {str(e)}")
+            if raise_errors:
+                raise
             return False, None, None
+        finally:
+            if cancel_token:
+                cancel_token.unregister(abort_handle)
+            if response is not None:
+                response.close()
+            # 清理未完成的文件或分片上传
+            if writer is not None:
+                writer.abort()
     
     def list_downloads(self, username=None):
         """
-        列出已下载的文件
+        列出已下载的文件（按下载时间倒序）
         username: 可选，如果提供则只返回该用户的下载
         """
-        downloads = []
-        for file_id, info in self.metadata.items():
-            if os.path.exists(info['file_path']):
-                # 如果指定了用户名，只返回该用户的下载
-                if username and info.get('username') != username:
-                    continue
-                downloads.append({
-                    'file_id': file_id,
-                    **info
-                })
-        # 按下载时间倒序排列
-        downloads.sort(key=lambda x: x.get('downloaded_at', ''), reverse=True)
-        return downloads
-    
-    def delete_file(self, file_id):
-        """删除文件"""
-        if file_id in self.metadata:
-            info = self.metadata[file_id]
-            file_path = info['file_path']
-            
-            # 删除文件
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            
-            # 删除元数据
-            del self.metadata[file_id]
-            self._save_metadata()
-            
-            return True
-        return False
+        with self.lock:
+            self._refresh_metadata()
+            downloads, _ = self.index.page(0, len(self.index.order), username, exists=self._file_exists)
+            return downloads
+    
+    def list_downloads_page(self, offset=0, limit=50, username=None):
+        """
+        分页列出已下载的文件（按下载时间倒序），只检查本页文件是否存在
+        返回: {'downloads', 'total', 'offset', 'limit', 'version'}
+        """
+        with self.lock:
+            self._refresh_metadata()
+            downloads, total = self.index.page(offset, limit, username, exists=self._file_exists)
+            return {
+                'downloads': downloads,
+                'total': total,
+                'offset': offset,
+                'limit': limit,
+                'version': self.index.version
+            }
+    
+    def get_changes(self, since, username=None):
+        """
+        获取版本since之后新增、修改和删除的下载
+        返回: {'version', 'reset', 'upserted', 'deleted'}；reset为True时客户端需要重新加载完整列表
+        """
+        with self.lock:
+            self._refresh_metadata()
+            changes = self.index.changes_since(since, username)
+            if changes is None:
+                return {'version': self.index.version, 'reset': True, 'upserted': [], 'deleted': []}
+            upserted, deleted = changes
+            return {
+                'version': self.index.version,
+                'reset': False,
+                'upserted': [item for item in upserted if self._file_exists(item)],
+                'deleted': deleted + [item['file_id'] for item in upserted if not self._file_exists(item)]
+            }
+    
+    def get_version(self):
+        """当前的下载列表版本"""
+        with self.lock:
+            self._refresh_metadata()
+            return self.index.version
+    
+    def delete_file(self, file_id, username=None):
+        """
+        删除文件
+        username: 可选，只移除该用户的引用，文件还有其他所有者时保留；不提供时为所有用户删除文件
+        返回: 是否成功（该用户不拥有此文件时返回False）
+        """
+        with self.lock:
+            with self._file_lock():
+                # 先在锁内检查，不需要修改时不开启事务，避免无谓地重写metadata.json
+                self._refresh_metadata()
+                info = self.metadata.get(file_id)
+                if not info:
+                    return False
+                if username is not None and username not in entry_owners(info):
+                    return False
+                with self.metadata_transaction() as metadata:
+                    info = metadata[file_id]
+                    if username is not None and len(entry_owners(info)) > 1:
+                        self._release(info, username)
+                        return True
+                    # 删除文件（删除失败时不修改元数据）
+                    backend = self._backend_for(info)
+                    if backend is not None:
+                        backend.delete(info)
+                    
+                    # 删除元数据
+                    del metadata[file_id]
+                    return True
     
-    def delete_files_batch(self, file_ids):
+    def delete_files_batch(self, file_ids, username=None):
         """
         批量删除文件
+        username: 可选，只移除该用户的引用（见delete_file）
         返回: (成功数量, 失败的文件ID列表)
         """
         success_count = 0
         failed_ids = []
         
         for file_id in file_ids:
-            if self.delete_file(file_id):
+            if self.delete_file(file_id, username):
                 success_count += 1
             else:
                 failed_ids.append(file_id)
@@ -216,9 +665,7 @@ class DownloadManager:
     
     def get_users(self):
         """获取所有用户列表"""
-        users = set()
-        for info in self.metadata.values():
-            username = info.get('username', 'unknown')
-            users.add(username)
-        return sorted(list(users))
+        with self.lock:
+            self._refresh_metadata()
+            return self.index.users()
 
@@ -0,0 +1,35 @@
+"""
+文件下载辅助
+生成与文件内容绑定的强ETag，以及把文件发送卸载给前端Web服务器（nginx X-Accel-Redirect）时的内部路径映射
+"""
+import os
+import hashlib
+from urllib.parse import quote
+
+OFFLOAD_X_ACCEL = 'x-accel'
+OFFLOAD_X_SENDFILE = 'x-sendfile'
+OFFLOAD_MODES = (OFFLOAD_X_ACCEL, OFFLOAD_X_SENDFILE)
+
+def file_etag(file_path, key=''):
+    """
+    生成强ETag：由文件标识（file_id和派生格式）、大小和修改时间决定，
+    文件被替换（转换、重新压缩）后自动变化，与文件所在路径无关
+    """
+    stat = os.stat(file_path)
+    raw = f"{key}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:32]
+
+def accel_redirect_uri(file_path, locations):
+    """
+    把本地文件路径映射为nginx internal location中的URI
+    locations: [(本地目录, URI前缀), ...]
+    返回: 已编码的URI，文件不在任何目录下时返回None
+    """
+    real_path = os.path.realpath(file_path)
+    for folder, uri_prefix in locations:
+        folder = os.path.realpath(folder)
+        if os.path.commonpath([real_path, folder]) != folder:
+            continue
+        relative = os.path.relpath(real_path, folder).replace(os.sep, '/')
+        return uri_prefix.rstrip('/') + '/' + quote(relative)
+    return None
@@ -0,0 +1,54 @@
+"""
+下载库的目录布局
+LIBRARY_LAYOUT 由 / 分隔的层级组成，决定文件保存在下载目录下的哪个子目录：
+    user     按用户
+    podcast  按节目所属的播客
+    shard    按file_id的前两位十六进制分散到256个子目录
+例如 "user/shard"、"podcast/shard"；为空时所有文件直接放在下载目录中（原有布局）
+"""
+import os
+import re
+
+LAYOUT_SEGMENTS = ('user', 'podcast', 'shard')
+
+def parse_layout(layout):
+    """解析布局字符串，包含未知层级时抛出ValueError"""
+    segments = [segment.strip().lower() for segment in (layout or '').split('/') if segment.strip()]
+    for segment in segments:
+        if segment not in LAYOUT_SEGMENTS:
+            raise ValueError(f"不支持的目录层级: {segment}（可用: {', '.join(LAYOUT_SEGMENTS)}）")
+    return segments
+
+def _safe_segment(name, default):
+    """目录名：移除路径分隔符和文件系统不允许的字符"""
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1f\x7f]', '_', name or '')
+    name = re.sub(r'\s+', ' ', name).strip('. ')[:80]
+    return name or default
+
+class LibraryLayout:
+    def __init__(self, root, layout=''):
+        self.root = root
+        self.segments = parse_layout(layout)
+
+    @property
+    def flat(self):
+        return not self.segments
+
+    def directory_for(self, file_id, username=None, episode_info=None):
+        """文件应保存的目录（不创建）"""
+        parts = []
+        for segment in self.segments:
+            if segment == 'user':
+                parts.append(_safe_segment(username, 'unknown'))
+            elif segment == 'podcast':
+                parts.append(_safe_segment((episode_info or {}).get('podcast_title'), '_unsorted'))
+            elif segment == 'shard':
+                parts.append(file_id[:2])
+        return os.path.join(self.root, *parts)
+
+    def path_for(self, file_id, filename, username=None, episode_info=None):
+        """文件应保存的路径（不创建目录）"""
+        return os.path.join(self.directory_for(file_id, username, episode_info), filename)
+
+    def describe(self):
+        return '/'.join(self.segments) or 'flat'
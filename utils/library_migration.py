@@ -0,0 +1,140 @@
+"""
+下载库目录布局迁移
+把已有文件移动到当前目录布局（DownloadManager.layout）下的位置，服务运行期间可以执行：
+每个文件先在新位置建立.part临时名的硬链接（跨文件系统时复制），持有元数据锁时改名为新路径并更新元数据，
+之后再删除旧路径，迁移过程中文件始终可读；
+临时名不会被一致性检查当作孤立文件隔离（新路径在元数据指向它之前不存在）；
+元数据在此期间被其他请求修改（删除、转换）的文件放弃迁移
+"""
+import os
+import time
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _prune_empty_dirs(folder, root):
+    """删除迁移后留下的空目录（不删除下载目录本身）"""
+    root = os.path.abspath(root)
+    folder = os.path.abspath(folder)
+    while folder != root and os.path.commonpath([folder, root]) == root:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            return
+        folder = os.path.dirname(folder)
+
+def _target_path(download_manager, file_id, info, dry_run):
+    """文件在当前布局下的位置，已在正确目录中时返回None"""
+    layout = download_manager.layout
+    folder = layout.directory_for(file_id, info.get('username'), info.get('episode_info'))
+    if os.path.abspath(os.path.dirname(info['file_path'])) == os.path.abspath(folder):
+        return None
+    filename = os.path.basename(info['file_path'])
+    if dry_run:
+        return os.path.join(folder, filename)
+    return download_manager.get_unique_path(file_id, filename, info.get('username'), info.get('episode_info'))
+
+def _commit_move(download_manager, file_id, old_path, part_path, new_path):
+    """
+    持有元数据锁，把临时文件改名为新路径并更新元数据（同一临界区内完成）
+    返回: 是否成功，元数据已不指向旧路径时返回False
+    """
+    with download_manager.lock, download_manager._file_lock():
+        download_manager._refresh_metadata()
+        info = download_manager.metadata.get(file_id)
+        if not info or info.get('file_path') != old_path:
+            return False
+        os.rename(part_path, new_path)
+        try:
+            info.update(file_path=new_path, filename=os.path.basename(new_path))
+            download_manager._save_metadata()
+        except Exception:
+            info.update(file_path=old_path, filename=os.path.basename(old_path))
+            os.rename(new_path, part_path)
+            raise
+        return True
+
+def migrate_library(download_manager, dry_run=False, pause=0.0, limit=None):
+    """
+    迁移下载库到当前目录布局
+    dry_run: 只统计需要移动的文件
+    pause: 每移动一个文件后休眠的秒数，降低对正在运行的服务的影响
+    limit: 最多移动的文件数
+    返回: 报告（检查数、移动数、跳过数、失败数、耗时）
+    """
+    started = time.time()
+    report = {
+        'layout': download_manager.layout.describe(),
+        'dry_run': dry_run,
+        'checked': 0,
+        'moved': 0,
+        'already_in_place': 0,
+        'skipped': 0,
+        'failed': 0,
+        'errors': [],
+        'duration_seconds': None
+    }
+    with download_manager.lock:
+        download_manager._refresh_metadata()
+        entries = [(file_id, dict(info)) for file_id, info in download_manager.metadata.items()]
+
+    for file_id, info in entries:
+        if limit is not None and report['moved'] >= limit:
+            break
+        report['checked'] += 1
+        old_path = info.get('file_path')
+        if not old_path or not os.path.exists(old_path):
+            report['skipped'] += 1
+            continue
+        new_path = None
+        part_path = None
+        try:
+            new_path = _target_path(download_manager, file_id, info, dry_run)
+            if new_path is None:
+                report['already_in_place'] += 1
+                continue
+            if dry_run:
+                report['moved'] += 1
+                continue
+
+            part_path = f"{new_path}.part"
+            try:
+                os.link(old_path, part_path)
+            except OSError:
+                shutil.copy2(old_path, part_path)
+            if not _commit_move(download_manager, file_id, old_path, part_path, new_path):
+                # 迁移期间文件被删除或替换
+                os.remove(part_path)
+                _prune_empty_dirs(os.path.dirname(new_path), download_manager.download_folder)
+                report['skipped'] += 1
+                continue
+            part_path = None
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                # 元数据已指向新路径，旧路径可能已被一致性检查当作孤立文件隔离
+                pass
+            _prune_empty_dirs(os.path.dirname(old_path), download_manager.download_folder)
+            report['moved'] += 1
+            logger.info(f"已迁移 - 文件ID: {file_id}, {old_path} -> {new_path}")
+        except OSError as e:
+            report['failed'] += 1
+            report['errors'].append(f"{old_path}: {str(e)}")
+            logger.warning(f"迁移失败 - 文件ID: {file_id}, 文件: {old_path}, 错误: {str(e)}")
+            # 元数据未指向新路径时删除新位置的临时副本
+            if part_path:
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+            continue
+        if pause > 0:
+            time.sleep(pause)
+
+    report['duration_seconds'] = round(time.time() - started, 3)
+    logger.info(
+        f"目录布局迁移完成 - 布局: {report['layout']}, 检查{report['checked']}个，移动{report['moved']}个，"
+        f"跳过{report['skipped']}个，失败{report['failed']}个，耗时{report['duration_seconds']}秒"
+    )
+    return report
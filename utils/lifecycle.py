@@ -0,0 +1,106 @@
+"""
+服务生命周期
+统计进行中的请求（包括流式响应），停止服务时先进入排空状态：
+新请求返回503，等待进行中的请求和流式传输结束后再退出
+"""
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _TrackedIterable:
+    """包装响应迭代器，响应发送完毕（close被调用）时结束计数"""
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.on_close()
+
+class RequestTracker:
+    """
+    WSGI中间件：统计进行中的请求，支持排空
+    exempt_paths中的路径（健康检查）不计数，排空期间仍然正常响应
+    """
+    def __init__(self, wsgi_app, exempt_paths=('/healthz', '/readyz')):
+        self.wsgi_app = wsgi_app
+        self.exempt_paths = tuple(exempt_paths)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.draining = False
+        self.drain_started_at = None
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').endswith(self.exempt_paths):
+            return self.wsgi_app(environ, start_response)
+
+        with self.condition:
+            if self.draining:
+                rejected = True
+            else:
+                rejected = False
+                self.in_flight += 1
+        if rejected:
+            body = json.dumps({'error': '服务正在停止，请稍后重试'}, ensure_ascii=False).encode('utf-8')
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'application/json; charset=utf-8'),
+                ('Content-Length', str(len(body))),
+                ('Retry-After', '5'),
+                ('Connection', 'close')
+            ])
+            return [body]
+
+        closed = threading.Event()
+
+        def on_close():
+            if closed.is_set():
+                return
+            closed.set()
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+        try:
+            return _TrackedIterable(self.wsgi_app(environ, start_response), on_close)
+        except BaseException:
+            on_close()
+            raise
+
+    def start_draining(self):
+        """进入排空状态：之后的新请求返回503"""
+        with self.condition:
+            if self.draining:
+                return
+            self.draining = True
+            self.drain_started_at = time.time()
+            in_flight = self.in_flight
+        logger.info(f"开始排空请求，进行中的请求数: {in_flight}")
+
+    def wait_idle(self, timeout=None):
+        """等待进行中的请求全部结束，返回是否在超时前结束"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.in_flight > 0:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def get_status(self):
+        """获取状态：进行中的请求数、是否正在排空"""
+        with self.condition:
+            return {
+                'in_flight': self.in_flight,
+                'draining': self.draining,
+                'draining_seconds': round(time.time() - self.drain_started_at, 1) if self.drain_started_at else None
+            }
@@ -0,0 +1,159 @@
+"""
+分阶段流水线
+各阶段运行在独立线程中，阶段之间通过有界队列连接，
+例如下载（网络）和转换（CPU）可以同时进行：第N+1集下载时第N集在转换
+"""
+import threading
+import queue
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 结束标记，沿流水线逐级传递
+_STOP = object()
+
+class PipelineStage:
+    """
+    流水线阶段
+
+    参数:
+        name: 阶段名称（用于统计）
+        handler: 处理函数，接收上一阶段的输出，返回交给下一阶段的数据；返回None表示丢弃
+        size_of: 可选，根据处理结果计算处理字节数的函数，用于统计字节吞吐量
+    """
+    def __init__(self, name, handler, size_of=None):
+        self.name = name
+        self.handler = handler
+        self.size_of = size_of
+        self.processed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, nbytes=0, failed=False):
+        """记录一次处理"""
+        with self.lock:
+            self.busy_seconds += elapsed
+            self.bytes += nbytes
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+
+    def get_stats(self):
+        """获取阶段统计：处理数量、字节数、忙碌时间和吞吐量"""
+        with self.lock:
+            end = self.finished_at or time.time()
+            wall_seconds = end - self.started_at if self.started_at else 0.0
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'bytes': self.bytes,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'wall_seconds': round(wall_seconds, 3),
+                # 阶段自身的吞吐量（按忙碌时间计算，不含等待上下游的时间）
+                'items_per_sec': round(self.processed / self.busy_seconds, 3) if self.busy_seconds > 0 else 0.0,
+                'bytes_per_sec': round(self.bytes / self.busy_seconds, 1) if self.busy_seconds > 0 else 0.0,
+                # 阶段利用率，接近1说明该阶段是瓶颈
+                'utilization': round(self.busy_seconds / wall_seconds, 3) if wall_seconds > 0 else 0.0
+            }
+
+class Pipeline:
+    """
+    有界队列连接的多阶段流水线
+
+    用法:
+        pipeline = Pipeline([PipelineStage('fetch', fetch), PipelineStage('commit', commit)])
+        pipeline.start()
+        for item in items:
+            pipeline.put(item)
+        pipeline.close()
+        pipeline.join()
+    """
+    def __init__(self, stages, queue_size=2, on_error=None, name='pipeline'):
+        """
+        参数:
+            stages: PipelineStage列表，按执行顺序排列
+            queue_size: 阶段之间队列的容量，队列满时上游阶段阻塞（背压）
+            on_error: 可选回调 on_error(stage_name, item, exception)，处理函数抛出异常时调用
+            name: 流水线名称（用于线程名和日志）
+        """
+        self.stages = stages
+        self.name = name
+        self.on_error = on_error
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.threads = []
+
+    def start(self):
+        """启动各阶段线程"""
+        for index, stage in enumerate(self.stages):
+            thread = threading.Thread(
+                target=self._run_stage,
+                args=(index,),
+                name=f"{self.name}-{stage.name}",
+                daemon=True
+            )
+            self.threads.append(thread)
+            thread.start()
+        return self
+
+    def put(self, item):
+        """向第一个阶段提交数据，队列满时阻塞"""
+        self.queues[0].put(item)
+
+    def close(self):
+        """不再提交新数据，处理完已提交的数据后各阶段依次退出"""
+        self.queues[0].put(_STOP)
+
+    def join(self, timeout=None):
+        """等待所有阶段处理完成"""
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def get_stats(self):
+        """获取各阶段统计"""
+        return {stage.name: stage.get_stats() for stage in self.stages}
+
+    def _run_stage(self, index):
+        """阶段线程主循环"""
+        stage = self.stages[index]
+        in_queue = self.queues[index]
+        out_queue = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        stage.started_at = time.time()
+
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+
+            start = time.time()
+            try:
+                result = stage.handler(item)
+            except Exception as e:
+                stage.record(time.time() - start, failed=True)
+                logger.exception(f"流水线阶段执行失败 - {self.name}/{stage.name}: {str(e)}")
+                if self.on_error:
+                    try:
+                        self.on_error(stage.name, item, e)
+                    except Exception:
+                        logger.exception(f"流水线错误回调执行失败 - {self.name}/{stage.name}")
+                continue
+
+            nbytes = 0
+            if stage.size_of and result is not None:
+                try:
+                    nbytes = stage.size_of(result) or 0
+                except Exception:
+                    nbytes = 0
+            stage.record(time.time() - start, nbytes)
+
+            if out_queue is not None and result is not None:
+                out_queue.put(result)
+
+        stage.finished_at = time.time()
+        if out_queue is not None:
+            out_queue.put(_STOP)
@@ -0,0 +1,323 @@
+"""
+下载目录与元数据的一致性检查
+一次 os.scandir 遍历下载目录（子目录并行扫描），与 metadata.json 中保存在本地的条目对比：
+    - 元数据中的文件不存在：同名不同扩展名的孤立文件存在时（例如转换后元数据未更新）修正路径，否则删除该条目
+    - 文件大小与元数据不一致：以磁盘上的文件为准修正
+    - 没有元数据的文件：移到隔离目录，由管理员决定保留或删除
+    - 残留的临时文件（.part/.tmp）：超过一定时间未修改的删除
+最近修改过的文件可能正在写入或即将登记，不处理
+"""
+import os
+import time
+import shutil
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from utils.coordination import LEADER_RECHECK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+TEMP_SUFFIXES = ('.part', '.tmp')
+
+class LibraryReconciler:
+    def __init__(self, download_manager, quarantine_folder=None, workers=4,
+                 grace_seconds=3600, temp_max_age_seconds=6 * 3600):
+        """
+        参数:
+            download_manager: DownloadManager实例
+            quarantine_folder: 隔离目录，默认为下载目录下的 .quarantine（与下载目录在同一文件系统，移动只需重命名）
+            workers: 并行扫描子目录的线程数
+            grace_seconds: 修改时间在此范围内的孤立文件不处理（可能正在写入或即将登记）
+            temp_max_age_seconds: 超过此时间未修改的临时文件才删除
+        """
+        self.download_manager = download_manager
+        self.download_folder = download_manager.download_folder
+        self.quarantine_folder = quarantine_folder or os.path.join(self.download_folder, '.quarantine')
+        self.workers = workers
+        self.grace_seconds = grace_seconds
+        self.temp_max_age_seconds = temp_max_age_seconds
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.last_report = None
+
+    def _is_internal(self, path, name):
+        """元数据文件本身和隔离目录不参与检查"""
+        if os.path.abspath(path) == os.path.abspath(self.quarantine_folder):
+            return True
+        return name.startswith(os.path.basename(self.download_manager.metadata_file))
+
+    def _scan_tree(self, folder):
+        """
+        递归扫描目录
+        返回: ({绝对路径: (大小, 修改时间)}, 目录数, 错误列表)
+        """
+        files = {}
+        directories = 0
+        errors = []
+        pending = [folder]
+        while pending:
+            current = pending.pop()
+            directories += 1
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if self._is_internal(entry.path, entry.name):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                stat = entry.stat(follow_symlinks=False)
+                                files[os.path.abspath(entry.path)] = (stat.st_size, stat.st_mtime)
+                        except OSError as e:
+                            errors.append(f"{entry.path}: {str(e)}")
+            except OSError as e:
+                errors.append(f"{current}: {str(e)}")
+        return files, directories, errors
+
+    def scan(self):
+        """
+        扫描下载目录，顶层的子目录并行扫描
+        返回: ({绝对路径: (大小, 修改时间)}, 目录数, 错误列表)
+        """
+        files = {}
+        subfolders = []
+        errors = []
+        with os.scandir(self.download_folder) as entries:
+            for entry in entries:
+                if self._is_internal(entry.path, entry.name):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files[os.path.abspath(entry.path)] = (stat.st_size, stat.st_mtime)
+                except OSError as e:
+                    errors.append(f"{entry.path}: {str(e)}")
+        directories = 1
+        if subfolders:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(subfolders)))) as executor:
+                for sub_files, sub_directories, sub_errors in executor.map(self._scan_tree, subfolders):
+                    files.update(sub_files)
+                    directories += sub_directories
+                    errors.extend(sub_errors)
+        return files, directories, errors
+
+    def _quarantine_path(self, path, stamp):
+        """隔离目录中的位置：按本轮时间分组，保留相对下载目录的路径"""
+        relative = os.path.relpath(path, os.path.abspath(self.download_folder))
+        return os.path.join(self.quarantine_folder, stamp, relative)
+
+    def run_once(self, dry_run=False):
+        """
+        执行一轮检查
+        dry_run: 只报告，不修改元数据和文件
+        返回: 本轮报告，已有一轮在运行时返回None
+        """
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+
+        started = time.time()
+        report = {
+            'started_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'dry_run': dry_run,
+            'files_scanned': 0,
+            'directories_scanned': 0,
+            'entries_checked': 0,
+            'missing_removed': 0,
+            'relinked': 0,
+            'size_fixed': 0,
+            'orphans_quarantined': 0,
+            'orphan_bytes': 0,
+            'temp_removed': 0,
+            'temp_bytes': 0,
+            'errors': [],
+            'scan_seconds': None,
+            'duration_seconds': None
+        }
+        self.last_report = report
+        try:
+            files, directories, errors = self.scan()
+            report['scan_seconds'] = round(time.time() - started, 3)
+            report['files_scanned'] = len(files)
+            report['directories_scanned'] = directories
+            report['errors'].extend(errors)
+            self._reconcile(files, report, dry_run)
+            return report
+        except Exception as e:
+            logger.exception(f"一致性检查失败: {str(e)}")
+            report['errors'].append(str(e))
+            return report
+        finally:
+            report['finished_at'] = datetime.now().isoformat()
+            report['duration_seconds'] = round(time.time() - started, 3)
+            logger.info(
+                f"一致性检查完成 - 扫描{report['files_scanned']}个文件，耗时{report['duration_seconds']}秒（扫描{report['scan_seconds']}秒），"
+                f"删除失效条目{report['missing_removed']}个，修正路径{report['relinked']}个，修正大小{report['size_fixed']}个，"
+                f"隔离孤立文件{report['orphans_quarantined']}个，清理临时文件{report['temp_removed']}个"
+            )
+            with self.lock:
+                self.running = False
+
+    def _reconcile(self, files, report, dry_run):
+        """对比扫描结果和元数据并修复（持有元数据锁并重新确认每一项，避免与并发的下载、删除冲突）"""
+        now = time.time()
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        manager = self.download_manager
+        changed = False
+        with manager.lock, manager._file_lock():
+            manager._refresh_metadata()
+            metadata = manager.metadata
+            report['entries_checked'] = len(metadata)
+            referenced = {
+                os.path.abspath(info['file_path']) for info in metadata.values()
+                if info.get('file_path') and manager.is_local(info)
+            }
+            temp_files = {path for path in files if path.endswith(TEMP_SUFFIXES)}
+            # 孤立文件按 目录+文件名主干 索引，用于修正扩展名变化的条目
+            orphans = {}
+            for path, (_, mtime) in files.items():
+                if path in referenced or path in temp_files or now - mtime < self.grace_seconds:
+                    continue
+                orphans.setdefault(os.path.splitext(path)[0], []).append(path)
+
+            for file_id, info in list(metadata.items()):
+                file_path = info.get('file_path')
+                if not file_path or not manager.is_local(info):
+                    # 对象存储中的条目不在下载目录中
+                    continue
+                path = os.path.abspath(file_path)
+                if path in files:
+                    size = files[path][0]
+                    if info.get('size') != size and os.path.exists(path):
+                        report['size_fixed'] += 1
+                        if not dry_run:
+                            info['size'] = os.path.getsize(path)
+                            changed = True
+                    continue
+                if os.path.exists(path):
+                    # 扫描之后才出现的文件
+                    continue
+                candidates = [
+                    candidate for candidate in orphans.get(os.path.splitext(path)[0], [])
+                    if os.path.exists(candidate)
+                ]
+                if len(candidates) == 1:
+                    candidate = candidates[0]
+                    orphans[os.path.splitext(path)[0]].remove(candidate)
+                    report['relinked'] += 1
+                    logger.info(f"修正文件路径 - 文件ID: {file_id}, {file_path} -> {candidate}")
+                    if not dry_run:
+                        info['file_path'] = os.path.join(os.path.dirname(file_path), os.path.basename(candidate))
+                        info['filename'] = os.path.basename(candidate)
+                        info['size'] = os.path.getsize(candidate)
+                        changed = True
+                    continue
+                report['missing_removed'] += 1
+                logger.info(f"删除失效条目 - 文件ID: {file_id}, 文件不存在: {file_path}")
+                if not dry_run:
+                    del metadata[file_id]
+                    changed = True
+
+            if changed:
+                manager._save_metadata()
+
+        # 移动文件不持有元数据锁（跨文件系统时需要完整复制，持锁会阻塞所有下载和元数据写入）
+        for paths in orphans.values():
+            for path in paths:
+                size = files[path][0]
+                report['orphans_quarantined'] += 1
+                report['orphan_bytes'] += size
+                logger.info(f"隔离孤立文件: {path}")
+                if not dry_run:
+                    self._quarantine(path, self._quarantine_path(path, stamp), report)
+
+        for path in temp_files:
+            size, mtime = files[path]
+            if now - mtime < self.temp_max_age_seconds:
+                continue
+            report['temp_removed'] += 1
+            report['temp_bytes'] += size
+            logger.info(f"删除残留的临时文件: {path}")
+            if dry_run:
+                continue
+            try:
+                # 再次确认期间没有被写入
+                if now - os.path.getmtime(path) >= self.temp_max_age_seconds:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                report['errors'].append(f"{path}: {str(e)}")
+
+    def _is_referenced(self, path):
+        """元数据中是否有本地条目指向该路径"""
+        manager = self.download_manager
+        with manager.lock:
+            manager._refresh_metadata()
+            return any(
+                info.get('file_path') and manager.is_local(info) and os.path.abspath(info['file_path']) == path
+                for info in manager.metadata.values()
+            )
+
+    def _quarantine(self, path, target, report):
+        """移动孤立文件到隔离目录；移动期间该文件被登记到元数据时放回原位"""
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(path, target)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            report['errors'].append(f"{path}: {str(e)}")
+            return
+        if not self._is_referenced(path):
+            return
+        logger.info(f"孤立文件在隔离期间被登记，放回原位: {path}")
+        report['orphans_quarantined'] -= 1
+        report['orphan_bytes'] -= os.path.getsize(target)
+        try:
+            if not os.path.exists(path):
+                shutil.move(target, path)
+        except OSError as e:
+            report['errors'].append(f"{path}: {str(e)}")
+
+    def start_background_thread(self, interval_hours=6, should_run=None):
+        """
+        启动后台线程：启动时立即检查一次，之后每interval_hours小时检查一次（为0时只在启动时检查）
+
+        参数:
+            should_run: 可选，返回本进程是否应执行的函数（多进程部署时只由主节点执行），
+                        返回False时跳过本轮并在LEADER_RECHECK_SECONDS秒后重新检查
+        """
+        if self.thread:
+            return
+
+        def background_worker():
+            while True:
+                if should_run and not should_run():
+                    time.sleep(LEADER_RECHECK_SECONDS)
+                    continue
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.exception(f"一致性检查任务执行失败: {str(e)}")
+                if interval_hours <= 0:
+                    return
+                time.sleep(interval_hours * 3600)
+
+        self.thread = threading.Thread(target=background_worker, name='reconciler', daemon=True)
+        self.thread.start()
+
+    def get_status(self):
+        """获取一致性检查状态和最近一次的报告"""
+        return {
+            'running': self.running,
+            'quarantine_folder': self.quarantine_folder,
+            'last_report': self.last_report
+        }
@@ -0,0 +1,214 @@
+"""
+下载重试
+按错误类型决定是否重试（404等不重试，429/503遵循Retry-After），
+重试间隔按指数退避并加入随机抖动，避免大量失败的下载同时重试
+"""
+import heapq
+import random
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+
+logger = logging.getLogger(__name__)
+
+# 错误分类
+ERROR_NOT_FOUND = 'not_found'          # 404/410，资源不存在
+ERROR_CLIENT = 'client_error'          # 其他4xx，请求本身有问题
+ERROR_RATE_LIMITED = 'rate_limited'    # 429
+ERROR_UNAVAILABLE = 'unavailable'      # 503
+ERROR_SERVER = 'server_error'          # 其他5xx
+ERROR_TIMEOUT = 'timeout'
+ERROR_CONNECTION = 'connection'
+ERROR_OTHER = 'other'
+
+# 默认可重试的错误类型（均为暂时性错误）
+RETRYABLE_ERRORS = frozenset({
+    ERROR_RATE_LIMITED, ERROR_UNAVAILABLE, ERROR_SERVER, ERROR_TIMEOUT, ERROR_CONNECTION
+})
+
+def parse_retry_after(value):
+    """
+    解析Retry-After响应头，支持秒数和HTTP日期两种格式
+    返回: 需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def classify_error(error):
+    """
+    对下载异常分类
+    返回: (error_class, retry_after)，retry_after为服务器要求的等待秒数（没有时为None）
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        if status in (404, 410):
+            return ERROR_NOT_FOUND, None
+        if status in (429, 503):
+            retry_after = parse_retry_after(error.response.headers.get('Retry-After'))
+            return (ERROR_RATE_LIMITED if status == 429 else ERROR_UNAVAILABLE), retry_after
+        if status >= 500:
+            return ERROR_SERVER, None
+        return ERROR_CLIENT, None
+    if isinstance(error, requests.Timeout):
+        return ERROR_TIMEOUT, None
+    if isinstance(error, (requests.ConnectionError, ConnectionError)):
+        return ERROR_CONNECTION, None
+    if isinstance(error, requests.exceptions.ChunkedEncodingError):
+        # 传输中途连接断开
+        return ERROR_CONNECTION, None
+    return ERROR_OTHER, None
+
+class RetryPolicy:
+    def __init__(self, max_attempts=4, base_delay=5.0, max_delay=300.0, jitter=0.5,
+                 max_retry_after=3600.0, retryable=RETRYABLE_ERRORS, defer_after=30.0):
+        """
+        参数:
+            max_attempts: 最多尝试次数（包含第一次）
+            base_delay: 第一次重试的基础等待秒数，之后每次翻倍
+            max_delay: 指数退避的等待上限
+            jitter: 随机抖动比例，实际等待时间在 [delay×(1-jitter), delay] 之间
+            max_retry_after: 服务器Retry-After的上限，超过时按上限等待
+            retryable: 可重试的错误类型集合
+            defer_after: 任务在工作线程中等待重试的上限秒数，剩余的重试都要等待更久时
+                         任务让出工作线程，到期后由调度器重新执行（见RetryQueue.defer）
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self.retryable = retryable
+        self.defer_after = defer_after
+
+    def should_retry(self, error_class, attempt):
+        """attempt为已经失败的次数"""
+        return error_class in self.retryable and attempt < self.max_attempts
+
+    def get_delay(self, attempt, retry_after=None):
+        """计算第attempt次失败后的等待秒数"""
+        if retry_after is not None:
+            # 服务器指定了等待时间，按服务器要求执行
+            return min(retry_after, self.max_retry_after)
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter * random.random())
+
+class RetryQueue:
+    """
+    单个任务的重试队列
+
+    生产者每放入一个工作项调用track()，处理完成（无论成功、失败还是进入重试）后调用done()；
+    需要重试的工作项通过schedule()按到期时间排队，生产者用next_due()取出到期的工作项重新提交。
+    队列为空且没有处理中的工作项时，next_due()返回None，表示不会再有新的重试；
+    指定max_wait时，剩余的重试都要等待更久也返回None，生产者调用defer()后让出工作线程，到期后继续
+    """
+    def __init__(self, policy=None):
+        self.policy = policy or RetryPolicy()
+        self.condition = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.in_flight = 0
+        self.stats = {
+            'scheduled': 0,       # 已安排的重试次数
+            'recovered': 0,       # 重试后成功的工作项
+            'exhausted': 0,       # 达到重试上限仍失败
+            'not_retryable': 0,   # 错误类型不可重试
+            'deferred': 0,        # 等待重试期间让出工作线程的次数
+            'errors': {}          # 各错误类型出现的次数
+        }
+
+    def track(self):
+        """登记一个进入处理的工作项"""
+        with self.condition:
+            self.in_flight += 1
+
+    def done(self):
+        """一个工作项处理结束"""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def handle_failure(self, work_item, error):
+        """
+        处理下载失败：可重试时安排重试
+        返回: (是否已安排重试, 错误类型)
+        """
+        error_class, retry_after = classify_error(error)
+        attempt = work_item.get('attempts', 0) + 1
+        with self.condition:
+            self.stats['errors'][error_class] = self.stats['errors'].get(error_class, 0) + 1
+            if not self.policy.should_retry(error_class, attempt):
+                self.stats['exhausted' if error_class in self.policy.retryable else 'not_retryable'] += 1
+                return False, error_class
+            delay = self.policy.get_delay(attempt, retry_after)
+            retry_item = {**work_item, 'attempts': attempt, 'last_error': error_class}
+            self.seq += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.seq, retry_item))
+            self.stats['scheduled'] += 1
+            self.condition.notify_all()
+        logger.info(f"安排重试 - 工作项: {work_item.get('item_key')}, 第{attempt}次失败, 错误类型: {error_class}, {delay:.1f}秒后重试")
+        return True, error_class
+
+    def record_success(self, work_item):
+        """工作项成功，重试过的计入recovered"""
+        if work_item.get('attempts'):
+            with self.condition:
+                self.stats['recovered'] += 1
+
+    def next_due(self, cancel_token=None, max_wait=None):
+        """
+        阻塞等待下一个到期的重试工作项
+        max_wait: 可选，没有处理中的工作项且下一个重试在max_wait秒后才到期时不再等待
+        返回: 工作项；没有待重试且没有处理中的工作项，或已取消时返回None
+        """
+        with self.condition:
+            while True:
+                if cancel_token and cancel_token.cancelled:
+                    return None
+                if self.heap:
+                    due_at = self.heap[0][0]
+                    wait = due_at - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self.heap)[2]
+                    if max_wait is not None and wait > max_wait and self.in_flight == 0:
+                        return None
+                elif self.in_flight == 0:
+                    return None
+                else:
+                    wait = None
+                # 定期醒来检查取消状态
+                self.condition.wait(min(wait, 1.0) if wait is not None else 1.0)
+
+    def defer(self):
+        """
+        任务让出工作线程（next_due因max_wait返回后调用），待重试的工作项保留在队列中，
+        由调度器在到期时重新执行的任务继续处理
+        返回: 最早的到期时间，没有待重试时返回None
+        """
+        with self.condition:
+            if not self.heap:
+                return None
+            self.stats['deferred'] += 1
+            return self.heap[0][0]
+
+    def get_stats(self):
+        """获取重试统计"""
+        with self.condition:
+            return {
+                **self.stats,
+                'errors': dict(self.stats['errors']),
+                'pending': len(self.heap),
+                'next_retry_in': round(max(0.0, self.heap[0][0] - time.time()), 1) if self.heap else None
+            }
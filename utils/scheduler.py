@@ -0,0 +1,264 @@
+"""
+任务调度器
+固定数量的工作线程执行任务，按优先级分类（交互 > 监听 > 补录），
+同一优先级内按用户轮转，避免单个用户的大量任务占满所有工作线程；
+延后执行的任务（not_before）到期前不占用工作线程
+"""
+import heapq
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# 优先级分类，数值越小优先级越高
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_MONITOR = 'monitor'
+PRIORITY_BACKFILL = 'backfill'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_MONITOR, PRIORITY_BACKFILL)
+
+class _Job:
+    def __init__(self, job_id, func, user, priority, on_drop=None):
+        self.job_id = job_id
+        self.func = func
+        self.user = user
+        self.priority = priority
+        self.on_drop = on_drop
+        self.submitted_at = time.time()
+        self.started_at = None
+
+class TaskScheduler:
+    def __init__(self, max_workers=2, name='scheduler'):
+        """
+        参数:
+            max_workers: 同时执行的任务数上限
+            name: 调度器名称（用于线程名）
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.condition = threading.Condition()
+        # 每个优先级一个"用户 -> 任务队列"的有序字典，取任务时按用户轮转
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        # 延后执行的任务，按 (到期时间, 序号) 排列，到期后进入对应优先级的队列
+        self.delayed = []
+        self.delayed_seq = 0
+        self.running_jobs = {}
+        self.workers = []
+        self.stopped = False
+        self.stats = {
+            priority: {'submitted': 0, 'completed': 0, 'failed': 0, 'total_wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+            for priority in PRIORITIES
+        }
+
+    def start(self):
+        """启动工作线程"""
+        with self.condition:
+            if self.workers:
+                return
+            self.stopped = False
+            for index in range(self.max_workers):
+                worker = threading.Thread(target=self._worker_loop, name=f"{self.name}-worker-{index}", daemon=True)
+                self.workers.append(worker)
+                worker.start()
+
+    def stop(self):
+        """停止工作线程：不再开始排队中的任务，正在执行的任务会执行完"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def submit(self, job_id, func, user=None, priority=PRIORITY_INTERACTIVE, on_drop=None, not_before=None):
+        """
+        提交任务
+        job_id: 任务ID（用于查询排队位置）
+        func: 无参数的可调用对象
+        user: 任务所属用户，同一优先级内按用户公平轮转
+        priority: 优先级分类（PRIORITIES之一）
+        on_drop: 可选的无参数回调，任务未执行就被移出队列（cancel/clear）时调用
+        not_before: 可选的时间戳，到期前不执行（例如等待重试），期间不占用工作线程
+        """
+        if priority not in self.queues:
+            raise ValueError(f"未知的优先级: {priority}")
+        job = _Job(job_id, func, user or '', priority, on_drop)
+        with self.condition:
+            if not_before is not None and not_before > time.time():
+                self.delayed_seq += 1
+                heapq.heappush(self.delayed, (not_before, self.delayed_seq, job))
+            else:
+                self.queues[priority].setdefault(job.user, deque()).append(job)
+            self.stats[priority]['submitted'] += 1
+            self.condition.notify_all()
+        return job_id
+
+    def _remove_queued(self, job_id):
+        """从队列中取出尚未开始的任务，不存在时返回None（调用方需持有condition）"""
+        for index, (_, _, job) in enumerate(self.delayed):
+            if job.job_id == job_id:
+                self.delayed.pop(index)
+                heapq.heapify(self.delayed)
+                return job
+        for user_queues in self.queues.values():
+            for user, jobs in list(user_queues.items()):
+                for job in jobs:
+                    if job.job_id == job_id:
+                        jobs.remove(job)
+                        if not jobs:
+                            del user_queues[user]
+                        return job
+        return None
+
+    def cancel(self, job_id):
+        """从队列中移除尚未开始的任务，返回是否移除成功"""
+        with self.condition:
+            job = self._remove_queued(job_id)
+        if job is None:
+            return False
+        self._drop(job)
+        return True
+
+    def clear(self):
+        """移除所有尚未开始的任务（停止后调用），返回移除的数量"""
+        with self.condition:
+            dropped = [job for user_queues in self.queues.values() for jobs in user_queues.values() for job in jobs]
+            dropped += [job for _, _, job in self.delayed]
+            for user_queues in self.queues.values():
+                user_queues.clear()
+            self.delayed = []
+        for job in dropped:
+            self._drop(job)
+        return len(dropped)
+
+    def _drop(self, job):
+        """任务未执行就被移出队列时调用其回调（不持有condition）"""
+        if job.on_drop is None:
+            return
+        try:
+            job.on_drop()
+        except Exception as e:
+            logger.warning(f"执行任务移除回调失败 - 任务ID: {job.job_id}, 错误: {str(e)}")
+
+    def _promote_delayed(self):
+        """
+        到期的延后任务进入队列（调用方需持有condition）
+        返回: 距下一个延后任务到期的秒数，没有延后任务时返回None
+        """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            not_before, _, job = heapq.heappop(self.delayed)
+            # 排队等待时间从到期时开始计算
+            job.submitted_at = max(job.submitted_at, not_before)
+            self.queues[job.priority].setdefault(job.user, deque()).append(job)
+        return self.delayed[0][0] - now if self.delayed else None
+
+    def _next_job(self):
+        """按优先级取下一个任务，同一优先级内轮转到下一个用户（调用方需持有condition）"""
+        for priority in PRIORITIES:
+            user_queues = self.queues[priority]
+            if not user_queues:
+                continue
+            user, jobs = next(iter(user_queues.items()))
+            job = jobs.popleft()
+            # 该用户移到队尾，下次轮到其他用户
+            del user_queues[user]
+            if jobs:
+                user_queues[user] = jobs
+            return job
+        return None
+
+    def _worker_loop(self):
+        """工作线程主循环"""
+        while True:
+            with self.condition:
+                job = None
+                while not self.stopped:
+                    wait = self._promote_delayed()
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self.condition.wait(wait)
+                if job is None:
+                    return
+                job.started_at = time.time()
+                wait_seconds = job.started_at - job.submitted_at
+                stats = self.stats[job.priority]
+                stats['total_wait_seconds'] += wait_seconds
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], wait_seconds)
+                self.running_jobs[job.job_id] = job
+
+            failed = False
+            try:
+                job.func()
+            except Exception as e:
+                failed = True
+                logger.exception(f"调度任务执行失败 - 任务ID: {job.job_id}, 异常: {str(e)}")
+            finally:
+                with self.condition:
+                    self.running_jobs.pop(job.job_id, None)
+                    self.stats[job.priority]['failed' if failed else 'completed'] += 1
+                    self.condition.notify_all()
+
+    def has_capacity(self):
+        """是否有空闲的工作线程（没有排队中的任务且执行中的任务数未达上限）"""
+        with self.condition:
+            queued = sum(len(jobs) for user_queues in self.queues.values() for jobs in user_queues.values())
+            return queued == 0 and len(self.running_jobs) < self.max_workers
+
+    def wait_idle(self, timeout=None):
+        """等待正在执行的任务全部结束，返回是否在超时前结束"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.running_jobs:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def get_queue_position(self, job_id):
+        """获取任务的排队信息：{'priority', 'wait_seconds'}，不在队列中返回None"""
+        now = time.time()
+        with self.condition:
+            for priority, user_queues in self.queues.items():
+                for jobs in user_queues.values():
+                    for job in jobs:
+                        if job.job_id == job_id:
+                            return {'priority': priority, 'wait_seconds': round(now - job.submitted_at, 3)}
+            for not_before, _, job in self.delayed:
+                if job.job_id == job_id:
+                    return {
+                        'priority': job.priority,
+                        'wait_seconds': round(now - job.submitted_at, 3),
+                        'starts_in_seconds': round(max(0.0, not_before - now), 3)
+                    }
+        return None
+
+    def get_stats(self):
+        """获取调度统计：各优先级的队列深度、最长等待时间和平均等待时间"""
+        now = time.time()
+        with self.condition:
+            queues = {}
+            for priority in PRIORITIES:
+                user_queues = self.queues[priority]
+                jobs = [job for user_jobs in user_queues.values() for job in user_jobs]
+                stats = self.stats[priority]
+                started = stats['completed'] + stats['failed'] + sum(
+                    1 for job in self.running_jobs.values() if job.priority == priority
+                )
+                queues[priority] = {
+                    'depth': len(jobs),
+                    'users': len(user_queues),
+                    'oldest_wait_seconds': round(max((now - job.submitted_at for job in jobs), default=0.0), 3),
+                    'avg_wait_seconds': round(stats['total_wait_seconds'] / started, 3) if started else 0.0,
+                    'max_wait_seconds': round(stats['max_wait_seconds'], 3),
+                    'submitted': stats['submitted'],
+                    'completed': stats['completed'],
+                    'failed': stats['failed']
+                }
+            return {
+                'max_workers': self.max_workers,
+                'running': len(self.running_jobs),
+                'queued': sum(q['depth'] for q in queues.values()),
+                'delayed': len(self.delayed),
+                'queues': queues
+            }
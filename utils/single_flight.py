@@ -0,0 +1,236 @@
+"""
+代理下载合并（single-flight）
+同一音频URL的并发代理下载只向源服务器发起一次请求：数据写入磁盘上的暂存文件，
+所有客户端从暂存文件读取，后加入的客户端先读取已写入的部分再等待新数据；
+有请求要求保存到服务器时，下载结束后暂存文件只保存一份
+"""
+import os
+import uuid
+import threading
+import logging
+import requests
+from utils.cancellation import CancelToken, cancellable_get
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+class _Flight:
+    """一次进行中的上游下载"""
+    def __init__(self, url, spool_path):
+        self.url = url
+        self.spool_path = spool_path
+        self.condition = threading.Condition()
+        self.headers = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.save_as = None
+        self.finalized = False
+        self.cancel_token = CancelToken()
+
+class FlightReader:
+    """
+    读取一次共享下载的数据，可迭代得到数据块
+    不再需要时必须调用close()（迭代结束或出错时会自动调用）
+    """
+    def __init__(self, downloader, flight):
+        self.downloader = downloader
+        self.flight = flight
+        self.closed = False
+
+    def wait_headers(self, timeout=60):
+        """等待上游响应头，返回 {'content_type', 'content_length'}；上游请求失败时抛出对应异常"""
+        flight = self.flight
+        with flight.condition:
+            flight.condition.wait_for(lambda: flight.headers is not None or flight.error is not None, timeout)
+            if flight.headers is not None:
+                return flight.headers
+            if flight.error is not None:
+                raise flight.error
+        raise requests.Timeout(f"等待上游响应超时: {flight.url}")
+
+    def request_save(self, save_as):
+        """要求下载完成后保存到服务器（同一次下载只保存一份，以第一个请求的信息为准）"""
+        with self.flight.condition:
+            if self.flight.save_as is None:
+                self.flight.save_as = save_as
+
+    def iter_chunks(self, chunk_size=65536):
+        """按数据块读取，追上写入进度后等待新数据；上游出错时抛出异常"""
+        flight = self.flight
+        try:
+            with open(flight.spool_path, 'rb') as f:
+                position = 0
+                while not self.closed:
+                    with flight.condition:
+                        flight.condition.wait_for(
+                            lambda: flight.written > position or flight.done or self.closed, 5.0
+                        )
+                        available = flight.written - position
+                        done, error = flight.done, flight.error
+                    if available > 0:
+                        data = f.read(min(chunk_size, available))
+                        position += len(data)
+                        yield data
+                    elif error is not None:
+                        raise error
+                    elif done:
+                        return
+        finally:
+            self.close()
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.downloader._release(self.flight)
+
+class SingleFlightDownloader:
+    def __init__(self, spool_folder, on_complete=None, chunk_size=65536, timeout=30):
+        """
+        参数:
+            spool_folder: 暂存文件目录（与下载目录在同一文件系统时，保存只需重命名）
+            on_complete: 可选回调 on_complete(spool_path, headers, save_as)，要求保存的下载完成后调用，
+                         负责把暂存文件移动到最终位置并记录元数据；未移走的暂存文件随后被删除
+            chunk_size: 从上游读取的块大小
+            timeout: 上游连接超时秒数
+        """
+        self.spool_folder = spool_folder
+        self.on_complete = on_complete
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {'library_hits': 0, 'fetches': 0, 'coalesced': 0}
+        os.makedirs(spool_folder, exist_ok=True)
+
+    def open(self, url):
+        """
+        获取URL的下载读取器：已有进行中的下载时加入，否则发起新的上游请求
+        返回: FlightReader
+        """
+        with self.lock:
+            flight = self.flights.get(url)
+            if flight is not None:
+                with flight.condition:
+                    # 已经保存或删除暂存文件的下载不能再加入
+                    joinable = not flight.finalized and not flight.cancel_token.cancelled
+                    if joinable:
+                        flight.readers += 1
+                if joinable:
+                    self.stats['coalesced'] += 1
+                    logger.info(f"合并到进行中的下载: {url}, 当前读取者: {flight.readers}")
+                    return FlightReader(self, flight)
+            spool_path = os.path.join(self.spool_folder, f".proxy-{uuid.uuid4().hex}.part")
+            # 先创建暂存文件，读取者随时可以打开
+            spool_file = open(spool_path, 'wb')
+            flight = _Flight(url, spool_path)
+            flight.readers = 1
+            self.flights[url] = flight
+            self.stats['fetches'] += 1
+        threading.Thread(
+            target=self._fetch, args=(flight, spool_file), name='proxy-fetch', daemon=True
+        ).start()
+        return FlightReader(self, flight)
+
+    def _fetch(self, flight, spool_file):
+        """后台线程：从上游下载到暂存文件"""
+        response = None
+        handle = None
+        try:
+            with spool_file:
+                response, handle = cancellable_get(
+                    flight.url, flight.cancel_token, headers=DEFAULT_HEADERS, stream=True, timeout=self.timeout
+                )
+                response.raise_for_status()
+                with flight.condition:
+                    flight.headers = {
+                        'content_type': response.headers.get('Content-Type', ''),
+                        'content_length': response.headers.get('Content-Length')
+                    }
+                    flight.condition.notify_all()
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if not chunk:
+                        continue
+                    spool_file.write(chunk)
+                    spool_file.flush()
+                    with flight.condition:
+                        flight.written += len(chunk)
+                        flight.condition.notify_all()
+        except Exception as e:
+            if not flight.cancel_token.cancelled:
+                logger.error(f"代理下载失败: {flight.url}, 错误: {str(e)}")
+            with flight.condition:
+                flight.error = e
+        finally:
+            flight.cancel_token.unregister(handle)
+            if response is not None:
+                response.close()
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+            if flight.error is not None:
+                # 之后的请求重新发起下载
+                self._forget(flight)
+            self._maybe_finalize(flight)
+
+    def _forget(self, flight):
+        """从进行中的下载中移除，之后的请求不再加入"""
+        with self.lock:
+            if self.flights.get(flight.url) is flight:
+                del self.flights[flight.url]
+
+    def _release(self, flight):
+        """一个读取者结束：没有读取者且无需保存时中止上游下载"""
+        with flight.condition:
+            flight.readers -= 1
+            abandon = flight.readers == 0 and not flight.done and flight.save_as is None
+            # 唤醒在其他线程中等待数据的读取（例如向ffmpeg写入数据的线程）
+            flight.condition.notify_all()
+        if abandon:
+            logger.info(f"所有客户端已断开，中止代理下载: {flight.url}")
+            self._forget(flight)
+            flight.cancel_token.cancel()
+        self._maybe_finalize(flight)
+
+    def _maybe_finalize(self, flight):
+        """下载结束且没有读取者时，保存或删除暂存文件（下载结束后、最后一个读取者结束前，新请求仍可加入）"""
+        with flight.condition:
+            if flight.finalized or not flight.done or flight.readers > 0:
+                return
+            flight.finalized = True
+            save = flight.save_as is not None and flight.error is None
+        self._forget(flight)
+        try:
+            if save and self.on_complete:
+                self.on_complete(flight.spool_path, flight.headers, flight.save_as)
+        except Exception as e:
+            logger.exception(f"保存代理下载失败: {flight.url}, 错误: {str(e)}")
+        finally:
+            try:
+                if os.path.exists(flight.spool_path):
+                    os.remove(flight.spool_path)
+            except OSError as e:
+                logger.warning(f"删除暂存文件失败: {flight.spool_path}, 错误: {str(e)}")
+
+    def record_library_hit(self):
+        """记录一次由本地文件满足、无需打开上游下载的请求"""
+        with self.lock:
+            self.stats['library_hits'] += 1
+
+    def get_stats(self):
+        """获取统计：进行中的下载数、下载库命中次数、上游请求次数、合并的请求次数和命中率"""
+        with self.lock:
+            total = sum(self.stats.values())
+            return {
+                'active': len(self.flights),
+                **self.stats,
+                'library_hit_ratio': round(self.stats['library_hits'] / total, 4) if total else 0.0
+            }
@@ -0,0 +1,237 @@
+"""
+下载库的存储后端
+    local: 文件保存在下载目录中（默认）
+    s3:    文件保存在S3兼容的对象存储中（AWS S3、MinIO等，需要安装boto3）；下载时数据边接收边分片上传，
+           不在本地落盘，/downloads/<file_id> 重定向到预签名URL，由对象存储直接发送文件
+元数据中的 storage 字段记录条目所在的后端（没有该字段的属于local），切换后端后已有的文件仍可访问
+"""
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+STORAGE_LOCAL = 'local'
+STORAGE_S3 = 's3'
+
+# S3分片上传要求除最后一片外每片不小于5MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+def entry_storage(info):
+    """条目所在的存储后端"""
+    return info.get('storage') or STORAGE_LOCAL
+
+def _is_not_found(error):
+    """对象存储返回的是否为对象不存在（不依赖botocore的异常类型）"""
+    response = getattr(error, 'response', None) or {}
+    code = str(response.get('Error', {}).get('Code', ''))
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+class LocalWriter:
+    """写入本地文件：先写.part临时文件，完整写入后再改名，避免留下不完整的文件"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.part_path = f"{file_path}.part"
+        self.size = 0
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.file = open(self.part_path, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """完成写入，返回需要记录到元数据中的存储字段"""
+        self.file.close()
+        os.replace(self.part_path, self.file_path)
+        return {}
+
+    def abort(self):
+        """放弃写入，删除未完成的文件"""
+        self.file.close()
+        try:
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+        except OSError:
+            pass
+
+class LocalStorage:
+    name = STORAGE_LOCAL
+
+    def __init__(self, root):
+        self.root = root
+
+    def open_writer(self, file_path, content_type=None):
+        return LocalWriter(file_path)
+
+    def path_taken(self, file_path):
+        """该路径是否已被占用（用于处理文件名冲突）"""
+        return os.path.exists(file_path)
+
+    def exists(self, info):
+        return os.path.exists(info['file_path'])
+
+    def delete(self, info):
+        if os.path.exists(info['file_path']):
+            os.remove(info['file_path'])
+
+    def get_download_url(self, info, content_disposition=None, content_type=None):
+        """本地文件由应用（或前端服务器）发送，没有外部URL"""
+        return None
+
+class S3MultipartWriter:
+    """
+    分片上传到对象存储：数据在内存中攒够一个分片就上传，内存占用不超过一个分片；
+    不足一个分片的小文件在提交时用一次PutObject上传
+    """
+    def __init__(self, storage, key, content_type=None):
+        self.client = storage.client
+        self.bucket = storage.bucket
+        self.key = key
+        self.part_size = storage.part_size
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def _extra_args(self):
+        return {'ContentType': self.content_type} if self.content_type else {}
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self._extra_args())
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(data)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+
+    def commit(self):
+        """完成上传，返回需要记录到元数据中的存储字段"""
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self._extra_args())
+        else:
+            if self.buffer:
+                self._upload_part(self.buffer)
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts}
+            )
+        self.buffer = bytearray()
+        return {'storage': STORAGE_S3, 'object_key': self.key}
+
+    def abort(self):
+        """放弃上传，清理已上传的分片（未完成的分片上传仍会占用存储空间）"""
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.warning(f"取消分片上传失败: {self.key}, 错误: {str(e)}")
+
+class S3Storage:
+    name = STORAGE_S3
+
+    def __init__(self, bucket, root, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 part_size=8 * 1024 * 1024, presign_expires=3600, client=None):
+        """
+        参数:
+            bucket: 存储桶
+            root: 下载目录，对象键为文件相对于下载目录的路径（与本地的目录布局一致）
+            prefix: 对象键前缀
+            endpoint_url: S3兼容服务的地址（例如MinIO），使用AWS S3时为None
+            region/access_key/secret_key: 未提供时使用boto3的默认配置（环境变量、配置文件等）
+            part_size: 分片大小（字节），不小于5MB
+            presign_expires: 预签名下载URL的有效期（秒）
+            client: 可选，已创建的S3客户端
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("S3分片大小不能小于5MB")
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("使用S3存储后端需要安装boto3: pip install boto3")
+            client = boto3.client(
+                's3',
+                endpoint_url=endpoint_url or None,
+                region_name=region or None,
+                aws_access_key_id=access_key or None,
+                aws_secret_access_key=secret_key or None
+            )
+        self.client = client
+        self.bucket = bucket
+        self.root = root
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip('/') else ''
+        self.part_size = part_size
+        self.presign_expires = presign_expires
+
+    def key_for(self, file_path):
+        """文件路径对应的对象键"""
+        relative = os.path.relpath(file_path, self.root).replace(os.sep, '/')
+        return f"{self.prefix}{relative}"
+
+    def open_writer(self, file_path, content_type=None):
+        return S3MultipartWriter(self, self.key_for(file_path), content_type)
+
+    def path_taken(self, file_path):
+        """
+        该路径是否已被占用：对象存储和本地共用同一组file_path（启用对象存储前的本地文件、
+        流式保存和待上传的文件仍在本地），本地已有同名文件或已有同名对象都视为占用
+        """
+        if os.path.exists(file_path):
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key_for(file_path))
+            return True
+        except Exception as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+    def exists(self, info):
+        """对象只由本应用写入和删除，以元数据为准（列表中的每一项不单独发送HEAD请求）"""
+        return bool(info.get('object_key'))
+
+    def delete(self, info):
+        self.client.delete_object(Bucket=self.bucket, Key=info['object_key'])
+
+    def upload_file(self, local_path, file_path, content_type=None):
+        """
+        把本地文件上传到对应的对象键（例如代理下载保存的文件）
+        返回: 需要记录到元数据中的存储字段
+        """
+        writer = self.open_writer(file_path, content_type)
+        try:
+            with open(local_path, 'rb') as f:
+                while True:
+                    data = f.read(self.part_size)
+                    if not data:
+                        break
+                    writer.write(data)
+            return writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def get_download_url(self, info, content_disposition=None, content_type=None):
+        """生成预签名的下载URL，对象存储按参数返回Content-Disposition和Content-Type"""
+        params = {'Bucket': self.bucket, 'Key': info['object_key']}
+        if content_disposition:
+            params['ResponseContentDisposition'] = content_disposition
+        if content_type:
+            params['ResponseContentType'] = content_type
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.presign_expires)
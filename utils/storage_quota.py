@@ -0,0 +1,197 @@
+"""
+存储配额
+按用户和全局限制下载库占用的字节数，新文件放不下时按最近播放时间（没有播放过的按下载时间）淘汰最久未使用的文件，
+固定（pinned）的文件不会被淘汰
+多个用户共享的文件计入每个所有者的配额；为满足用户配额淘汰共享文件时只移除该用户的引用，
+文件的最后一个引用被移除或为满足全局配额时才删除文件
+在内存中维护按使用时间排序的可淘汰文件索引和各用户的占用量，选择淘汰对象不需要排序全部元数据
+"""
+import bisect
+from utils.download_index import entry_owners
+
+class QuotaExceededError(Exception):
+    """超出存储配额，且淘汰未固定的文件也无法腾出足够空间"""
+
+def parse_user_quotas(value):
+    """
+    解析按用户设置的配额，格式 "alice=2048,bob=512"（单位MB，0表示不限制）
+    返回: {用户名: 字节数}
+    """
+    quotas = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        username, _, megabytes = item.partition('=')
+        try:
+            quotas[username.strip()] = int(float(megabytes) * 1024 * 1024)
+        except ValueError:
+            raise ValueError(f"无效的用户配额: {item}")
+    return quotas
+
+class StorageQuota:
+    def __init__(self, global_bytes=0, user_bytes=0, user_overrides=None):
+        """
+        参数:
+            global_bytes: 下载库总配额（字节），0表示不限制
+            user_bytes: 每个用户的默认配额（字节），0表示不限制
+            user_overrides: 可选，{用户名: 字节数}，覆盖默认的用户配额
+        """
+        self.global_bytes = global_bytes
+        self.user_bytes = user_bytes
+        self.user_overrides = user_overrides or {}
+        # file_id -> (使用时间, 所有者, 大小, 是否固定)
+        self.entries = {}
+        # 未固定的文件，按 (使用时间, file_id) 升序排列，最前面的最先淘汰
+        self.order = []
+        # 用户名 -> 该用户拥有的未固定文件，排序同上
+        self.user_order = {}
+        self.used = 0
+        self.user_used = {}
+        self.pinned_bytes = 0
+        self.stats = {'evicted_files': 0, 'evicted_bytes': 0, 'released_references': 0, 'rejected': 0}
+
+    @property
+    def enabled(self):
+        return bool(self.global_bytes or self.user_bytes or any(self.user_overrides.values()))
+
+    def limit_for(self, username):
+        """用户的配额（字节），不限制时返回None"""
+        limit = self.user_overrides.get(username, self.user_bytes)
+        return limit or None
+
+    @staticmethod
+    def _state(info):
+        return (
+            info.get('last_accessed') or info.get('downloaded_at') or '',
+            tuple(entry_owners(info)),
+            info.get('size') or 0,
+            bool(info.get('pinned'))
+        )
+
+    def _add(self, file_id, state):
+        used_at, owners, size, pinned = state
+        self.entries[file_id] = state
+        self.used += size
+        for username in owners:
+            self.user_used[username] = self.user_used.get(username, 0) + size
+        if pinned:
+            self.pinned_bytes += size
+            return
+        key = (used_at, file_id)
+        bisect.insort(self.order, key)
+        for username in owners:
+            bisect.insort(self.user_order.setdefault(username, []), key)
+
+    def _remove(self, file_id):
+        used_at, owners, size, pinned = self.entries.pop(file_id)
+        self.used -= size
+        for username in owners:
+            self.user_used[username] -= size
+            if not self.user_used[username]:
+                del self.user_used[username]
+        if pinned:
+            self.pinned_bytes -= size
+            return
+        key = (used_at, file_id)
+        for keys in [self.order] + [self.user_order.get(username, []) for username in owners]:
+            index = bisect.bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+        for username in owners:
+            if username in self.user_order and not self.user_order[username]:
+                del self.user_order[username]
+
+    def update(self, file_id, info):
+        """添加或更新一个条目"""
+        state = self._state(info)
+        if self.entries.get(file_id) == state:
+            return
+        if file_id in self.entries:
+            self._remove(file_id)
+        self._add(file_id, state)
+
+    def discard(self, file_id):
+        """移除一个条目"""
+        if file_id in self.entries:
+            self._remove(file_id)
+
+    def sync(self, metadata):
+        """与元数据对比，更新变化的条目（调用方需持有下载管理器的锁）"""
+        for file_id, info in metadata.items():
+            self.update(file_id, info)
+        for file_id in [file_id for file_id in self.entries if file_id not in metadata]:
+            self._remove(file_id)
+
+    def plan_eviction(self, username, size, exclude=()):
+        """
+        为用户新增size字节选择需要淘汰的文件：先淘汰该用户最久未使用的文件满足用户配额，
+        再从全部用户中淘汰满足全局配额
+        exclude: 不能淘汰的file_id（例如正在保存的文件本身）
+        返回: {file_id: 用户名或None}（可能为空），用户名表示只移除该用户的引用，None表示删除文件；
+              淘汰所有未固定的文件也放不下时返回None
+        """
+        victims = {}
+        freed = 0
+        freed_user = 0
+
+        user_limit = self.limit_for(username)
+        if user_limit is not None:
+            need = self.user_used.get(username, 0) + size - user_limit
+            for _, file_id in self.user_order.get(username, []):
+                if freed_user >= need:
+                    break
+                if file_id in exclude:
+                    continue
+                owners, file_size = self.entries[file_id][1:3]
+                freed_user += file_size
+                if len(owners) > 1:
+                    victims[file_id] = username
+                else:
+                    victims[file_id] = None
+                    freed += file_size
+            if freed_user < need:
+                return None
+
+        if self.global_bytes:
+            need = self.used + size - self.global_bytes
+            for _, file_id in self.order:
+                if freed >= need:
+                    break
+                if file_id in exclude or (file_id in victims and victims[file_id] is None):
+                    continue
+                # 按全局配额删除文件（包括上面只移除了引用的共享文件）
+                victims[file_id] = None
+                freed += self.entries[file_id][2]
+            if freed < need:
+                return None
+        return victims
+
+    def record_eviction(self, size):
+        self.stats['evicted_files'] += 1
+        self.stats['evicted_bytes'] += size
+
+    def record_release(self):
+        self.stats['released_references'] += 1
+
+    def record_rejection(self):
+        self.stats['rejected'] += 1
+
+    def get_status(self):
+        """获取配额和占用情况（调用方需持有下载管理器的锁）"""
+        users = {}
+        for username in sorted(set(self.user_used) | set(self.user_overrides)):
+            users[username] = {
+                'used_bytes': self.user_used.get(username, 0),
+                'limit_bytes': self.limit_for(username)
+            }
+        return {
+            'enabled': self.enabled,
+            'global': {
+                'used_bytes': self.used,
+                'limit_bytes': self.global_bytes or None,
+                'pinned_bytes': self.pinned_bytes
+            },
+            'default_user_limit_bytes': self.user_bytes or None,
+            'users': users,
+            **self.stats
+        }
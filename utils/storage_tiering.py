@@ -0,0 +1,282 @@
+"""
+存储分层：把长时间未播放的旧节目重新压缩为适合语音的小体积格式
+"""
+import os
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+from utils.audio_converter import AUDIO_FORMATS, convert_audio, get_audio_format, probe_audio, parse_bitrate, check_ffmpeg
+from utils.coordination import make_owner_id, LEADER_RECHECK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 语音优化的编码参数：单声道，opus使用voip模式
+SPEECH_ARGS = {
+    'opus': ['-ac', '1', '-application', 'voip'],
+    'aac': ['-ac', '1'],
+    'm4a': ['-ac', '1'],
+    'mp3': ['-ac', '1'],
+}
+
+# 认领超过该秒数仍未释放视为认领进程已退出，其他进程可以重新认领
+CLAIM_TTL = 6 * 3600
+
+class StorageTiering:
+    def __init__(self, download_manager, max_age_days=90, target_format='opus', bitrate='32k',
+                 threads=1, throttle=1.0):
+        """
+        参数:
+            download_manager: DownloadManager实例
+            max_age_days: 超过多少天未访问（无访问记录时按下载时间）的节目才会重新压缩
+            target_format: 目标格式（AUDIO_FORMATS中的键）
+            bitrate: 目标比特率
+            threads: ffmpeg线程数
+            throttle: CPU节流系数，每处理完一个文件休眠 处理耗时×throttle 秒（1.0约为50%占空比）
+        """
+        if target_format not in AUDIO_FORMATS:
+            raise ValueError(f"不支持的目标格式: {target_format}")
+        self.download_manager = download_manager
+        self.max_age_days = max_age_days
+        self.target_format = target_format
+        self.bitrate = bitrate
+        self.threads = threads
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.last_report = None
+        self.total_reclaimed_bytes = 0
+        self.owner_id = make_owner_id()
+
+    def _is_candidate(self, info, cutoff):
+        """判断文件是否需要重新压缩"""
+        if info.get('tiered'):
+            return False
+        # 对象存储中的文件不在本地，无法转码
+        if not self.download_manager.is_local(info):
+            return False
+        file_path = info.get('file_path')
+        if not file_path or not os.path.exists(file_path):
+            return False
+        if self._claimed_elsewhere(info):
+            return False
+        last_used = info.get('last_accessed') or info.get('downloaded_at')
+        if not last_used:
+            return False
+        try:
+            if datetime.fromisoformat(last_used) > cutoff:
+                return False
+        except ValueError:
+            return False
+        return True
+
+    def _claimed_elsewhere(self, info):
+        """文件是否已被其他进程认领且认领未过期"""
+        claim = info.get('tiering_claim')
+        if not claim or claim.get('owner') == self.owner_id:
+            return False
+        try:
+            claimed_at = datetime.fromisoformat(claim.get('at'))
+        except (TypeError, ValueError):
+            return False
+        return datetime.now() - claimed_at < timedelta(seconds=CLAIM_TTL)
+
+    def _claim(self, file_id, file_path):
+        """
+        在元数据事务中认领文件，避免多个进程同时重新压缩同一个文件
+        返回: 是否认领成功（文件已被删除、替换、压缩或被其他进程认领时返回False）
+        """
+        manager = self.download_manager
+        with manager.lock:
+            with manager._file_lock():
+                # 先在锁内检查，认领失败时不开启事务，避免无谓地重写metadata.json
+                manager._refresh_metadata()
+                info = manager.metadata.get(file_id)
+                if not info or info.get('file_path') != file_path or info.get('tiered') or self._claimed_elsewhere(info):
+                    return False
+                with manager.metadata_transaction() as metadata:
+                    metadata[file_id]['tiering_claim'] = {'owner': self.owner_id, 'at': datetime.now().isoformat()}
+                return True
+
+    def _release(self, file_id):
+        """释放本进程对文件的认领"""
+        manager = self.download_manager
+        with manager.lock:
+            with manager._file_lock():
+                manager._refresh_metadata()
+                info = manager.metadata.get(file_id)
+                if not info or (info.get('tiering_claim') or {}).get('owner') != self.owner_id:
+                    return
+                with manager.metadata_transaction() as metadata:
+                    del metadata[file_id]['tiering_claim']
+
+    def _already_compact(self, file_path):
+        """已是目标格式且比特率不高于目标时无需处理"""
+        if get_audio_format(file_path) != self.target_format:
+            return False
+        info = probe_audio(file_path)
+        target_bps = parse_bitrate(self.bitrate)
+        return bool(info and info.get('bit_rate') and target_bps and info['bit_rate'] <= target_bps * 1.1)
+
+    def _recompress(self, file_id, info):
+        """
+        重新压缩单个文件并原子地更新元数据
+        返回: 节省的字节数，失败或不划算时返回None
+        """
+        file_path = info['file_path']
+        if self._already_compact(file_path):
+            self.download_manager.update_file_info(file_id, expected_path=file_path, tiered=True)
+            return None
+
+        old_size = os.path.getsize(file_path)
+        ext = AUDIO_FORMATS[self.target_format]['ext']
+        output_path = f"{os.path.splitext(file_path)[0]}.{ext}"
+        if output_path == file_path:
+            output_path = f"{os.path.splitext(file_path)[0]}.tiered.{ext}"
+
+        success, output_path, error = convert_audio(
+            file_path, output_path, self.target_format,
+            bitrate=self.bitrate,
+            threads=self.threads,
+            extra_args=SPEECH_ARGS.get(self.target_format),
+            low_priority=True
+        )
+        if not success:
+            logger.error(f"分层压缩失败 - 文件ID: {file_id}, 错误: {error}")
+            return None
+
+        new_size = os.path.getsize(output_path)
+        if new_size >= old_size:
+            # 压缩后反而更大，保留原文件
+            os.remove(output_path)
+            self.download_manager.update_file_info(file_id, expected_path=file_path, tiered=True)
+            return None
+
+        # 元数据仍指向原文件时才替换，避免覆盖并发的删除或转换
+        updated = self.download_manager.update_file_info(
+            file_id,
+            expected_path=file_path,
+            filename=os.path.basename(output_path),
+            file_path=output_path,
+            size=new_size,
+            tiered=True,
+            tiered_at=datetime.now().isoformat(),
+            original_size=old_size
+        )
+        if not updated:
+            logger.warning(f"文件元数据已变化，放弃分层结果 - 文件ID: {file_id}")
+            os.remove(output_path)
+            return None
+
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            logger.warning(f"删除原文件失败: {file_path}, 错误: {str(e)}")
+        logger.info(f"分层压缩完成 - 文件ID: {file_id}, {old_size} -> {new_size} 字节")
+        return old_size - new_size
+
+    def run_once(self, max_age_days=None):
+        """
+        执行一轮分层压缩
+        返回: 本轮报告（扫描数、压缩数、失败数、节省字节数等）
+        """
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+
+        max_age_days = self.max_age_days if max_age_days is None else max_age_days
+        report = {
+            'started_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'max_age_days': max_age_days,
+            'target_format': self.target_format,
+            'bitrate': self.bitrate,
+            'scanned': 0,
+            'recompressed': 0,
+            'skipped': 0,
+            'failed': 0,
+            'reclaimed_bytes': 0
+        }
+        self.last_report = report
+        try:
+            if not check_ffmpeg():
+                report['error'] = 'ffmpeg未安装或不在PATH中'
+                return report
+
+            cutoff = datetime.now() - timedelta(days=max_age_days)
+            with self.download_manager.lock:
+                self.download_manager._refresh_metadata()
+                candidates = [
+                    (file_id, dict(info)) for file_id, info in self.download_manager.metadata.items()
+                    if self._is_candidate(info, cutoff)
+                ]
+            report['scanned'] = len(candidates)
+
+            for file_id, info in candidates:
+                if not self._claim(file_id, info['file_path']):
+                    report['skipped'] += 1
+                    continue
+                start = time.time()
+                try:
+                    reclaimed = self._recompress(file_id, info)
+                except Exception as e:
+                    logger.exception(f"分层压缩异常 - 文件ID: {file_id}, 异常: {str(e)}")
+                    reclaimed = None
+                    report['failed'] += 1
+                else:
+                    if reclaimed is None:
+                        report['skipped'] += 1
+                    else:
+                        report['recompressed'] += 1
+                        report['reclaimed_bytes'] += reclaimed
+                        self.total_reclaimed_bytes += reclaimed
+                finally:
+                    self._release(file_id)
+                # CPU节流：按处理耗时休眠，让出CPU给前台请求
+                if self.throttle > 0:
+                    time.sleep((time.time() - start) * self.throttle)
+            return report
+        finally:
+            report['finished_at'] = datetime.now().isoformat()
+            logger.info(f"分层压缩完成 - 压缩{report['recompressed']}个文件，节省{report['reclaimed_bytes'] / 1024 / 1024:.2f} MB")
+            with self.lock:
+                self.running = False
+
+    def start_background_thread(self, interval_hours=24, should_run=None):
+        """
+        启动后台线程，定期执行分层压缩
+
+        参数:
+            interval_hours: 执行间隔（小时）
+            should_run: 可选，返回本进程是否应执行的函数（多进程部署时只由主节点执行），
+                        返回False时跳过本轮并在LEADER_RECHECK_SECONDS秒后重新检查
+        """
+        if self.thread:
+            return
+
+        def background_worker():
+            while True:
+                if should_run and not should_run():
+                    time.sleep(LEADER_RECHECK_SECONDS)
+                    continue
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.exception(f"分层压缩任务执行失败: {str(e)}")
+                time.sleep(interval_hours * 3600)
+
+        self.thread = threading.Thread(target=background_worker, daemon=True)
+        self.thread.start()
+
+    def get_status(self):
+        """获取分层压缩状态"""
+        return {
+            'running': self.running,
+            'max_age_days': self.max_age_days,
+            'target_format': self.target_format,
+            'bitrate': self.bitrate,
+            'total_reclaimed_bytes': self.total_reclaimed_bytes,
+            'last_report': self.last_report
+        }
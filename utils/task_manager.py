@@ -6,23 +6,168 @@ import time
 import uuid
 import os
 import logging
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 from utils.rss_parser import get_episodes_from_rss, check_rss_update
 from utils.download_manager import DownloadManager
+from utils.download_index import entry_owners
 from utils.audio_converter import convert_m4a_to_mp3, get_audio_format, check_ffmpeg
+from utils.pipeline import Pipeline, PipelineStage
+from utils.scheduler import TaskScheduler, PRIORITY_INTERACTIVE, PRIORITY_MONITOR, PRIORITIES
+from utils.cancellation import CancelToken
+from utils.retry import RetryPolicy, RetryQueue
+from utils.transfer_stats import TransferStats
+from utils.coordination import LeaderElection, make_owner_id, ROLE_ALL, ROLE_API, ROLES
 
 logger = logging.getLogger(__name__)
 
+# 已结束的任务状态
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+# 任务摘要中附带的最近结果条数
+RECENT_RESULTS = 5
+# 多进程部署时共享任务队列的名称和租约
+DOWNLOAD_QUEUE = 'download_latest'
+JOB_LEASE_SECONDS = 60
+MONITOR_LEADER_LEASE = 'monitor-scheduler'
+
+def _file_size(path):
+    """获取文件大小，文件不存在时返回0"""
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+def _compact_result(result):
+    """
+    精简结果记录：只保留标题、file_id、状态、字节数和耗时
+    兼容旧格式（内嵌完整节目信息的结果）
+    """
+    if 'episode' not in result:
+        return result
+    compact = {
+        'title': (result.get('episode') or {}).get('title'),
+        'file_id': result.get('file_id'),
+        'status': 'completed' if result.get('success') else 'failed',
+        'bytes': result.get('bytes', 0),
+        'duration': result.get('duration')
+    }
+    for key in ('attempts', 'error', 'error_class'):
+        if key in result:
+            compact[key] = result[key]
+    return compact
+
 class TaskManager:
-    def __init__(self, download_manager):
+    def __init__(self, download_manager, pipeline_queue_size=2, store=None, scheduler=None, retry_policy=None,
+                 history_limit=100, history_max_age_days=7, coordinator=None, role=ROLE_ALL, sync_interval=2.0):
+        """
+        参数:
+            download_manager: DownloadManager实例
+            pipeline_queue_size: 流水线阶段之间的队列容量（下载 -> 转换 -> 提交）
+            store: 可选的TaskStore，用于持久化任务、监听游标和工作项，重启后继续未完成的工作
+            scheduler: 可选的TaskScheduler，限制同时执行的任务数并按优先级和用户公平调度
+            retry_policy: 可选的RetryPolicy，下载失败时的重试策略
+            history_limit: 内存中保留的已结束任务数上限，超出的最旧任务被移出（有store时归档）
+            history_max_age_days: 已结束任务在内存中保留的天数
+            coordinator: 可选的Coordinator，多进程部署时共享任务队列、选主和取消请求（需要同时提供store）
+            role: 进程角色（all/api/worker）：api只提交任务不执行，worker只执行任务，all两者兼有
+            sync_interval: 多进程部署时从store同步其他进程任务状态的间隔秒数
+        """
+        if role not in ROLES:
+            raise ValueError(f"未知的进程角色: {role}")
+        if coordinator and not store:
+            raise ValueError("多进程部署需要同时提供TaskStore")
+        if role != ROLE_ALL and not coordinator:
+            raise ValueError(f"角色 {role} 需要配置协调后端")
         self.download_manager = download_manager
+        self.pipeline_queue_size = pipeline_queue_size
+        self.store = store
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.history_limit = history_limit
+        self.history_max_age_days = history_max_age_days
+        self.scheduler = scheduler or TaskScheduler()
+        self.scheduler.start()
         self.tasks = {}
         self.running = False
+        # 进程停止时中断的任务保存为pending，重启后继续
+        self.shutting_down = False
         self.thread = None
         self.lock = threading.Lock()
+        # 已提交到调度器、尚未执行完的监听检查，避免同一任务重复排队
+        self.monitor_checks_inflight = set()
+        # 正在执行的任务的取消令牌，取消时中断进行中的下载和转换
+        self.cancel_tokens = {}
+        # 正在执行的任务的字节级下载统计（吞吐量、ETA、TTFB）
+        self.transfers = {}
+        # 任务变更日志：(版本号, task_id, 是否已移除)，供SSE等订阅者增量获取变化
+        self.change_condition = threading.Condition()
+        self.change_version = 0
+        self.change_log = deque(maxlen=1000)
+        # 多进程协调：共享队列中本进程领取的任务，监听检查只在主节点执行
+        self.coordinator = coordinator
+        self.role = role
+        self.sync_interval = sync_interval
+        self.owner_id = make_owner_id()
+        self.claimed_jobs = set()
+        self.store_versions = {}
+        self.leader = None
+        if coordinator and role != ROLE_API:
+            self.leader = LeaderElection(coordinator, MONITOR_LEADER_LEASE, owner=self.owner_id)
+        self._restore_tasks()
+    
+    def _restore_tasks(self):
+        """从持久化存储加载任务"""
+        if not self.store:
+            return
+        for task in self.store.load_tasks():
+            if task.get('results'):
+                task['results'] = [_compact_result(r) for r in task['results']]
+            self.tasks[task['task_id']] = task
+        if self.tasks:
+            logger.info(f"已从任务存储恢复{len(self.tasks)}个任务")
+        self.prune_history()
     
-    def create_download_latest_task(self, username, subscriptions, count, convert_to_mp3=False):
-        """创建下载最新N集任务"""
+    def _task_updated(self, task):
+        """任务状态变化：通知订阅者并保存到持久化存储"""
+        self._publish_change(task['task_id'])
+        self._persist_task(task)
+    
+    def _persist_task(self, task):
+        """保存任务到持久化存储"""
+        if not self.store:
+            return
+        try:
+            with self.lock:
+                self.store.save_task(task)
+        except Exception as e:
+            logger.warning(f"保存任务失败 - 任务ID: {task.get('task_id')}, 错误: {str(e)}")
+    
+    def resume_tasks(self):
+        """继续执行重启前未完成的下载任务，已完成的工作项不会重复执行"""
+        if self.coordinator:
+            # 共享队列按task_id去重，正在其他进程中执行的任务不会重复提交
+            with self.lock:
+                unfinished = [
+                    t['task_id'] for t in self.tasks.values()
+                    if t['type'] == 'download_latest' and t['status'] in ('pending', 'running')
+                ]
+            for task_id in unfinished:
+                self._dispatch_download_latest_task(task_id)
+            return
+        with self.lock:
+            unfinished = [
+                t for t in self.tasks.values()
+                if t['type'] == 'download_latest' and t['status'] in ('pending', 'running')
+            ]
+            for task in unfinished:
+                task['status'] = 'pending'
+                task['resumed_at'] = datetime.now().isoformat()
+        for task in unfinished:
+            logger.info(f"继续执行未完成的任务: {task['task_id']}")
+            self._execute_download_latest_task(task['task_id'])
+    
+    def create_download_latest_task(self, username, subscriptions, count, convert_to_mp3=False,
+                                    priority=PRIORITY_INTERACTIVE):
+        """创建下载最新N集任务，priority为调度优先级（interactive或backfill）"""
         task_id = str(uuid.uuid4())
         
         task = {
@@ -34,6 +179,7 @@ class TaskManager:
             'subscriptions': subscriptions,
             'count': count,
             'convert_to_mp3': convert_to_mp3,
+            'priority': priority,
             'progress': {
                 'total': len(subscriptions) * count,  # 修复：总数应该是订阅数 * 每个订阅的集数
                 'completed': 0,
@@ -44,9 +190,10 @@ class TaskManager:
         
         with self.lock:
             self.tasks[task_id] = task
+        self._task_updated(task)
         
         # 立即开始执行任务
-        self._execute_download_latest_task(task_id)
+        self._dispatch_download_latest_task(task_id)
         
         return task_id
     
@@ -69,76 +216,348 @@ class TaskManager:
         
         with self.lock:
             self.tasks[task_id] = task
+        self._task_updated(task)
         
         return task_id
     
-    def _execute_download_latest_task(self, task_id):
-        """执行下载最新N集任务"""
-        def run_task():
+    def _dispatch_download_latest_task(self, task_id):
+        """提交下载任务：多进程部署时放入共享队列由任意工作进程领取，否则在本进程执行"""
+        if self.coordinator:
+            self.coordinator.enqueue(DOWNLOAD_QUEUE, task_id, {'task_id': task_id})
+        else:
+            self._execute_download_latest_task(task_id)
+    
+    def _execute_download_latest_task(self, task_id, on_done=None):
+        """
+        执行下载最新N集任务
+        on_done: 可选回调，任务执行结束（包括排队期间已取消而跳过）后调用
+        剩余的重试都要等待较长时间（例如服务器的Retry-After）时，任务让出工作线程，
+        由调度器在重试到期时继续执行，期间任务保持running状态
+        """
+        def run_task(retries=None):
+            """执行任务，retries为上次让出工作线程时的重试队列；返回是否已延后继续"""
+            resuming = retries is not None
             with self.lock:
                 if task_id not in self.tasks:
-                    return
+                    return False
                 task = self.tasks[task_id]
-                task['status'] = 'running'
+                if task['status'] != ('running' if resuming else 'pending'):
+                    # 排队或等待重试期间已被取消
+                    return False
+                if not resuming:
+                    task['status'] = 'running'
+                    task['started_at'] = datetime.now().isoformat()
+                task.pop('retry_at', None)
+                task.setdefault('resolved_subscriptions', [])
+                cancel_token = self.cancel_tokens[task_id] = CancelToken()
+                transfer = self.transfers.get(task_id) if resuming else None
+            self._task_updated(task)
+            
+            retries = retries or RetryQueue(self.retry_policy)
+            transfer = transfer or self._start_transfer(task_id)
+            retry_at = None
             
+            def on_commit(item):
+                with self.lock:
+                    # 只保存精简的结果记录，节目的完整信息（描述等）已在下载元数据中
+                    result = {
+                        'title': item['episode'].get('title'),
+                        'file_id': item['file_id'],
+                        'status': 'completed' if item['success'] else 'failed',
+                        'bytes': item.get('bytes', 0),
+                        'duration': item.get('duration')
+                    }
+                    if item.get('attempts'):
+                        result['attempts'] = item['attempts'] + 1
+                    if item.get('error'):
+                        result['error'] = item['error']
+                        result['error_class'] = item['error_class']
+                    task['results'].append(result)
+                    if item['success']:
+                        task['progress']['completed'] += 1
+                    else:
+                        task['progress']['failed'] += 1
+                    task['pipeline'] = pipeline.get_stats()
+                    task['retries'] = retries.get_stats()
+                self._finish_work_item(task, item)
+            
+            def on_error(stage_name, item, error):
+                with self.lock:
+                    task['progress']['failed'] += 1
+                self._finish_work_item(task, item, success=False)
+            
+            pipeline = self._build_episode_pipeline(
+                task, on_commit, on_error, name=f"task-{task_id[:8]}", cancel_token=cancel_token, retries=retries,
+                transfer=transfer
+            )
+            pipeline.start()
             try:
-                for sub_idx, subscription in enumerate(task['subscriptions']):
+                # 继续执行时订阅已全部处理，只等待重试
+                for sub_idx, subscription in ([] if resuming else enumerate(task['subscriptions'])):
+                    if cancel_token.cancelled:
+                        break
                     rss_url = subscription.get('xmlUrl', '')
                     if not rss_url:
                         continue
                     
                     try:
-                        episodes = get_episodes_from_rss(rss_url)
-                        # 取最新的N集
-                        latest_episodes = episodes[:task['count']]
+                        if sub_idx in task['resolved_subscriptions'] and self.store:
+                            # 重启前已解析过该订阅，只继续未完成的工作项
+                            work_items = [
+                                payload for _, _, payload in
+                                self.store.get_work_items(task_id, statuses=('pending',))
+                                if payload.get('sub_idx') == sub_idx
+                            ]
+                        else:
+                            episodes = get_episodes_from_rss(rss_url)
+                            # 取最新的N集
+                            latest_episodes = episodes[:task['count']]
+                            # 记录所属播客，用于按播客划分目录和下载列表显示
+                            work_items = [
+                                {
+                                    'item_key': episode['audio_url'],
+                                    'sub_idx': sub_idx,
+                                    'episode': dict(episode, podcast_title=subscription.get('title', ''))
+                                }
+                                for episode in latest_episodes if episode.get('audio_url')
+                            ]
+                            self._register_work_items(task, work_items)
+                            with self.lock:
+                                task['resolved_subscriptions'].append(sub_idx)
+                            self._task_updated(task)
                         
-                        for episode in latest_episodes:
-                            if episode.get('audio_url'):
-                                success, file_id, file_path = self.download_manager.download_file(
-                                    episode['audio_url'],
-                                    episode_info=episode,
-                                    username=task['username']
-                                )
-                                
-                                # 如果需要转换且下载成功
-                                if success and task.get('convert_to_mp3', False):
-                                    self._convert_downloaded_file(file_id, file_path)
-                                
-                                with self.lock:
-                                    task['results'].append({
-                                        'episode': episode,
-                                        'success': success,
-                                        'file_id': file_id
-                                    })
-                                    if success:
-                                        task['progress']['completed'] += 1
-                                    else:
-                                        task['progress']['failed'] += 1
+                        # 提交到流水线，下载与转换在各自的阶段线程中并行进行
+                        for work_item in work_items:
+                            if cancel_token.cancelled:
+                                break
+                            retries.track()
+                            pipeline.put(work_item)
                     except Exception as e:
                         print(f"处理订阅失败: {e}")
                         with self.lock:
                             task['progress']['failed'] += 1
                 
+                retry_at = self._drain_retries(pipeline, retries, cancel_token)
+                pipeline.close()
+                pipeline.join()
                 with self.lock:
-                    task['status'] = 'completed'
+                    task['pipeline'] = pipeline.get_stats()
+                    task['retries'] = retries.get_stats()
+                    # 执行期间被取消的任务保持cancelled状态
+                    if task['status'] == 'running':
+                        if cancel_token.cancelled and self.shutting_down:
+                            # 进程停止时被中断，未完成的工作项保持pending，重启后继续
+                            task['status'] = 'pending'
+                            task['interrupted_at'] = datetime.now().isoformat()
+                        elif retry_at is not None:
+                            task['retry_at'] = datetime.fromtimestamp(retry_at).isoformat()
+                        else:
+                            task['status'] = 'completed'
+                    if task['status'] != 'running':
+                        retry_at = None
             except Exception as e:
+                pipeline.close()
+                retry_at = None
                 with self.lock:
-                    task['status'] = 'failed'
-                    task['error'] = str(e)
+                    if task['status'] == 'running':
+                        task['status'] = 'failed'
+                        task['error'] = str(e)
+            finally:
+                with self.lock:
+                    self.cancel_tokens.pop(task_id, None)
+                if retry_at is None:
+                    self._finish_task_run(task)
+            self._task_updated(task)
+            if retry_at is None:
+                self.prune_history()
+                return False
+            logger.info(f"任务等待重试，让出工作线程 - 任务ID: {task_id}, 重试时间: {task['retry_at']}")
+            # 到期后继续；等待期间被取消或进程停止时从队列移除
+            self.scheduler.submit(
+                task_id, lambda: job(retries), user=username, priority=priority,
+                on_drop=lambda: self._drop_deferred_task(task), not_before=retry_at
+            )
+            return True
+        
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if not task:
+                return
+            username = task['username']
+            priority = task.get('priority', PRIORITY_INTERACTIVE)
         
-        thread = threading.Thread(target=run_task, daemon=True)
-        thread.start()
+        def job(retries=None):
+            deferred = False
+            try:
+                deferred = run_task(retries)
+            finally:
+                # 延后继续的任务由继续执行的job调用on_done
+                if on_done and not deferred:
+                    on_done()
+        # 交给调度器排队执行，同时运行的任务数受工作线程数限制
+        self.scheduler.submit(task_id, job, user=username, priority=priority)
+    
+    def _finish_task_run(self, task):
+        """下载任务执行结束（或被中断），保存下载统计并清理执行期间的字段"""
+        self._finish_transfer(task)
+        with self.lock:
+            task.pop('retry_at', None)
+            if task['status'] != 'pending':
+                task.setdefault('finished_at', datetime.now().isoformat())
+                # 只在执行期间需要的字段
+                task.pop('resolved_subscriptions', None)
+    
+    def _drop_deferred_task(self, task):
+        """
+        等待重试的任务被移出调度队列：取消时已是cancelled状态；进程停止时保存为pending，
+        重启后从未完成的工作项继续（共享队列中已领取的任务由取消/停止的调用方放回）
+        """
+        with self.lock:
+            if task['status'] == 'running':
+                task['status'] = 'pending'
+                task['interrupted_at'] = datetime.now().isoformat()
+        self._finish_task_run(task)
+        self._task_updated(task)
+    
+    def _start_transfer(self, task_id):
+        """创建任务的下载统计，下载进度变化时（限频）推送任务变化"""
+        transfer = TransferStats(on_progress=lambda: self._on_transfer_progress(task_id))
+        with self.lock:
+            self.transfers[task_id] = transfer
+        return transfer
+    
+    def _on_transfer_progress(self, task_id):
+        """下载进度变化，多进程部署时把实时统计写入store，供API进程读取"""
+        self._publish_change(task_id)
+        if not self.coordinator:
+            return
+        with self.lock:
+            task = self.tasks.get(task_id)
+            transfer = self.transfers.get(task_id)
+            if not task or not transfer:
+                return
+            task['transfer'] = transfer.get_stats()
+        self._persist_task(task)
+    
+    def _finish_transfer(self, task):
+        """任务执行结束，把最终的下载统计保存到任务中"""
+        with self.lock:
+            transfer = self.transfers.pop(task['task_id'], None)
+            if transfer:
+                stats = transfer.get_stats()
+                # 只保留汇总数据，实时字段对已结束的任务没有意义
+                for key in ('active_downloads', 'current_bytes_per_sec', 'eta_seconds'):
+                    del stats[key]
+                task['transfer'] = stats
+    
+    def _drain_retries(self, pipeline, retries, cancel_token):
+        """
+        所有工作项提交后，继续把到期的重试重新提交到流水线，直到没有待重试的工作项；
+        剩余的重试都要等待超过defer_after秒时不再占用工作线程等待
+        返回: 需要延后继续时为最早的重试到期时间，否则为None
+        """
+        while True:
+            work_item = retries.next_due(cancel_token, max_wait=retries.policy.defer_after)
+            if work_item is None:
+                break
+            retries.track()
+            pipeline.put(work_item)
+        if cancel_token.cancelled:
+            return None
+        return retries.defer()
+    
+    def _register_work_items(self, task, work_items):
+        """登记工作项到持久化存储，重启后据此继续"""
+        if not self.store or not work_items:
+            return
+        try:
+            self.store.add_work_items(task['task_id'], [(w['item_key'], w) for w in work_items])
+        except Exception as e:
+            logger.warning(f"登记工作项失败 - 任务ID: {task['task_id']}, 错误: {str(e)}")
+    
+    def _finish_work_item(self, task, item, success=None):
+        """标记工作项完成并保存任务进度"""
+        if success is None:
+            success = item.get('success', False)
+        try:
+            if self.store and item.get('item_key'):
+                self.store.set_work_item_status(task['task_id'], item['item_key'], 'done' if success else 'failed')
+        except Exception as e:
+            logger.warning(f"更新工作项失败 - 任务ID: {task['task_id']}, 错误: {str(e)}")
+        self._task_updated(task)
     
     def _check_monitor_tasks(self):
-        """检查监听任务"""
+        """检查监听任务：把每个监听任务的检查以monitor优先级提交给调度器"""
         with self.lock:
-            monitor_tasks = [t for t in self.tasks.values() if t['type'] == 'monitor' and t['status'] == 'running']
+            monitor_tasks = [
+                t for t in self.tasks.values()
+                if t['type'] == 'monitor' and t['status'] == 'running'
+                and t['task_id'] not in self.monitor_checks_inflight
+            ]
+            for task in monitor_tasks:
+                self.monitor_checks_inflight.add(task['task_id'])
         
         for task in monitor_tasks:
+            self.scheduler.submit(
+                task['task_id'],
+                lambda task=task: self._check_monitor_task(task),
+                user=task['username'],
+                priority=PRIORITY_MONITOR,
+                # 检查未执行就被移出队列（取消或停止）时同样清除标记，否则该监听任务不会再被检查
+                on_drop=lambda task_id=task['task_id']: self._discard_monitor_check(task_id)
+            )
+    
+    def _discard_monitor_check(self, task_id):
+        """监听检查结束或被移出调度队列"""
+        with self.lock:
+            self.monitor_checks_inflight.discard(task_id)
+    
+    def _check_monitor_task(self, task, retries=None):
+        """
+        检查单个监听任务
+        retries: 上次检查等待重试时让出工作线程保留的重试队列，继续时只处理其中的重试
+        """
+        resuming = retries is not None
+        cancel_token = CancelToken()
+        with self.lock:
+            if resuming and task['status'] != 'running':
+                # 等待重试期间监听任务已停止
+                self.monitor_checks_inflight.discard(task['task_id'])
+                return
+            self.cancel_tokens[task['task_id']] = cancel_token
+        retries = retries or RetryQueue(self.retry_policy)
+        transfer = self._start_transfer(task['task_id'])
+        retry_at = None
+        try:
+            current_time = datetime.now().isoformat()
+            
+            def on_commit(item, task=task):
+                if item['success']:
+                    with self.lock:
+                        task['downloaded_count'] += 1
+                        if item['episode'].get('published'):
+                            task['last_episode_times'][item['sub_key']] = item['episode']['published']
+                    if self.store and item['episode'].get('published'):
+                        self.store.set_cursor(task['task_id'], item['sub_key'], item['episode']['published'])
+                self._finish_work_item(task, item)
+            
+            pipeline = self._build_episode_pipeline(
+                task, on_commit, name=f"monitor-{task['task_id'][:8]}", cancel_token=cancel_token, retries=retries,
+                transfer=transfer
+            )
+            pipeline.start()
             try:
-                current_time = datetime.now().isoformat()
+                # 先继续上次检查中发现但尚未完成的节目（例如重启前中断的下载）
+                queued_keys = set()
+                if self.store and not resuming:
+                    for item_key, _, work_item in self.store.get_work_items(task['task_id'], statuses=('pending',)):
+                        queued_keys.add(item_key)
+                        retries.track()
+                        pipeline.put(work_item)
                 
-                for subscription in task['subscriptions']:
+                for subscription in ([] if resuming else task['subscriptions']):
+                    if cancel_token.cancelled:
+                        break
                     rss_url = subscription.get('xmlUrl', '')
                     if not rss_url:
                         continue
@@ -149,28 +568,145 @@ class TaskManager:
                     # 检查更新
                     new_episodes = check_rss_update(rss_url, last_check_time)
                     
-                    for episode in new_episodes:
-                        if episode.get('audio_url'):
-                            success, file_id, file_path = self.download_manager.download_file(
-                                episode['audio_url'],
-                                episode_info=episode,
-                                username=task['username']
-                            )
-                            
-                            if success:
-                                # 如果需要转换
-                                if task.get('convert_to_mp3', False):
-                                    self._convert_downloaded_file(file_id, file_path)
-                                
-                                with self.lock:
-                                    task['downloaded_count'] += 1
-                                    if episode.get('published'):
-                                        task['last_episode_times'][sub_key] = episode['published']
+                    work_items = [
+                        {
+                            'item_key': episode['audio_url'],
+                            'sub_key': sub_key,
+                            'episode': dict(episode, podcast_title=subscription.get('title', ''))
+                        }
+                        for episode in new_episodes
+                        if episode.get('audio_url') and episode['audio_url'] not in queued_keys
+                    ]
+                    self._register_work_items(task, work_items)
+                    for work_item in work_items:
+                        if cancel_token.cancelled:
+                            break
+                        queued_keys.add(work_item['item_key'])
+                        retries.track()
+                        pipeline.put(work_item)
                 
-                with self.lock:
+                retry_at = self._drain_retries(pipeline, retries, cancel_token)
+            finally:
+                pipeline.close()
+                pipeline.join()
+            
+            with self.lock:
+                if not resuming:
                     task['last_check'] = current_time
-            except Exception as e:
-                print(f"监听任务检查失败: {e}")
+                task['pipeline'] = pipeline.get_stats()
+                task['retries'] = retries.get_stats()
+            self._task_updated(task)
+        except Exception as e:
+            print(f"监听任务检查失败: {e}")
+            retry_at = None
+        finally:
+            self._finish_transfer(task)
+            with self.lock:
+                if self.cancel_tokens.get(task['task_id']) is cancel_token:
+                    del self.cancel_tokens[task['task_id']]
+            if retry_at is None:
+                self._discard_monitor_check(task['task_id'])
+        if retry_at is not None:
+            # 剩余的重试都要等待较长时间，让出工作线程，到期后继续；期间不开始新的检查
+            self.scheduler.submit(
+                task['task_id'],
+                lambda: self._check_monitor_task(task, retries),
+                user=task['username'],
+                priority=PRIORITY_MONITOR,
+                on_drop=lambda task_id=task['task_id']: self._discard_monitor_check(task_id),
+                not_before=retry_at
+            )
+    
+    def _build_episode_pipeline(self, task, on_commit, on_error=None, name='pipeline', cancel_token=None,
+                                retries=None, transfer=None):
+        """
+        构建节目处理流水线：下载(fetch) -> 转换(transcode) -> 提交元数据(commit)
+        
+        阶段之间使用有界队列，第N+1集下载时第N集可以同时转换
+        输入为工作项 {'item_key', 'episode', 'sub_key'/'sub_idx'}
+        on_commit(item) 在提交阶段调用，item包含episode、success、file_id、file_path等字段
+        cancel_token取消后，尚未下载的节目被丢弃，进行中的下载和转换立即中断，
+        已下载完成的节目不再转换、直接提交
+        retries: 可选的RetryQueue，下载遇到暂时性错误时工作项进入重试队列，由生产者到期后重新提交
+        transfer: 可选的TransferStats，记录每个下载的字节级进度
+        """
+        convert_to_mp3 = task.get('convert_to_mp3', False)
+        cancel_token = cancel_token or CancelToken()
+        retries = retries or RetryQueue(RetryPolicy(max_attempts=1))
+        
+        def fetch(work_item):
+            item = None
+            try:
+                if cancel_token.cancelled:
+                    return None
+                episode = work_item['episode']
+                item = {
+                    'episode': episode,
+                    'started_at': time.time(),
+                    'item_key': work_item.get('item_key'),
+                    'sub_key': work_item.get('sub_key'),
+                    'attempts': work_item.get('attempts', 0),
+                    'success': False,
+                    'file_id': None,
+                    'file_path': None,
+                    'converted_path': None
+                }
+                progress_callback = transfer.track(item['item_key'], episode.get('title')) if transfer else None
+                try:
+                    item['success'], item['file_id'], item['file_path'] = self.download_manager.download_file(
+                        episode['audio_url'],
+                        episode_info=episode,
+                        username=task['username'],
+                        cancel_token=cancel_token,
+                        raise_errors=True,
+                        progress_callback=progress_callback
+                    )
+                except Exception as e:
+                    if cancel_token.cancelled:
+                        # 被取消的下载不计为失败，工作项保持pending
+                        return None
+                    scheduled, error_class = retries.handle_failure(work_item, e)
+                    if scheduled:
+                        return None
+                    item['error'] = str(e)
+                    item['error_class'] = error_class
+                    return item
+                retries.record_success(work_item)
+                return item
+            finally:
+                if transfer:
+                    transfer.finish(work_item.get('item_key'), success=bool(item and item['success']))
+                retries.done()
+        
+        def transcode(item):
+            # 如果需要转换且下载成功
+            if item['success'] and convert_to_mp3 and not cancel_token.cancelled:
+                item['converted_path'] = self._convert_downloaded_file(
+                    item['file_id'], item['file_path'], cancel_token=cancel_token
+                )
+            return item
+        
+        def commit(item):
+            if item['converted_path'] and not self._commit_converted_file(
+                item['file_id'], item['file_path'], item['converted_path']
+            ):
+                item['converted_path'] = None
+            if item['success']:
+                item['bytes'] = _file_size(item['converted_path'] or item['file_path'])
+            item['duration'] = round(time.time() - item['started_at'], 3)
+            on_commit(item)
+            return item
+        
+        stages = [
+            PipelineStage('fetch', fetch, size_of=lambda item: _file_size(item['file_path']) if item['success'] else 0),
+            PipelineStage('transcode', transcode, size_of=lambda item: _file_size(item['file_path']) if item['converted_path'] else 0),
+            PipelineStage('commit', commit)
+        ]
+        return Pipeline(stages, queue_size=self.pipeline_queue_size, on_error=on_error, name=name)
+    
+    def is_maintenance_leader(self):
+        """本进程是否负责监听检查等全局后台任务：单进程部署时始终负责，多进程部署时只有持有主节点租约的进程负责"""
+        return self.role != ROLE_API and (not self.leader or self.leader.is_leader)
     
     def start_background_thread(self):
         """启动后台线程"""
@@ -178,65 +714,393 @@ class TaskManager:
             return
         
         self.running = True
+        if self.leader:
+            self.leader.start()
+        if self.role != ROLE_API:
+            self.resume_tasks()
         
         def background_worker():
             while self.running:
                 try:
-                    self._check_monitor_tasks()
+                    # 多进程部署时只有主节点执行监听检查，避免重复下载
+                    if self.is_maintenance_leader():
+                        self._check_monitor_tasks()
+                    self.prune_history()
                 except Exception as e:
                     print(f"后台任务执行失败: {e}")
                 time.sleep(60)  # 每分钟检查一次
         
         self.thread = threading.Thread(target=background_worker, daemon=True)
         self.thread.start()
+        
+        if self.coordinator:
+            threading.Thread(target=self._sync_worker, name='task-sync', daemon=True).start()
+            if self.role != ROLE_API:
+                threading.Thread(target=self._queue_worker, name='task-queue', daemon=True).start()
     
     def stop_background_thread(self):
         """停止后台线程"""
         self.running = False
+        if self.leader:
+            self.leader.stop()
+    
+    def shutdown(self, timeout=60):
+        """
+        优雅停止：不再领取和开始新任务，等待执行中的任务完成
+        超时后中断执行中的下载任务并保存为pending，重启后（多进程部署时由其他工作进程）从未完成的工作项继续
+        返回: 是否所有任务都在超时前完成
+        """
+        self.stop_background_thread()
+        self.scheduler.stop()
+        if self.coordinator:
+            # 已领取但尚未开始的任务放回共享队列
+            with self.lock:
+                claimed = list(self.claimed_jobs)
+            for task_id in claimed:
+                if self.scheduler.cancel(task_id):
+                    self._release_job(task_id)
+        # 其余排队中的任务不会再执行（执行on_drop回调清理状态）
+        self.scheduler.clear()
+        
+        if self.scheduler.wait_idle(timeout):
+            logger.info("后台任务已全部完成")
+            return True
+        
+        with self.lock:
+            self.shutting_down = True
+            tokens = list(self.cancel_tokens.items())
+        for task_id, cancel_token in tokens:
+            logger.info(f"中断执行中的任务，重启后继续: {task_id}")
+            cancel_token.cancel()
+        if not self.scheduler.wait_idle(10):
+            logger.warning("仍有后台任务未结束，强制退出")
+        return False
+    
+    def wake_subscribers(self):
+        """唤醒所有等待任务变更的订阅者（服务停止时让SSE连接尽快结束）"""
+        with self.change_condition:
+            self.change_condition.notify_all()
+    
+    def _queue_worker(self):
+        """从共享队列领取下载任务：本进程有空闲工作线程时才领取，已领取任务的租约定期续期"""
+        last_extend = time.time()
+        while self.running:
+            try:
+                if time.time() - last_extend >= JOB_LEASE_SECONDS / 3:
+                    last_extend = time.time()
+                    with self.lock:
+                        claimed = list(self.claimed_jobs)
+                    for task_id in claimed:
+                        if not self.coordinator.extend(task_id, self.owner_id, JOB_LEASE_SECONDS):
+                            logger.warning(f"任务租约已失效，可能已被其他进程领取: {task_id}")
+                
+                job = None
+                if self.scheduler.has_capacity():
+                    job = self.coordinator.claim(DOWNLOAD_QUEUE, self.owner_id, JOB_LEASE_SECONDS)
+                if not job:
+                    time.sleep(1)
+                    continue
+                self._start_claimed_job(job[0])
+            except Exception as e:
+                logger.exception(f"领取共享队列任务失败: {str(e)}")
+                time.sleep(5)
+    
+    def _start_claimed_job(self, task_id):
+        """执行从共享队列领取的任务"""
+        task = self.store.load_task(task_id)
+        if not task or task['status'] not in ('pending', 'running'):
+            self.coordinator.ack(task_id)
+            return
+        if task['status'] == 'running':
+            # 之前执行该任务的进程已退出，从未完成的工作项继续
+            task['status'] = 'pending'
+            task['resumed_at'] = datetime.now().isoformat()
+        if task.get('results'):
+            task['results'] = [_compact_result(r) for r in task['results']]
+        with self.lock:
+            self.tasks[task_id] = task
+            self.claimed_jobs.add(task_id)
+        logger.info(f"已从共享队列领取任务: {task_id}")
+        self._execute_download_latest_task(task_id, on_done=lambda: self._release_job(task_id))
+    
+    def _release_job(self, task_id):
+        """任务执行结束，从共享队列删除；未完成（进程停止时中断）的任务重新放回队列"""
+        with self.lock:
+            self.claimed_jobs.discard(task_id)
+            task = self.tasks.get(task_id)
+            unfinished = task is not None and task['status'] == 'pending'
+        try:
+            self.coordinator.ack(task_id)
+            if unfinished:
+                self.coordinator.enqueue(DOWNLOAD_QUEUE, task_id, {'task_id': task_id})
+        except Exception as e:
+            logger.warning(f"确认任务完成失败 - 任务ID: {task_id}, 错误: {str(e)}")
+    
+    def _is_local_task(self, task_id):
+        """任务是否由本进程执行（调用方需持有self.lock）"""
+        return (task_id in self.cancel_tokens or task_id in self.claimed_jobs
+                or task_id in self.monitor_checks_inflight)
+    
+    def _sync_worker(self):
+        """多进程部署时定期同步其他进程的任务变化并处理取消请求"""
+        while self.running:
+            try:
+                self._sync_from_store()
+                self._process_cancel_requests()
+            except Exception as e:
+                logger.warning(f"同步任务状态失败: {str(e)}")
+            time.sleep(self.sync_interval)
+    
+    def _sync_from_store(self):
+        """从store加载其他进程新建或更新的任务，移除已被归档的任务"""
+        versions = self.store.get_task_versions()
+        with self.lock:
+            changed_ids = [
+                task_id for task_id, updated_at in versions.items()
+                if self.store_versions.get(task_id) != updated_at and not self._is_local_task(task_id)
+            ]
+            removed_ids = [
+                task_id for task_id in self.tasks
+                if task_id not in versions and task_id in self.store_versions and not self._is_local_task(task_id)
+            ]
+            for task_id in removed_ids:
+                del self.tasks[task_id]
+            self.store_versions = versions
+        
+        for task in self.store.load_tasks(changed_ids):
+            if task.get('results'):
+                task['results'] = [_compact_result(r) for r in task['results']]
+            with self.lock:
+                if self._is_local_task(task['task_id']):
+                    continue
+                self.tasks[task['task_id']] = task
+            self._publish_change(task['task_id'])
+        for task_id in removed_ids:
+            self._publish_change(task_id, removed=True)
+    
+    def _process_cancel_requests(self):
+        """处理其他进程登记的取消请求：由执行该任务的进程（监听任务由主节点）取消"""
+        for task_id in self.coordinator.get_cancel_requests():
+            with self.lock:
+                task = self.tasks.get(task_id)
+                handles = task is not None and (
+                    task_id in self.cancel_tokens or task_id in self.claimed_jobs
+                    or (task['type'] == 'monitor' and self.leader is not None and self.leader.is_leader)
+                )
+                finished = task is not None and task['status'] in FINISHED_STATUSES
+            if handles:
+                self._cancel_local_task(task_id)
+                self.coordinator.clear_cancel_request(task_id)
+            elif finished:
+                self.coordinator.clear_cancel_request(task_id)
+    
+    def _with_live_info(self, task):
+        """附加实时信息：排队中的任务附加调度信息（优先级和已等待时间），执行中的任务附加下载统计"""
+        if task['status'] == 'pending':
+            queue_info = self.scheduler.get_queue_position(task['task_id'])
+            if queue_info:
+                return {**task, 'queue': queue_info}
+            return task
+        transfer = self.transfers.get(task['task_id'])
+        if not transfer or task['status'] != 'running':
+            return task
+        pending_files = 0
+        progress = task.get('progress')
+        if progress:
+            # 尚未开始下载的文件数，用于估算剩余时间
+            stats = transfer.get_stats()
+            pending_files = max(0, progress['total'] - progress['failed'] - stats['files_downloaded'] - len(stats['active_downloads']))
+        return {**task, 'transfer': transfer.get_stats(pending_files=pending_files)}
     
     def get_task(self, task_id):
         """获取任务"""
         with self.lock:
-            return self.tasks.get(task_id)
+            task = self.tasks.get(task_id)
+        return self._with_live_info(task) if task else None
     
     def get_all_tasks(self):
         """获取所有任务"""
         with self.lock:
-            return list(self.tasks.values())
+            tasks = list(self.tasks.values())
+        return [self._with_live_info(task) for task in tasks]
+    
+    def get_task_summary(self, task_id):
+        """获取任务摘要：不含完整结果列表，只附带结果数量和最近几条结果，用于列表展示和增量推送"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if not task:
+                return None
+            summary = {
+                k: v for k, v in task.items()
+                if k not in ('results', 'subscriptions', 'last_episode_times', 'resolved_subscriptions')
+            }
+            results = task.get('results') or []
+            summary['subscription_count'] = len(task.get('subscriptions') or [])
+            summary['results_count'] = len(results)
+            summary['recent_results'] = results[-RECENT_RESULTS:]
+        return self._with_live_info(summary)
+    
+    def get_all_task_summaries(self):
+        """获取所有任务的摘要"""
+        with self.lock:
+            task_ids = list(self.tasks)
+        return [summary for summary in map(self.get_task_summary, task_ids) if summary]
+    
+    def _publish_change(self, task_id, removed=False):
+        """记录任务变更并唤醒等待中的订阅者"""
+        with self.change_condition:
+            self.change_version += 1
+            self.change_log.append((self.change_version, task_id, removed))
+            self.change_condition.notify_all()
+    
+    def wait_for_changes(self, since, timeout=15.0):
+        """
+        等待版本号since之后的任务变更
+        返回: (version, changed_ids, removed_ids, reset)
+            reset为True表示变更日志已无法覆盖since之后的变化（例如服务重启或客户端落后太多），
+            订阅者应重新获取全部任务
+        超时没有变化时changed_ids和removed_ids为空
+        """
+        with self.change_condition:
+            if since == self.change_version:
+                self.change_condition.wait(timeout)
+            version = self.change_version
+            oldest = self.change_log[0][0] if self.change_log else version + 1
+            if since > version or since < oldest - 1:
+                return version, [], [], True
+            changed = {}
+            for change_version, task_id, removed in self.change_log:
+                if change_version > since:
+                    changed[task_id] = removed
+        changed_ids = [task_id for task_id, removed in changed.items() if not removed]
+        removed_ids = [task_id for task_id, removed in changed.items() if removed]
+        return version, changed_ids, removed_ids, False
+    
+    def get_scheduler_stats(self):
+        """获取调度器统计（队列深度、等待时间），多进程部署时附带共享队列的统计"""
+        stats = self.scheduler.get_stats()
+        if self.coordinator:
+            try:
+                stats['coordination'] = {
+                    **self.coordinator.get_stats(),
+                    'role': self.role,
+                    'owner': self.owner_id,
+                    'is_leader': self.leader.is_leader if self.leader else False
+                }
+            except Exception as e:
+                logger.warning(f"获取协调后端统计失败: {str(e)}")
+        return stats
+    
+    def prune_history(self):
+        """
+        清理已结束的任务：超过保留天数或超出数量上限的最旧任务移出内存
+        有持久化存储时归档到存储中，可通过get_task_history查询
+        返回: 移出的任务数
+        """
+        cutoff = (datetime.now() - timedelta(days=self.history_max_age_days)).isoformat()
+        with self.lock:
+            finished = sorted(
+                (t for t in self.tasks.values() if t['status'] in FINISHED_STATUSES),
+                key=lambda t: t.get('finished_at') or t.get('created_at', ''),
+                reverse=True
+            )
+            evicted = [
+                t for index, t in enumerate(finished)
+                if index >= self.history_limit or (t.get('finished_at') or t.get('created_at', '')) < cutoff
+            ]
+            for task in evicted:
+                del self.tasks[task['task_id']]
+        
+        for task in evicted:
+            self._publish_change(task['task_id'], removed=True)
+            if not self.store:
+                continue
+            try:
+                self.store.archive_task(task)
+            except Exception as e:
+                logger.warning(f"归档任务失败 - 任务ID: {task['task_id']}, 错误: {str(e)}")
+        if evicted:
+            logger.info(f"已从内存中移出{len(evicted)}个已结束的任务")
+        return len(evicted)
+    
+    def get_task_history(self, username=None, limit=50, offset=0):
+        """查询已归档的任务（按结束时间倒序）"""
+        if not self.store:
+            return []
+        return self.store.list_archived_tasks(username=username, limit=limit, offset=offset)
     
     def cancel_task(self, task_id):
-        """取消任务"""
+        """取消任务：排队中的任务移出队列，执行中的任务立即中断下载和转换"""
+        if self.coordinator:
+            with self.lock:
+                task = self.tasks.get(task_id)
+                if not task or task['status'] not in ('pending', 'running'):
+                    return False
+                local = task_id in self.cancel_tokens or task_id in self.claimed_jobs
+                is_monitor = task['type'] == 'monitor'
+            if not local and not (is_monitor and self.leader and self.leader.is_leader):
+                if is_monitor or not self.coordinator.remove_unclaimed(task_id):
+                    # 任务在其他进程中执行，登记取消请求，由执行该任务的进程处理
+                    self.coordinator.request_cancel(task_id)
+                    return True
+        return self._cancel_local_task(task_id)
+    
+    def _cancel_local_task(self, task_id):
+        """在本进程中取消任务"""
+        cancelled = None
+        cancel_token = None
         with self.lock:
             if task_id in self.tasks:
                 task = self.tasks[task_id]
                 if task['status'] in ['pending', 'running']:
                     task['status'] = 'cancelled'
-                    return True
+                    task['cancelled_at'] = task['finished_at'] = datetime.now().isoformat()
+                    cancelled = task
+                    cancel_token = self.cancel_tokens.get(task_id)
+        if cancelled:
+            # 尚未开始执行的任务直接从调度队列移除
+            if self.scheduler.cancel(task_id) and task_id in self.claimed_jobs:
+                self._release_job(task_id)
+            if cancel_token:
+                cancel_token.cancel()
+            self._task_updated(cancelled)
+            return True
         return False
     
-    def _convert_downloaded_file(self, file_id, file_path):
-        """转换下载的文件为MP3并删除原文件"""
+    def _convert_downloaded_file(self, file_id, file_path, cancel_token=None):
+        """
+        转换下载的文件为MP3
+        只执行转换，不修改元数据和原文件，由_commit_converted_file提交
+        cancel_token取消时终止ffmpeg并返回None
+        返回: 转换后的文件路径，无需转换或转换失败时返回None
+        """
         try:
             if not file_path or not os.path.exists(file_path):
                 logger.warning(f"文件不存在，无法转换: {file_path}")
-                return
+                return None
+            
+            # 多个用户共享的文件不替换（其他用户下载的是原格式），需要mp3时通过 /downloads/<file_id>?format=mp3 获取
+            info = self.download_manager.get_file_info(file_id)
+            if info and len(entry_owners(info)) > 1:
+                logger.info(f"文件由多个用户共享，不转换: {file_path}")
+                return None
             
             audio_format = get_audio_format(file_path)
             
             # 如果已经是MP3，不需要转换
             if audio_format == 'mp3':
                 logger.info(f"文件已经是MP3格式: {file_path}")
-                return
+                return None
             
             # 如果不是M4A，不转换
             if audio_format != 'm4a':
                 logger.info(f"文件格式为{audio_format}，只转换M4A格式: {file_path}")
-                return
+                return None
             
             # 检查ffmpeg
             if not check_ffmpeg():
                 logger.warning("ffmpeg未安装，无法转换格式")
-                return
+                return None
             
             # 生成输出路径
             base_name = os.path.splitext(file_path)[0]
@@ -244,31 +1108,28 @@ class TaskManager:
             
             # 执行转换
             logger.info(f"开始转换音频文件 - 输入: {file_path}, 输出: {output_path}")
-            success, converted_path, error = convert_m4a_to_mp3(file_path, output_path)
+            success, converted_path, error = convert_m4a_to_mp3(file_path, output_path, cancel_token=cancel_token)
             
             if success:
-                # 删除原始文件
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info(f"已删除原始文件: {file_path}")
-                except Exception as e:
-                    logger.warning(f"删除原始文件失败: {file_path}, 错误: {str(e)}")
-                
-                # 更新元数据（保持原file_id，替换文件信息）
-                new_filename = os.path.basename(converted_path)
-                file_info = self.download_manager.metadata.get(file_id)
-                if file_info:
-                    self.download_manager.metadata[file_id]['filename'] = new_filename
-                    self.download_manager.metadata[file_id]['file_path'] = converted_path
-                    self.download_manager.metadata[file_id]['size'] = os.path.getsize(converted_path)
-                    self.download_manager.metadata[file_id]['downloaded_at'] = datetime.now().isoformat()
-                    self.download_manager._save_metadata()
-                    logger.info(f"音频转换成功并替换原文件 - 文件ID: {file_id}, 输出文件: {converted_path}")
-                else:
-                    logger.warning(f"未找到文件元数据: {file_id}")
-            else:
-                logger.error(f"音频转换失败 - 文件ID: {file_id}, 输入文件: {file_path}, 错误信息: {error}")
+                return converted_path
+            logger.error(f"音频转换失败 - 文件ID: {file_id}, 输入文件: {file_path}, 错误信息: {error}")
         except Exception as e:
             logger.exception(f"转换下载文件时发生异常 - 文件ID: {file_id}, 文件路径: {file_path}, 异常信息: {str(e)}")
-
+        return None
+    
+    def _commit_converted_file(self, file_id, file_path, converted_path):
+        """
+        提交转换结果：更新元数据指向MP3文件并删除原文件
+        转换期间文件被其他用户共享、删除或替换时放弃转换结果
+        返回: 是否已替换
+        """
+        try:
+            # 更新元数据（保持原file_id，替换文件信息）
+            if not self.download_manager.replace_converted_file(file_id, file_path, converted_path):
+                logger.warning(f"文件已被共享、删除或替换，放弃转换结果 - 文件ID: {file_id}")
+                return False
+            logger.info(f"音频转换成功并替换原文件 - 文件ID: {file_id}, 输出文件: {converted_path}")
+            return True
+        except Exception as e:
+            logger.exception(f"提交转换结果时发生异常 - 文件ID: {file_id}, 文件路径: {converted_path}, 异常信息: {str(e)}")
+            return False
@@ -0,0 +1,228 @@
+"""
+任务持久化存储
+使用SQLite保存任务、监听游标和待处理的工作项，进程重启后可以继续未完成的工作
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    task_id TEXT NOT NULL,
+    cursor_key TEXT NOT NULL,
+    value TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (task_id, cursor_key)
+);
+CREATE TABLE IF NOT EXISTS work_items (
+    task_id TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (task_id, item_key)
+);
+CREATE INDEX IF NOT EXISTS idx_work_items_status ON work_items (task_id, status);
+CREATE TABLE IF NOT EXISTS task_archive (
+    task_id TEXT PRIMARY KEY,
+    username TEXT,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    finished_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_task_archive_finished ON task_archive (finished_at);
+'''
+
+class TaskStore:
+    def __init__(self, db_path='data/tasks.db', archive_limit=5000):
+        """
+        参数:
+            db_path: 数据库文件路径
+            archive_limit: 归档任务的保留数量上限，超出时删除最旧的归档
+        """
+        self.db_path = db_path
+        self.archive_limit = archive_limit
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # 多个进程共享数据库时，其他进程持有写锁最多等待10秒
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        # WAL模式：单行更新只追加日志，读写互不阻塞
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+
+    def save_task(self, task):
+        """保存（插入或更新）单个任务"""
+        # 监听游标单独存储，避免每次更新游标都重写整个任务
+        data = {k: v for k, v in task.items() if k != 'last_episode_times'}
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, type, status, updated_at, data) VALUES (?, ?, ?, ?, ?)',
+                (task['task_id'], task['type'], task['status'], time.time(), json.dumps(data, ensure_ascii=False))
+            )
+
+    def delete_task(self, task_id):
+        """删除任务及其游标和工作项"""
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+            self.conn.execute('DELETE FROM cursors WHERE task_id = ?', (task_id,))
+            self.conn.execute('DELETE FROM work_items WHERE task_id = ?', (task_id,))
+            self.conn.execute('COMMIT')
+
+    def load_tasks(self, task_ids=None):
+        """
+        加载任务，监听任务的游标合并到last_episode_times
+        task_ids: 只加载指定的任务，为None时加载所有任务
+        """
+        with self.lock:
+            if task_ids is None:
+                rows = self.conn.execute('SELECT data FROM tasks').fetchall()
+                cursor_rows = self.conn.execute('SELECT task_id, cursor_key, value FROM cursors').fetchall()
+            else:
+                task_ids = list(task_ids)
+                if not task_ids:
+                    return []
+                placeholders = ', '.join('?' for _ in task_ids)
+                rows = self.conn.execute(f'SELECT data FROM tasks WHERE task_id IN ({placeholders})', task_ids).fetchall()
+                cursor_rows = self.conn.execute(
+                    f'SELECT task_id, cursor_key, value FROM cursors WHERE task_id IN ({placeholders})', task_ids
+                ).fetchall()
+
+        cursors = {}
+        for task_id, cursor_key, value in cursor_rows:
+            cursors.setdefault(task_id, {})[cursor_key] = value
+
+        tasks = []
+        for (data,) in rows:
+            try:
+                task = json.loads(data)
+            except ValueError:
+                logger.warning("跳过无法解析的任务记录")
+                continue
+            if task.get('type') == 'monitor':
+                task['last_episode_times'] = cursors.get(task['task_id'], {})
+            tasks.append(task)
+        return tasks
+
+    def load_task(self, task_id):
+        """加载单个任务，不存在时返回None"""
+        tasks = self.load_tasks([task_id])
+        return tasks[0] if tasks else None
+
+    def get_task_versions(self):
+        """获取所有任务的更新时间 {task_id: updated_at}，用于多进程之间同步任务状态"""
+        with self.lock:
+            rows = self.conn.execute('SELECT task_id, updated_at FROM tasks').fetchall()
+        return dict(rows)
+
+    def set_cursor(self, task_id, cursor_key, value):
+        """更新监听任务某个订阅的游标（最后节目时间）"""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cursors (task_id, cursor_key, value, updated_at) VALUES (?, ?, ?, ?)',
+                (task_id, cursor_key, value, time.time())
+            )
+
+    def add_work_items(self, task_id, items):
+        """
+        批量登记工作项，已存在的工作项保持原状态
+        items: [(item_key, payload), ...]
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM work_items WHERE task_id = ?', (task_id,)).fetchone()
+            seq = row[0]
+            self.conn.execute('BEGIN')
+            for item_key, payload in items:
+                seq += 1
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO work_items (task_id, item_key, seq, status, payload, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (task_id, item_key, seq, 'pending', json.dumps(payload, ensure_ascii=False), now)
+                )
+            self.conn.execute('COMMIT')
+
+    def set_work_item_status(self, task_id, item_key, status):
+        """更新工作项状态（pending/done/failed）"""
+        with self.lock:
+            self.conn.execute(
+                'UPDATE work_items SET status = ?, updated_at = ? WHERE task_id = ? AND item_key = ?',
+                (status, time.time(), task_id, item_key)
+            )
+
+    def get_work_items(self, task_id, statuses=None):
+        """
+        获取任务的工作项，按登记顺序排列
+        返回: [(item_key, status, payload), ...]
+        """
+        sql = 'SELECT item_key, status, payload FROM work_items WHERE task_id = ?'
+        params = [task_id]
+        if statuses:
+            sql += f" AND status IN ({', '.join('?' for _ in statuses)})"
+            params.extend(statuses)
+        sql += ' ORDER BY seq'
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [(item_key, status, json.loads(payload)) for item_key, status, payload in rows]
+
+    def archive_task(self, task):
+        """把已结束的任务移入归档表，同时删除其游标和工作项"""
+        data = {k: v for k, v in task.items() if k != 'last_episode_times'}
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute(
+                'INSERT OR REPLACE INTO task_archive (task_id, username, type, status, finished_at, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (task['task_id'], task.get('username'), task['type'], task['status'],
+                 task.get('finished_at') or task.get('created_at'), json.dumps(data, ensure_ascii=False))
+            )
+            self.conn.execute('DELETE FROM tasks WHERE task_id = ?', (task['task_id'],))
+            self.conn.execute('DELETE FROM cursors WHERE task_id = ?', (task['task_id'],))
+            self.conn.execute('DELETE FROM work_items WHERE task_id = ?', (task['task_id'],))
+            # 超出保留数量的最旧归档直接删除
+            self.conn.execute(
+                'DELETE FROM task_archive WHERE task_id IN ('
+                'SELECT task_id FROM task_archive ORDER BY finished_at DESC LIMIT -1 OFFSET ?)',
+                (self.archive_limit,)
+            )
+            self.conn.execute('COMMIT')
+
+    def list_archived_tasks(self, username=None, limit=50, offset=0):
+        """查询归档任务，按结束时间倒序"""
+        sql = 'SELECT data FROM task_archive'
+        params = []
+        if username:
+            sql += ' WHERE username = ?'
+            params.append(username)
+        sql += ' ORDER BY finished_at DESC LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def ping(self):
+        """检查数据库是否可用（用于就绪检查）"""
+        with self.lock:
+            self.conn.execute('SELECT 1').fetchone()
+    
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()
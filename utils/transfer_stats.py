@@ -0,0 +1,164 @@
+"""
+下载传输统计
+汇总一个任务中各个下载的字节级进度：当前和平均吞吐量、预计剩余时间、首字节时间（TTFB）
+"""
+import time
+import threading
+from collections import deque
+
+class TransferStats:
+    def __init__(self, window=5.0, on_progress=None, notify_interval=1.0):
+        """
+        参数:
+            window: 计算当前吞吐量的滑动窗口秒数
+            on_progress: 可选回调，有下载进度时调用（按notify_interval限频），用于推送任务变化
+            notify_interval: on_progress的最小调用间隔秒数
+        """
+        self.window = window
+        self.on_progress = on_progress
+        self.notify_interval = notify_interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.samples = deque()
+        self.bytes_downloaded = 0
+        self.files_completed = 0
+        self.bytes_completed = 0
+        self.ttfbs = []
+        self.first_started_at = None
+        self.busy_seconds = 0.0
+        self.busy_since = None
+        self.last_notify = 0.0
+
+    def track(self, key, title=None):
+        """
+        开始跟踪一个下载
+        返回: progress_callback(downloaded, total)，传给DownloadManager.download_file
+        """
+        now = time.time()
+        with self.lock:
+            self.active[key] = {
+                'title': title,
+                'started_at': now,
+                'downloaded': 0,
+                'total': None,
+                'ttfb': None
+            }
+            if self.first_started_at is None:
+                self.first_started_at = now
+            if self.busy_since is None:
+                self.busy_since = now
+
+        def progress_callback(downloaded, total):
+            self._update(key, downloaded, total)
+        return progress_callback
+
+    def _update(self, key, downloaded, total):
+        now = time.time()
+        notify = False
+        with self.lock:
+            entry = self.active.get(key)
+            if not entry:
+                return
+            if entry['ttfb'] is None:
+                # 第一次回调发生在收到响应头之后
+                entry['ttfb'] = now - entry['started_at']
+                self.ttfbs.append(entry['ttfb'])
+            delta = downloaded - entry['downloaded']
+            entry['downloaded'] = downloaded
+            entry['total'] = total
+            if delta > 0:
+                self.bytes_downloaded += delta
+                self.samples.append((now, delta))
+            self._trim_samples(now)
+            if self.on_progress and now - self.last_notify >= self.notify_interval:
+                self.last_notify = now
+                notify = True
+        if notify:
+            self.on_progress()
+
+    def finish(self, key, success=True):
+        """结束跟踪一个下载"""
+        now = time.time()
+        with self.lock:
+            entry = self.active.pop(key, None)
+            if entry and success:
+                self.files_completed += 1
+                self.bytes_completed += entry['downloaded']
+            if not self.active and self.busy_since is not None:
+                self.busy_seconds += now - self.busy_since
+                self.busy_since = None
+
+    def _trim_samples(self, now):
+        """丢弃滑动窗口之外的样本（调用方需持有self.lock）"""
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def get_stats(self, pending_files=0):
+        """
+        获取传输统计
+        pending_files: 尚未开始下载的文件数，按估算的文件大小计算剩余字节
+        """
+        now = time.time()
+        with self.lock:
+            self._trim_samples(now)
+            window_bytes = sum(nbytes for _, nbytes in self.samples)
+            # 窗口从第一次下载开始计算，避免刚开始时低估速度
+            window_seconds = min(self.window, now - self.first_started_at) if self.first_started_at else 0.0
+            current_bps = window_bytes / window_seconds if window_seconds > 0 else 0.0
+            busy_seconds = self.busy_seconds + (now - self.busy_since if self.busy_since else 0.0)
+            average_bps = self.bytes_downloaded / busy_seconds if busy_seconds > 0 else 0.0
+
+            # 估算单个文件的大小：优先使用已完成文件的平均大小，其次使用进行中下载的Content-Length
+            known_totals = [entry['total'] for entry in self.active.values() if entry['total']]
+            if self.files_completed:
+                average_size = self.bytes_completed / self.files_completed
+            elif known_totals:
+                average_size = sum(known_totals) / len(known_totals)
+            else:
+                average_size = None
+
+            downloads = []
+            remaining_bytes = 0
+            unknown_size = False
+            for entry in self.active.values():
+                total = entry['total']
+                downloads.append({
+                    'title': entry['title'],
+                    'downloaded': entry['downloaded'],
+                    'total': total,
+                    'percent': round(entry['downloaded'] * 100 / total, 1) if total else None,
+                    'ttfb': round(entry['ttfb'], 3) if entry['ttfb'] is not None else None,
+                    'elapsed_seconds': round(now - entry['started_at'], 1)
+                })
+                if total:
+                    remaining_bytes += max(0, total - entry['downloaded'])
+                elif average_size is not None and entry['downloaded'] == 0:
+                    # 尚未收到响应头
+                    remaining_bytes += average_size
+                else:
+                    unknown_size = True
+
+            if pending_files > 0:
+                if average_size is not None:
+                    remaining_bytes += pending_files * average_size
+                else:
+                    unknown_size = True
+
+            rate = current_bps or average_bps
+            eta = None
+            if rate > 0 and not unknown_size:
+                eta = round(remaining_bytes / rate, 1)
+
+            return {
+                'bytes_downloaded': self.bytes_downloaded,
+                'files_downloaded': self.files_completed,
+                'current_bytes_per_sec': round(current_bps, 1),
+                'average_bytes_per_sec': round(average_bps, 1),
+                'eta_seconds': eta,
+                'ttfb': {
+                    'last': round(self.ttfbs[-1], 3) if self.ttfbs else None,
+                    'avg': round(sum(self.ttfbs) / len(self.ttfbs), 3) if self.ttfbs else None,
+                    'max': round(max(self.ttfbs), 3) if self.ttfbs else None
+                },
+                'active_downloads': downloads
+            }
@@ -0,0 +1,153 @@
+"""
+用户数据存储
+users/<用户名>.json 的读写层：缓存解析后的用户数据，文件修改时间变化时重新加载；
+写入先写临时文件再替换；维护内存中的用户索引，列出用户时不需要逐个读取文件
+"""
+import os
+import copy
+import json
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class UserStore:
+    def __init__(self, users_folder='users'):
+        self.users_folder = users_folder
+        self.lock = threading.RLock()
+        # 用户名 -> (文件修改时间, 用户数据)
+        self.cache = {}
+        # 用户名 -> 列表摘要，按目录修改时间判断是否需要重新扫描（其他进程可能新增或删除了用户）
+        self.index = {}
+        self.index_mtime = None
+        os.makedirs(users_folder, exist_ok=True)
+
+    def _user_file(self, username):
+        """用户文件路径，用户名不能包含路径"""
+        if not username or username in ('.', '..') or os.path.basename(username) != username or '\\' in username:
+            raise ValueError(f"无效的用户名: {username}")
+        return os.path.join(self.users_folder, f'{username}.json')
+
+    @staticmethod
+    def _summary(username, user_data):
+        return {
+            'username': username,
+            'created_at': user_data.get('created_at', ''),
+            'subscriptions_count': len(user_data.get('subscriptions', []))
+        }
+
+    def _load(self, username):
+        """
+        读取用户数据（调用方需持有self.lock），文件修改时间未变时使用缓存
+        返回: 缓存中的用户数据，不存在或无法解析时返回None
+        """
+        try:
+            user_file = self._user_file(username)
+            mtime = os.stat(user_file).st_mtime_ns
+        except (ValueError, FileNotFoundError):
+            self.cache.pop(username, None)
+            self.index.pop(username, None)
+            return None
+        cached = self.cache.get(username)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(user_file, 'r', encoding='utf-8') as f:
+                user_data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取用户文件失败: {user_file}, 错误: {str(e)}")
+            return None
+        self.cache[username] = (mtime, user_data)
+        self.index[username] = self._summary(username, user_data)
+        return user_data
+
+    def _write(self, username, user_data):
+        """写入用户文件并更新缓存和索引（调用方需持有self.lock）"""
+        user_file = self._user_file(username)
+        temp_file = f"{user_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(user_data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, user_file)
+        self.cache[username] = (os.stat(user_file).st_mtime_ns, user_data)
+        self.index[username] = self._summary(username, user_data)
+
+    def exists(self, username):
+        """用户是否存在"""
+        with self.lock:
+            return self._load(username) is not None
+
+    def get(self, username):
+        """获取用户数据（副本），不存在时返回None"""
+        with self.lock:
+            user_data = self._load(username)
+            return copy.deepcopy(user_data) if user_data is not None else None
+
+    def get_subscriptions(self, username):
+        """获取用户的订阅列表（副本），用户不存在时返回None"""
+        with self.lock:
+            user_data = self._load(username)
+            if user_data is None:
+                return None
+            return copy.deepcopy(user_data.get('subscriptions', []))
+
+    def create(self, username):
+        """
+        创建用户，用户名无效时抛出ValueError
+        返回: (是否新建, 用户数据副本)，用户已存在时返回已有数据
+        """
+        with self.lock:
+            self._user_file(username)
+            user_data = self._load(username)
+            if user_data is not None:
+                return False, copy.deepcopy(user_data)
+            user_data = {
+                'username': username,
+                'created_at': datetime.now().isoformat(),
+                'subscriptions': [],
+                'tasks': []
+            }
+            self._write(username, user_data)
+            return True, copy.deepcopy(user_data)
+
+    def update(self, username, **fields):
+        """
+        更新用户数据的字段并保存，同时更新updated_at
+        返回: 更新后的用户数据副本，用户不存在时返回None
+        """
+        with self.lock:
+            user_data = self._load(username)
+            if user_data is None:
+                return None
+            user_data = {**user_data, **fields, 'updated_at': datetime.now().isoformat()}
+            self._write(username, user_data)
+            return copy.deepcopy(user_data)
+
+    def _refresh_index(self):
+        """用户目录有变化时（新增、删除或替换了文件）重新扫描（调用方需持有self.lock）"""
+        try:
+            mtime = os.stat(self.users_folder).st_mtime_ns
+        except FileNotFoundError:
+            self.cache.clear()
+            self.index.clear()
+            self.index_mtime = None
+            return
+        if mtime == self.index_mtime:
+            return
+        usernames = {
+            filename[:-5] for filename in os.listdir(self.users_folder)
+            if filename.endswith('.json')
+        }
+        for username in list(self.index):
+            if username not in usernames:
+                self.index.pop(username, None)
+                self.cache.pop(username, None)
+        for username in usernames:
+            self._load(username)
+        self.index_mtime = mtime
+
+    def list_users(self):
+        """列出所有用户的摘要：用户名、创建时间、订阅数"""
+        with self.lock:
+            self._refresh_index()
+            return [dict(summary) for summary in self.index.values()]
@@ -0,0 +1,71 @@
+"""
+流式ZIP打包
+边读取文件边生成ZIP（存储模式，不重新压缩音频），不使用临时文件，内存占用与文件数量和大小无关；
+文件或归档超过4GB时自动使用ZIP64
+"""
+import os
+import time
+import zipfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _StreamBuffer:
+    """不可seek的输出对象，zipfile写入的数据暂存在这里，由生成器取出发送"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def unique_arcname(name, used_names):
+    """同名文件加序号，避免归档中的文件互相覆盖"""
+    candidate = name
+    base, ext = os.path.splitext(name)
+    index = 2
+    while candidate.lower() in used_names:
+        candidate = f"{base} ({index}){ext}"
+        index += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+def stream_zip(entries, chunk_size=1024 * 1024):
+    """
+    生成ZIP数据块
+    entries: 可迭代的 (归档内文件名, 本地文件路径)，读取失败的文件会被跳过
+    """
+    buffer = _StreamBuffer()
+    # 输出不可seek，zipfile会在每个文件数据之后写入数据描述符（CRC和大小）
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for arcname, file_path in entries:
+            try:
+                stat = os.stat(file_path)
+                source = open(file_path, 'rb')
+            except OSError as e:
+                logger.warning(f"打包时跳过无法读取的文件: {file_path}, 错误: {str(e)}")
+                continue
+            # ZIP的时间戳不能早于1980年
+            date_time = max(time.localtime(stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+            zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            # 预先给出文件大小，zipfile据此决定是否使用ZIP64
+            zinfo.file_size = stat.st_size
+            with source, archive.open(zinfo, 'w') as target:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    # 中央目录
+    yield buffer.pop()
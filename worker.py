@@ -0,0 +1,38 @@
+"""
+后台任务工作进程
+多进程部署时与Web进程（WORKER_ROLE=api）配合使用：从共享队列领取下载任务并执行，
+需要配置与Web进程相同的 COORDINATION_URL、DOWNLOAD_FOLDER 和 DATA_FOLDER
+用法: COORDINATION_URL=sqlite:///data/coordination.db python worker.py
+"""
+import os
+import signal
+import threading
+import logging
+
+os.environ.setdefault('WORKER_ROLE', 'worker')
+
+from app import app, task_manager, task_store, storage_tiering, reconciler
+
+logger = logging.getLogger(__name__)
+
+# SHUTDOWN_TIMEOUT: 停止时等待执行中任务的最长秒数，超时的任务被中断并放回共享队列
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '60'))
+
+if __name__ == '__main__':
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    logger.info(f"启动工作进程 - 角色: {task_manager.role}, 标识: {task_manager.owner_id}")
+    task_manager.start_background_thread()
+    if app.config['TIERING_ENABLED']:
+        storage_tiering.start_background_thread(app.config['TIERING_INTERVAL_HOURS'], should_run=task_manager.is_maintenance_leader)
+    if app.config['RECONCILE_ENABLED']:
+        reconciler.start_background_thread(app.config['RECONCILE_INTERVAL_HOURS'], should_run=task_manager.is_maintenance_leader)
+
+    while not stop_event.wait(1):
+        pass
+    logger.info("工作进程停止中，等待执行中的任务")
+    task_manager.shutdown(SHUTDOWN_TIMEOUT)
+    task_store.close()
+    logger.info("工作进程已退出")